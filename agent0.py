@@ -1,14 +1,20 @@
 #!python
 import ast
-import difflib
+import builtins
+import codecs
+import collections
+import contextlib
+import functools
+import hashlib
+import json
 import inspect
 import os
-import shutil
+import signal
 import sys
+import threading
+import time
+import types
 import uuid
-import random
-import string
-import pprint
 import re
 import importlib
 
@@ -18,22 +24,519 @@ Primordial code for automatic generation of complex agents through automatic age
 """
 
 num_doc_lines = 20
-history_level = 1
+# prompt token budget for the messages sent each iteration, older turns are dropped once they no longer fit;
+# it has to fit a full review of this file, about 35k tokens
+context_token_budget = int(os.getenv('AGENT0_CONTEXT_TOKENS', '64000'))
+# messages older than the latest one that are larger than this are elided to a head and tail
+max_message_tokens = int(os.getenv('AGENT0_MAX_MESSAGE_TOKENS', '4000'))
+
+# on-disk index of python_tools, so only new or changed tool modules are re-processed
+tool_catalog_name = '.tool_catalog.json'
+tool_catalog_version = 2
+_tool_catalogs = {}
+# tools are validated by importing them in subprocesses, in parallel, each within an import time and memory budget;
+# verdicts are kept in the catalog by content hash, failures only for tool_verdict_ttl as installs may fix them
+tool_validate_workers = int(os.getenv('AGENT0_TOOL_VALIDATE_WORKERS', str(min(4, os.cpu_count() or 1))))
+tool_import_timeout = float(os.getenv('AGENT0_TOOL_IMPORT_TIMEOUT', '30'))
+tool_import_max_bytes = int(os.getenv('AGENT0_TOOL_IMPORT_MAX_BYTES', str(8 * 1024 ** 3)))
+tool_verdict_ttl = 3600
+# validations per scan, more tools may be added while a batch is validated
+tool_validate_rounds = 3
+
+# wall-clock limit in seconds per case, None means no limit (a restarted agent runs until it exits)
+case_timeouts = dict(bash=600, python=600, python_tools=600, patch=60, restart=None)
+# patch blocks are applied in process ('python'), where a patch that does not apply or leaves python code that does
+# not parse is rejected before anything is written, or by GNU patch ('gnu') in a subprocess
+patch_backend = os.getenv('AGENT0_PATCH_BACKEND', 'python')
+# most leading and trailing context lines of a hunk that may fail to match, like GNU patch's fuzz factor
+patch_max_fuzz = int(os.getenv('AGENT0_PATCH_FUZZ', '2'))
+# full outputs of children are spilled here, and kept only if they were truncated
+logs_dir = 'logs'
+# seconds to wait for output of background children after the main child has exited
+capture_grace = 5
+# scripts and patches are stored once per content hash, with an index back to the iterations and cases that ran them;
+# stored objects and spilled logs unused for max age, or oldest beyond max bytes, are garbage collected
+artifacts_dir = 'artifacts'
+artifact_max_bytes = int(os.getenv('AGENT0_ARTIFACT_MAX_BYTES', str(256 * 1024 * 1024)))
+artifact_max_age = float(os.getenv('AGENT0_ARTIFACT_MAX_AGE', str(7 * 24 * 3600)))
+# files this recent may still be in use, e.g. a log being spilled to, so are never collected
+artifact_min_age = 60
+artifact_gc_every = 20
+# resource limits of children per case: cpu seconds, address space bytes and open files, None for no limit
+rlimit_address_space = int(os.getenv('AGENT0_RLIMIT_AS', '0')) or None
+case_rlimits = {case: dict(cpu=600, address_space=rlimit_address_space, open_files=4096)
+                for case in ['bash', 'python', 'python_tools']}
+case_rlimits['patch'] = dict(cpu=60, address_space=rlimit_address_space, open_files=4096)
+case_rlimits['tool_validate'] = dict(cpu=None, address_space=tool_import_max_bytes, open_files=4096)
+rlimit_resources = dict(cpu='RLIMIT_CPU', address_space='RLIMIT_AS', open_files='RLIMIT_NOFILE')
+# resource accounting of children, kept in the run log and metrics but not shown to the LLM
+usage_keys = ['wall_time', 'cpu_time', 'max_rss_mb']
+
+# opt-in memoization of repeated blocks, keyed on case, code and env_fingerprint, with LRU and TTL eviction
+result_cache_enabled = os.getenv('AGENT0_RESULT_CACHE', '0') == '1'
+# per case: 'readonly' caches only read-only bash probes, 'always' caches any block, None never caches
+result_cache_policy = dict(bash='readonly', python=None, python_tools=None, patch=None, restart=None)
+result_cache_size = 256
+result_cache_ttl = 600
+readonly_commands = {'ls', 'cat', 'head', 'tail', 'wc', 'pwd', 'whoami', 'id', 'uname', 'hostname', 'df', 'du',
+                     'free', 'nproc', 'lscpu', 'lsb_release', 'lsblk', 'lspci', 'which', 'whereis', 'type', 'echo',
+                     'printf', 'printenv', 'file', 'stat', 'find', 'grep', 'egrep', 'rg', 'sort', 'uniq', 'cut',
+                     'tr', 'realpath', 'readlink', 'basename', 'dirname', 'nvidia-smi', 'locate', 'tree', 'true'}
+readonly_subcommands = dict(pip={'list', 'show', 'freeze'}, pip3={'list', 'show', 'freeze'},
+                            git={'status', 'log', 'diff', 'show', 'branch', 'remote'},
+                            python={'--version', '-V'}, python3={'--version', '-V'}, conda={'list', 'info'})
+# commands and subcommands that only list when given no arguments, e.g. `git branch x` creates a branch
+readonly_bare_commands = {'hostname'}
+readonly_bare_subcommands = dict(git={'branch', 'remote'})
+# options that make otherwise read-only commands write files or run commands, short ones also inside -xyz clusters
+readonly_write_options = dict(find={'-delete', '-exec', '-execdir', '-ok', '-okdir', '-fprint', '-fprint0', '-fprintf',
+                                    '-fls'},
+                              sort={'-o', '--output'}, tree={'-o'}, git={'--output'})
+_result_cache = collections.OrderedDict()
+_result_cache_lock = threading.Lock()
+
+# pip install whatever python blocks import but is missing
+auto_pip_install = os.getenv('AGENT0_AUTO_PIP_INSTALL', '1') == '1'
+# imports in the body of a try with a handler for one of these are optional, so not installed
+import_error_names = {'ImportError', 'ModuleNotFoundError', 'Exception', 'BaseException'}
+# local wheel cache (pip --find-links) and whether to install only from it (pip --no-index)
+pip_find_links = os.getenv('AGENT0_WHEEL_DIR')
+pip_offline = os.getenv('AGENT0_PIP_OFFLINE', '0') == '1'
+pip_timeout = 900
+# negative cache of import names that failed to install, retried after pip_failed_ttl seconds
+pip_failed_name = '.pip_failed.json'
+pip_failed_ttl = 24 * 3600
+_pip_failed = {}
+_pip_lock = threading.Lock()
+# import names whose distribution has a different name
+import_to_distribution = {
+    'cv2': 'opencv-python', 'PIL': 'pillow', 'sklearn': 'scikit-learn', 'skimage': 'scikit-image',
+    'yaml': 'PyYAML', 'bs4': 'beautifulsoup4', 'Crypto': 'pycryptodome', 'dateutil': 'python-dateutil',
+    'dotenv': 'python-dotenv', 'docx': 'python-docx', 'pptx': 'python-pptx', 'fitz': 'PyMuPDF',
+    'magic': 'python-magic', 'serial': 'pyserial', 'usb': 'pyusb', 'git': 'GitPython', 'jwt': 'PyJWT',
+    'OpenSSL': 'pyOpenSSL', 'speech_recognition': 'SpeechRecognition', 'attr': 'attrs', 'zmq': 'pyzmq',
+    'Levenshtein': 'python-Levenshtein', 'mpl_toolkits': 'matplotlib', 'faiss': 'faiss-cpu',
+    'whisper': 'openai-whisper', 'wx': 'wxPython', 'gi': 'PyGObject', 'igraph': 'python-igraph',
+    'telegram': 'python-telegram-bot', 'socks': 'PySocks', 'pkg_resources': 'setuptools',
+}
+
+# cached directory listings and working tree index for process_stderr suggestions
+path_index_roots = ['.', 'python_tools']
+path_index_max_depth = 3
+path_index_skip = {'__pycache__', 'node_modules', 'site-packages', 'venv', 'dead', 'logs', 'runs', 'artifacts'}
+path_index_refresh = 2
+# directories with more entries than this are pre-filtered by trigrams before difflib
+trigram_min_entries = 1000
+dir_index_max_dirs = 10000
+_dir_index = {}
+_dir_index_lock = threading.Lock()
+_tree_dirs = {}
+
+# 'fork' runs python blocks in forks of a warm worker with warm_modules and tools pre-imported, else 'subprocess'
+python_backend = os.getenv('AGENT0_PYTHON_BACKEND', 'subprocess')
+# seconds to wait for the warm worker to import warm modules and tools, else blocks run as plain subprocesses
+warm_worker_start_timeout = float(os.getenv('AGENT0_WARM_WORKER_START_TIMEOUT', '60'))
+warm_modules = ['json', 're', 'subprocess', 'urllib.request', 'numpy', 'pandas', 'requests', 'PIL.Image']
+_warm_worker = {}
+_warm_worker_lock = threading.Lock()
+
+# append-only JSONL log of LLM calls and code blocks per run, rotated by size, optionally gzip compressed
+run_log_dir = 'runs'
+run_log_compress = os.getenv('AGENT0_RUN_LOG_COMPRESS', '0') == '1'
+run_log_max_bytes = int(os.getenv('AGENT0_RUN_LOG_MAX_BYTES', str(64 * 1024 * 1024)))
+_run_log_lock = threading.Lock()
+
+# stream chat completions, so code blocks run as soon as they are complete instead of after the whole response
+llm_stream = os.getenv('AGENT0_STREAM', '0') == '1'
+# ask the service to report usage at the end of a stream, else tokens are counted locally
+llm_stream_usage = os.getenv('AGENT0_STREAM_USAGE', '1') == '1'
+azure_api_version = os.getenv('AGENT0_AZURE_API_VERSION', '2023-12-01-preview')
+# Regex pattern to match code blocks with optional language identifiers
+code_block_pattern = re.compile(r"```(.*?)(\n[\s\S]*?)?```", re.DOTALL)
+_encodings = {}
+# memoized system prompt segments and the previous request, for prefix reuse stats
+_prompt_segments = {}
+# once the catalog has more tools than this, the system prompt only lists tool names,
+# and the top k tools for the latest turn (by BM25 over names, signatures and doc strings) are given in full after it
+tool_retrieval_min = int(os.getenv('AGENT0_TOOL_RETRIEVAL_MIN', '20'))
+tool_retrieval_k = int(os.getenv('AGENT0_TOOL_TOP_K', '8'))
+bm25_k1 = 1.5
+bm25_b = 0.75
+
+# read-only bash blocks from one response run concurrently on this many workers, as nothing can depend upon them;
+# every other block is a barrier, run alone once the blocks before it are done
+block_workers = int(os.getenv('AGENT0_BLOCK_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# LLM client backend: azure, record (azure, saving exchanges), replay (saved exchanges), local (OpenAI-compatible server)
+llm_backend = os.getenv('AGENT0_LLM_BACKEND', 'azure')
+llm_recording = os.getenv('AGENT0_LLM_RECORDING', 'llm_recording.jsonl')
+# seconds before the first token for replay and the stand-in server, or 'recorded' to replay recorded timing
+llm_latency = os.getenv('AGENT0_LLM_LATENCY', '0')
+llm_local_url = os.getenv('AGENT0_LLM_LOCAL_URL', 'http://127.0.0.1:8765/v1')
+# restart the patched agent code by reloading it in this process (keeping history and caches), or as a subprocess
+restart_mode = os.getenv('AGENT0_RESTART', 'reload')
+_restart = {}
+# after the first full review of the agent code, reviews only show what changed since the version the model saw:
+# 'diff' as a unified diff, 'functions' as the changed functions and classes, or 'full' to always send the whole file
+review_mode = os.getenv('AGENT0_REVIEW_MODE', 'diff')
+# changes larger than this fraction of the file are sent as a full review instead
+review_max_change = float(os.getenv('AGENT0_REVIEW_MAX_CHANGE', '0.5'))
+# agent code the model last saw in this run, and the review messages it is spread over
+_review = {}
+
+# supervised agents get disjoint AGENT0_ID ranges, so ids of their restarts (AGENT0_ID + 1) never collide
+supervisor_id_stride = 1000
+supervisor_max_restarts = int(os.getenv('AGENT0_SUPERVISOR_RESTARTS', '0'))
+# agents sharing a tool store take this lock to rename, quarantine or update the catalog
+tool_store_lock_name = '.tool_store.lock'
+
+# LLM requests time out, retry transient errors with jittered exponential backoff, and can be hedged:
+# a duplicate request is sent once the first is slower than the recent p95 latency, and the first response wins
+llm_timeout = float(os.getenv('AGENT0_LLM_TIMEOUT', '120'))
+llm_retries = int(os.getenv('AGENT0_LLM_RETRIES', '3'))
+llm_backoff = 1.0
+llm_backoff_max = 30.0
+llm_hedge = os.getenv('AGENT0_LLM_HEDGE', '0') == '1'
+llm_hedge_quantile = 0.95
+llm_hedge_min_samples = 20
+llm_pool_size = int(os.getenv('AGENT0_LLM_POOL_SIZE', '4'))
+
+# seconds spent per stage in the current iteration, for the per-iteration breakdown in the run log
+_iteration_timings = collections.Counter()
+
+# span timings and counters, written each iteration as a Prometheus text file or appended as JSON lines (or none)
+metrics_format = os.getenv('AGENT0_METRICS_FORMAT', 'prometheus')
+metrics_buckets = [0.01, 0.1, 1, 10, 60, 600]
+_metrics = dict(spans={}, counters=collections.Counter(), maxima={})
+_metrics_lock = threading.Lock()
 
 
 def get_client():
-    from openai import AzureOpenAI
-
     model = 'gpt-4o'
 
+    match llm_backend:
+        case 'replay':
+            # a hedged duplicate would consume the next recorded response
+            return get_resilient_client(get_replay_client(llm_recording, latency=llm_latency), hedge=False), model
+        case 'local':
+            from openai import OpenAI
+            client = OpenAI(base_url=llm_local_url, api_key=os.getenv('OPENAI_API_KEY', 'standin'),
+                            timeout=llm_timeout, max_retries=0, http_client=get_http_client())
+            return get_resilient_client(client), model
+
+    from openai import AzureOpenAI
+
     client_args = dict(azure_deployment=os.getenv('OPENAI_AZURE_DEPLOYMENT'),
                        azure_endpoint=os.getenv('OPENAI_BASE_URL'),
-                       api_version="2023-12-01-preview",
-                       api_key=os.getenv('OPENAI_API_KEY'))
-    client = AzureOpenAI(**client_args)
+                       api_version=azure_api_version,
+                       api_key=os.getenv('OPENAI_API_KEY'),
+                       # retries are done by get_resilient_client
+                       timeout=llm_timeout, max_retries=0, http_client=get_http_client())
+    client = get_resilient_client(AzureOpenAI(**client_args))
+    if llm_backend == 'record':
+        # only the winning response of hedged requests is recorded
+        client = get_recording_client(client, llm_recording)
     return client, model
 
 
+def get_stream_usage_supported():
+    """
+    Whether the backend accepts stream_options to report usage at the end of a stream.
+    Azure only does from API version 2024-09-01-preview, and rejects requests with it before.
+    """
+    if llm_backend in ['azure', 'record']:
+        return azure_api_version[:10] >= '2024-09-01'
+    return True
+
+
+def get_http_client():
+    # connections are kept alive and shared by concurrent (hedged) requests
+    import httpx
+
+    limits = httpx.Limits(max_connections=llm_pool_size, max_keepalive_connections=llm_pool_size)
+    return httpx.Client(limits=limits, timeout=llm_timeout)
+
+
+def is_transient_error(e):
+    # openai errors are recognized by name and status code, so openai need not be imported
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    if type(e).__name__ in ['APITimeoutError', 'APIConnectionError', 'RateLimitError', 'InternalServerError']:
+        return True
+    status = getattr(e, 'status_code', None) or 0
+    return status in [408, 409, 429] or status >= 500
+
+
+def get_resilient_client(client, timeout=None, retries=None, hedge=None):
+    """
+    Wrap client so chat completion requests time out, transient errors are retried with jittered exponential backoff,
+    and, if hedge, a duplicate request is sent once one is slower than the recent p95 latency, the first response wins.
+    Request latencies go to the llm_request span histogram.
+    """
+    import random
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    timeout = llm_timeout if timeout is None else timeout
+    retries = llm_retries if retries is None else retries
+    hedge = llm_hedge if hedge is None else hedge
+    executor = ThreadPoolExecutor(max_workers=2 * llm_pool_size, thread_name_prefix='llm')
+    latencies = collections.deque(maxlen=200)
+    # rebound by restore_checkpoint, so after an in-place restart metrics go to the new generation
+    hooks = dict(observe_span=observe_span, count_metric=count_metric)
+
+    def timed_create(kwargs):
+        start = time.time()
+        try:
+            response = client.chat.completions.create(**kwargs)
+        except Exception:
+            hooks['observe_span']('llm_request', time.time() - start, outcome='error')
+            raise
+        latency = time.time() - start
+        hooks['observe_span']('llm_request', latency, outcome='ok')
+        latencies.append(latency)
+        return response
+
+    def hedge_after():
+        if not hedge or len(latencies) < llm_hedge_min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(llm_hedge_quantile * len(ordered)))]
+
+    def discard(future):
+        # a losing request cannot be interrupted, so its stream is closed once it arrives
+        def close(future):
+            if future.exception() is None and hasattr(future.result(), 'close'):
+                future.result().close()
+        future.add_done_callback(close)
+
+    def attempt(kwargs):
+        deadline = time.time() + timeout
+        futures = [executor.submit(timed_create, kwargs)]
+        threshold = hedge_after()
+        if threshold is not None and not wait(futures, timeout=min(threshold, timeout)).done:
+            hooks['count_metric']('llm_hedged')
+            futures.append(executor.submit(timed_create, kwargs))
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+            if not done:
+                for future in pending:
+                    discard(future)
+                raise TimeoutError("LLM request timed out after %s seconds" % timeout)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        discard(other)
+                    if future is not futures[0]:
+                        hooks['count_metric']('llm_hedge_wins')
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def create(**kwargs):
+        for attempt_number in range(retries + 1):
+            try:
+                return attempt(kwargs)
+            except Exception as e:
+                if attempt_number >= retries or not is_transient_error(e):
+                    raise
+                delay = random.uniform(0, min(llm_backoff_max, llm_backoff * 2 ** attempt_number))
+                hooks['count_metric']('retries', case='llm')
+                print("LLM request failed (%s: %s), retrying in %.1fs" % (type(e).__name__, e, delay))
+                time.sleep(delay)
+
+    resilient = make_client(create)
+    resilient.latencies = latencies
+    resilient.hooks = hooks
+    return resilient
+
+
+def make_client(create):
+    # same shape as the openai client, as far as the agent uses it
+    return types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+
+
+def get_request_record(request):
+    messages = json.dumps(request.get('messages', []), sort_keys=True, default=str)
+    return dict(model=request.get('model'), max_tokens=request.get('max_tokens'), stream=bool(request.get('stream')),
+                messages=len(request.get('messages', [])),
+                messages_hash=hashlib.sha256(messages.encode()).hexdigest()[:16])
+
+
+def usage_to_dict(usage):
+    if not usage:
+        return None
+    return dict(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+                total_tokens=usage.total_tokens)
+
+
+def save_recording(filename, record):
+    with _run_log_lock:
+        with open(filename, 'at') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def get_recording_client(client, filename):
+    """
+    Wrap client so every chat completion exchange is appended to filename, for replay with get_replay_client.
+    """
+    def create(**kwargs):
+        start = time.time()
+        response = client.chat.completions.create(**kwargs)
+        record = dict(request=get_request_record(kwargs), latency=time.time() - start)
+        if not kwargs.get('stream'):
+            record.update(content=response.choices[0].message.content, usage=usage_to_dict(response.usage),
+                          duration=record['latency'])
+            save_recording(filename, record)
+            return response
+        return record_stream(response, record, filename, start)
+
+    recording = make_client(create)
+    recording.hooks = getattr(client, 'hooks', None)
+    return recording
+
+
+def record_stream(responses, record, filename, start):
+    deltas = []
+    usage = None
+    try:
+        for chunk in responses:
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                deltas.append(chunk.choices[0].delta.content)
+            yield chunk
+    finally:
+        record.update(content=''.join(deltas), deltas=deltas, usage=usage_to_dict(usage), duration=time.time() - start)
+        save_recording(filename, record)
+
+
+def load_recording(filename):
+    records = []
+    if os.path.isfile(filename):
+        with open(filename, 'rt') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    return dict(records=records, index=0, mismatches=0, lock=threading.Lock())
+
+
+def next_recorded(replay, request):
+    """
+    Next recorded exchange, in order so replay is deterministic, counting requests that differ from the recorded ones.
+    Once the recording is exhausted the agent is told to exit.
+    """
+    with replay['lock']:
+        index = replay['index']
+        replay['index'] += 1
+        if index >= len(replay['records']):
+            return dict(content='```exit\n```', usage=None, latency=0, duration=0)
+        record = replay['records'][index]
+        if record.get('request', {}).get('messages_hash') != get_request_record(request)['messages_hash']:
+            replay['mismatches'] += 1
+    return record
+
+
+def get_record_deltas(record, size=16):
+    content = record['content'] or ''
+    return record.get('deltas') or [content[i:i + size] for i in range(0, len(content), size)]
+
+
+def get_replay_delays(record, latency):
+    # seconds before the first delta and between deltas
+    if latency == 'recorded':
+        first = record.get('latency') or 0
+        return first, max(0, (record.get('duration') or first) - first) / max(1, len(get_record_deltas(record)))
+    return float(latency or 0), 0
+
+
+def get_replay_client(filename, latency='0'):
+    """
+    Client serving recorded chat completions in order, with simulated latency, so the loop runs without a service.
+    """
+    replay = load_recording(filename)
+
+    def create(**kwargs):
+        record = next_recorded(replay, kwargs)
+        first, between = get_replay_delays(record, latency)
+        time.sleep(first)
+        usage = types.SimpleNamespace(**record['usage']) if record.get('usage') else None
+        if not kwargs.get('stream'):
+            message = types.SimpleNamespace(role='assistant', content=record['content'])
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason='stop')],
+                                         usage=usage)
+        include_usage = (kwargs.get('stream_options') or {}).get('include_usage')
+        return replay_stream(record, between, usage if include_usage else None)
+
+    client = make_client(create)
+    client.replay = replay
+    return client
+
+
+def replay_stream(record, between, usage):
+    for delta in get_record_deltas(record):
+        time.sleep(between)
+        yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=delta))],
+                                    usage=None)
+    if usage:
+        yield types.SimpleNamespace(choices=[], usage=usage)
+
+
+def get_llm_standin(filename=None, port=8765, latency=None):
+    """
+    Local OpenAI-compatible chat completions server replaying a recording, with configurable latency.
+    E.g. python agent0.py --llm-standin llm_recording.jsonl 8765 0.5
+    then run the agent with AGENT0_LLM_BACKEND=local
+    """
+    import http.server
+
+    replay = load_recording(filename or llm_recording)
+    latency = llm_latency if latency is None else latency
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            record = next_recorded(replay, request)
+            first, between = get_replay_delays(record, latency)
+            time.sleep(first)
+            base = dict(id='chatcmpl-standin-%d' % replay['index'], created=int(time.time()),
+                        model=request.get('model'))
+            if not request.get('stream'):
+                message = dict(role='assistant', content=record['content'])
+                body = json.dumps(dict(base, object='chat.completion', usage=record.get('usage'),
+                                       choices=[dict(index=0, message=message, finish_reason='stop')])).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            chunk = dict(base, object='chat.completion.chunk')
+
+            def send(data):
+                self.wfile.write(b'data: ' + json.dumps(data).encode() + b'\n\n')
+                self.wfile.flush()
+            for delta in get_record_deltas(record):
+                time.sleep(between)
+                send(dict(chunk, choices=[dict(index=0, delta=dict(content=delta), finish_reason=None)]))
+            send(dict(chunk, choices=[dict(index=0, delta={}, finish_reason='stop')]))
+            if (request.get('stream_options') or {}).get('include_usage') and record.get('usage'):
+                send(dict(chunk, choices=[], usage=record['usage']))
+            self.wfile.write(b'data: [DONE]\n\n')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', int(port)), Handler)
+    server.replay = replay
+    return server
+
+
 def generate_random_module_name(length=8):
     """
     Generates a random module name that conforms to Python module file name requirements.
@@ -41,6 +544,9 @@ def generate_random_module_name(length=8):
     - Can include lowercase letters, digits, and underscores.
     - Length can be specified; default is 8 characters.
     """
+    import random
+    import string
+
     # First character must be a lowercase letter
     first_char = random.choice(string.ascii_lowercase)
 
@@ -50,19 +556,159 @@ def generate_random_module_name(length=8):
     return first_char + other_chars
 
 
-def run_code(text, case='unknown', iteration=-1, limit_output=10000, can_try_again=False):
+def observe_span(name, seconds, **labels):
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _metrics_lock:
+        stats = _metrics['spans'].setdefault(key, dict(count=0, sum=0.0, max=0.0,
+                                                       buckets=[0] * len(metrics_buckets)))
+        stats['count'] += 1
+        stats['sum'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        for i, bound in enumerate(metrics_buckets):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+
+
+def count_metric(name, value=1, **labels):
+    if value:
+        with _metrics_lock:
+            _metrics['counters'][(name, tuple(sorted((k, str(v)) for k, v in labels.items())))] += value
+
+
+def max_metric(name, value, **labels):
+    # highest value seen, e.g. peak memory of children per case, exported as a gauge
+    if value is not None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with _metrics_lock:
+            maxima = _metrics.setdefault('maxima', {})
+            maxima[key] = max(maxima.get(key, value), value)
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe_span(name, time.time() - start, **labels)
+
+
+def traced(name, label_args=()):
+    """
+    Decorator recording the duration of every call as a span, labelled by the values of the named arguments.
+    """
+    def decorator(func):
+        signature = []
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            labels = {}
+            if label_args:
+                # inspected on first call, not at import
+                if not signature:
+                    signature.append(inspect.signature(func))
+                bound = signature[0].bind(*args, **kwargs)
+                bound.apply_defaults()
+                labels = {k: bound.arguments[k] for k in label_args}
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_metrics_name():
+    ext = 'jsonl' if metrics_format == 'jsonl' else 'prom'
+    return os.path.join(run_log_dir, 'metrics_%s_%s.%s' % (myid, runid, ext))
+
+
+def format_prometheus_labels(labels):
+    labels = dict(agent_id=myid, run_id=runid, **dict(labels))
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return '{' + ','.join('%s="%s"' % (k, v) for k, v in escaped.items()) + '}'
+
+
+def format_prometheus():
+    lines = ['# TYPE agent0_span_seconds histogram']
+    with _metrics_lock:
+        spans = {k: dict(v, buckets=list(v['buckets'])) for k, v in _metrics['spans'].items()}
+        counters = dict(_metrics['counters'])
+        maxima = dict(_metrics.get('maxima', {}))
+    for (name, labels), stats in sorted(spans.items()):
+        labels = (('span', name),) + labels
+        for bound, value in zip(metrics_buckets, stats['buckets']):
+            lines.append('agent0_span_seconds_bucket%s %d' % (format_prometheus_labels(labels + (('le', bound),)), value))
+        lines.append('agent0_span_seconds_bucket%s %d' % (format_prometheus_labels(labels + (('le', '+Inf'),)),
+                                                         stats['count']))
+        lines.append('agent0_span_seconds_sum%s %.6f' % (format_prometheus_labels(labels), stats['sum']))
+        lines.append('agent0_span_seconds_count%s %d' % (format_prometheus_labels(labels), stats['count']))
+    for name in sorted({name for name, _ in counters}):
+        lines.append('# TYPE agent0_%s_total counter' % name)
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append('agent0_%s_total%s %s' % (name, format_prometheus_labels(labels), value))
+    for name in sorted({name for name, _ in maxima}):
+        lines.append('# TYPE agent0_%s gauge' % name)
+        for (gauge_name, labels), value in sorted(maxima.items()):
+            if gauge_name == name:
+                lines.append('agent0_%s%s %s' % (name, format_prometheus_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(iteration=-1):
+    """
+    Export span timings and counters so far: the Prometheus text file is replaced atomically,
+    JSON lines get one cumulative record per iteration so long runs and agent generations can be compared.
+    """
+    if metrics_format not in ['prometheus', 'jsonl']:
+        return
+    name = get_metrics_name()
+    os.makedirs(run_log_dir, exist_ok=True)
+    if metrics_format == 'jsonl':
+        with _metrics_lock:
+            spans = [dict(span=k[0], labels=dict(k[1]), count=v['count'], sum=v['sum'], max=v['max'])
+                     for k, v in _metrics['spans'].items()]
+            counters = [dict(name=k[0], labels=dict(k[1]), value=v) for k, v in _metrics['counters'].items()]
+            maxima = [dict(name=k[0], labels=dict(k[1]), value=v) for k, v in _metrics.get('maxima', {}).items()]
+        record = dict(time=time.time(), agent_id=myid, run_id=runid, iteration=iteration, spans=spans,
+                      counters=counters, maxima=maxima)
+        with open(name, 'at') as f:
+            f.write(json.dumps(record) + '\n')
+        return
+    atomic_write(name, format_prometheus())
+
+
+@traced('run_code', label_args=('case',))
+def run_code(text, case='unknown', iteration=-1, limit_output=10000, can_try_again=False, timeout=None):
     """
     Executes the given Python code in a separate Python interpreter subprocess.
     Returns the stdout and stderr outputs as separate strings.
     """
 
+    cache_key = get_result_cache_key(text, case) if result_cache_enabled else None
+    if cache_key:
+        cached = lookup_result_cache(cache_key)
+        if cached:
+            return dict(cached, iteration=iteration)
+    elif result_cache_enabled:
+        # any block not known to be read-only may change what cached ones would show, e.g. create a file ls lists
+        clear_result_cache()
+
     if case == 'patch':
-        os.makedirs('patches')
-        patch_name = os.path.join('patches', 'patchfile.diff' + str(uuid.uuid4()) + '.diff')
-        with open(patch_name, 'wt') as f:
-            f.write(text)
+        patch_name = store_artifact(text, case=case, iteration=iteration, ext='.diff')
+        if patch_backend == 'python':
+            ret = dict(iteration=iteration, case=case, **apply_patch(text))
+            count_metric('exits', case=case, status='error' if ret['exception'] else 'ok')
+            return ret
         text = "patch -u -p0 -F 1000 --batch < %s" % patch_name
 
+    if auto_pip_install and case in ['python', 'python_tools']:
+        # install everything the script imports but is missing in one go, instead of one failed run per module
+        missing = find_missing_imports(text)
+        if missing:
+            installed = pip_install(missing)
+            if installed['failed']:
+                print("pip could not install: %s" % installed['failed'])
+
     args = ''
     if case in ['python', 'python_tools']:
         ext = '.py'
@@ -71,64 +717,868 @@ def run_code(text, case='unknown', iteration=-1, limit_output=10000, can_try_aga
     elif case in ['bash', 'patch']:
         ext = '.sh'
         binary = 'bash'
+    elif case == 'restart':
+        ext = None
+        binary = sys.executable
     else:
         ext = None
         binary = None
 
-    if ext is None:
+    if case == 'restart':
+        cmd = get_agent_cmd(script=text)
+    elif ext is None:
         if args:
             cmd = [binary, args, text]
         else:
             cmd = [binary, text]
+    elif case == 'python_tools':
+        # tools live in python_tools under a random name until get_tool_imports names them
+        script_name = os.path.join(case, generate_random_module_name() + ext)
+        os.makedirs(case, exist_ok=True)
+        # agents sharing python_tools never see a partial tool
+        atomic_write(script_name, text)
+        cmd = [binary, script_name]
     else:
-        if case == 'python_tools':
-            case_dir = os.path.join(case)
-        else:
-            case_dir = os.path.join('scripts', case)
-        if case == 'bash':
-            script_name = os.path.join(case_dir, str(uuid.uuid4()) + ext)
-        else:
-            script_name = os.path.join(case_dir, generate_random_module_name() + ext)
-        os.makedirs(case_dir, exist_ok=True)
-        with open(script_name, 'wt') as f:
-            f.write(text)
+        script_name = store_artifact(text, case=case, iteration=iteration, ext=ext)
         cmd = [binary, script_name]
 
     # Open a subprocess and run the command
-    stdout = stderr = exception = None
-    import subprocess
-    try:
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        # Wait for the subprocess to finish and capture stdout and stderr
-        stdout, stderr = process.communicate()
-    except BaseException as e:
-        exception = str(e)
-
-    if stdout and len(stdout) > limit_output:
-        stdout = stdout[:limit_output]
-    if stderr and len(stderr) > limit_output:
-        stderr = stderr[:limit_output]
+    if timeout is None:
+        timeout = case_timeouts.get(case)
+    captured = None
+    if python_backend == 'fork' and case in ['python', 'python_tools']:
+        captured = run_warm(script_name, case=case, limit_output=limit_output, timeout=timeout)
+    if captured is None:
+        captured = run_process(cmd, case=case, limit_output=limit_output, timeout=timeout)
+    stdout, stderr, exception = captured.pop('stdout'), captured.pop('stderr'), captured.pop('exception')
+    if captured.get('cpu_time'):
+        count_metric('cpu_seconds', captured['cpu_time'], case=case)
+    if captured.get('wall_time'):
+        count_metric('wall_seconds', captured['wall_time'], case=case)
+    max_metric('max_rss_mb', captured.get('max_rss_mb'), case=case)
+    count_metric('exits', case=case, status='error' if captured.get('returncode') or exception else 'ok')
 
     stderr, try_again = process_stderr(stderr)
     if try_again and can_try_again:
         # FIXME: Could try a few times
+        count_metric('retries', case=case)
         ret = run_code(text, case=case, iteration=iteration, limit_output=limit_output, can_try_again=False)
-        stderr, try_again = process_stderr(ret['stderr'])
+        stdout, stderr, exception = ret.pop('stdout'), ret.pop('stderr'), ret.pop('exception')
+        captured = {k: v for k, v in ret.items() if k not in ['iteration', 'case']}
 
     # remove and report on bad modules that fail even at import level (missing imports etc.)
     # FIXME: Could pip install package here if global scope failure
     if case == 'python_tools':
-        import_lines, bad_modules = get_tool_imports()
+        import_lines, bad_modules = get_tool_imports(validate=True)
         if bad_modules:
+            import pprint
             if not stderr:
                 stderr = ""
             pretty_bad_modules = pprint.pformat(bad_modules, indent=4)
             stderr += pretty_bad_modules
 
-    return dict(iteration=iteration, case=case, stdout=stdout, stderr=stderr, exception=exception)
+    ret = dict(iteration=iteration, case=case, stdout=stdout, stderr=stderr, exception=exception, **captured)
+    if cache_key and not exception:
+        store_result_cache(cache_key, ret)
+    return ret
 
 
+def parse_patch(text):
+    """
+    Parse a unified diff into [dict(old=path, new=path, hunks=[dict(number, start, lines=[(tag, line)], no_newline)])].
+    Lenient with LLM written diffs: hunk line counts are not trusted, an empty line is blank context,
+    and a bare @@ header without line numbers matches anywhere.
+    """
+    header = re.compile(r'^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@')
+    lines = text.splitlines()
+    files = []
+    hunk = None
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith('--- ') and i + 1 < len(lines) and lines[i + 1].startswith('+++ '):
+            # paths end at a tab, before any timestamp
+            files.append(dict(old=line[4:].split('\t')[0].strip(), new=lines[i + 1][4:].split('\t')[0].strip(),
+                              hunks=[]))
+            hunk = None
+            i += 2
+            continue
+        if line.startswith('@@') and files:
+            match = header.match(line)
+            hunk = dict(number=len(files[-1]['hunks']) + 1, start=int(match.group(1)) if match else None, lines=[],
+                        no_newline=False)
+            files[-1]['hunks'].append(hunk)
+        elif hunk is not None and line.startswith('\\'):
+            # no newline at end of file, only matters after an added line
+            if hunk['lines'] and hunk['lines'][-1][0] == '+':
+                hunk['no_newline'] = True
+        elif hunk is not None and (not line or line[0] in ' -+'):
+            hunk['lines'].append((line[:1] or ' ', line[1:]))
+        else:
+            hunk = None
+        i += 1
+    return files
+
+
+def resolve_patch_path(path, root='.'):
+    # diffs may be -p0 or git style -p1 (a/ and b/ prefixes), whichever names an existing file
+    if path == '/dev/null':
+        return None
+    if not os.path.exists(os.path.join(root, path)) and path[:2] in ['a/', 'b/']:
+        if os.path.exists(os.path.join(root, path[2:])) or not os.path.isdir(os.path.join(root, path[:1])):
+            return path[2:]
+    return path
+
+
+def find_hunk(lines, old, start, normalize=False):
+    """
+    Index where the lines old appear in lines, nearest to start first, or None.
+    With normalize, whitespace differences are ignored.
+    """
+    if normalize:
+        lines = [' '.join(x.split()) for x in lines]
+        old = [' '.join(x.split()) for x in old]
+    if not old:
+        return min(max(start, 0), len(lines))
+    candidates = [i for i in range(len(lines) - len(old) + 1) if lines[i] == old[0] and lines[i:i + len(old)] == old]
+    return min(candidates, key=lambda i: abs(i - start)) if candidates else None
+
+
+def describe_failed_hunk(lines, old, start):
+    """
+    Where a hunk came closest to matching, with its first differing line, for the failed hunk report.
+    """
+    stripped = [x.strip() for x in lines]
+    wanted = [x.strip() for x in old]
+    best, best_i = -1, 0
+    for i in range(max(1, len(lines) - len(old) + 1)):
+        matches = sum(a == b for a, b in zip(stripped[i:i + len(old)], wanted))
+        if matches > best or (matches == best and abs(i - start) < abs(best_i - start)):
+            best, best_i = matches, i
+    if best <= 0:
+        return 'none of its %d lines are in the file' % len(old)
+    text = 'closest at line %d (%d of %d lines match)' % (best_i + 1, best, len(old))
+    for j, line in enumerate(old):
+        actual = lines[best_i + j] if best_i + j < len(lines) else None
+        if actual is None or actual.strip() != line.strip():
+            text += ', first difference at line %d: file has %r, hunk has %r' % (best_i + j + 1, actual, line)
+            break
+    return text
+
+
+def apply_hunks(content, hunks, max_fuzz=None):
+    """
+    Apply hunks to content, a hunk may match at an offset, ignoring whitespace, or with up to max_fuzz
+    leading and trailing context lines not matching.  Returns new content, report lines and failure lines.
+    """
+    max_fuzz = patch_max_fuzz if max_fuzz is None else max_fuzz
+    lines = content.splitlines()
+    newline = '\r\n' if '\r\n' in content else '\n'
+    ends_with_newline = content.endswith('\n') or not content
+    report, failed = [], []
+    # lines added less removed by earlier hunks, offset the last hunk was found at, and where it ended
+    delta, last_offset, end = 0, 0, 0
+    for hunk in hunks:
+        body = hunk['lines']
+        # a hunk is looked for first where the header says, moved by the earlier hunks like GNU patch
+        expected = hunk['start'] - 1 + delta + last_offset if hunk['start'] else end
+        found = None
+        for fuzz in range(max_fuzz + 1):
+            # fuzz drops up to this many context lines from both ends of the hunk
+            lead = 0
+            while lead < min(fuzz, len(body)) and body[lead][0] == ' ':
+                lead += 1
+            trail = 0
+            while trail < min(fuzz, len(body) - lead) and body[len(body) - 1 - trail][0] == ' ':
+                trail += 1
+            trimmed = body[lead:len(body) - trail]
+            old = [line for tag, line in trimmed if tag != '+']
+            if fuzz and not old:
+                # an addition with all its context dropped could go anywhere
+                break
+            for normalize in [False, True]:
+                index = find_hunk(lines, old, expected + lead, normalize=normalize)
+                if index is not None:
+                    found = (index, trimmed, old, fuzz, normalize, lead)
+                    break
+            if found or lead + trail < fuzz:
+                break
+        if found is None:
+            old = [line for tag, line in body if tag != '+']
+            new = [line for tag, line in body if tag != '-']
+            if old != new and find_hunk(lines, new, expected, normalize=True) is not None:
+                reason = 'looks already applied, its result is in the file'
+            else:
+                reason = describe_failed_hunk(lines, old, expected)
+            failed.append('Hunk #%d FAILED at %d: %s.' % (hunk['number'], expected + 1, reason))
+            continue
+        index, trimmed, old, fuzz, normalize, lead = found
+        # context keeps the file's own lines, only removed and added lines come from the hunk
+        replacement = []
+        j = index
+        for tag, line in trimmed:
+            if tag == '+':
+                replacement.append(line)
+                continue
+            if tag == ' ':
+                replacement.append(lines[j])
+            j += 1
+        lines[index:index + len(old)] = replacement
+        if hunk['no_newline'] and index + len(replacement) == len(lines):
+            ends_with_newline = False
+        offset = index - lead - (hunk['start'] - 1 + delta) if hunk['start'] else 0
+        last_offset = offset
+        delta += len(replacement) - len(old)
+        end = index + len(replacement)
+        notes = ['offset %d line%s' % (offset, '' if abs(offset) == 1 else 's')] if offset else []
+        notes += ['fuzz %d' % fuzz] if fuzz else []
+        notes += ['ignoring whitespace'] if normalize else []
+        if notes:
+            report.append('Hunk #%d succeeded at %d (%s).' % (hunk['number'], index - lead + 1, ', '.join(notes)))
+    content = newline.join(lines) + (newline if lines and ends_with_newline else '')
+    return content, report, failed
+
+
+def apply_patch(text, dry_run=False, root='.', max_fuzz=None):
+    """
+    Apply a unified diff in process: every file is patched in memory and python files are checked to still parse,
+    and only if all hunks of all files apply is anything written.  With dry_run nothing is written.
+    Returns dict(stdout, stderr, exception) like a patch subprocess would, with failed hunks reported precisely.
+    """
+    files = parse_patch(text)
+    if not files:
+        return dict(stdout='', stderr='No unified diff found, expected --- and +++ file headers then @@ hunks.',
+                    exception='Patch not applied')
+    stdout, stderr = [], []
+    results = []
+    # index in results by patched path, so later sections for the same file apply on top of earlier ones
+    patched = {}
+    for entry in files:
+        old_path, new_path = resolve_patch_path(entry['old'], root), resolve_patch_path(entry['new'], root)
+        path = new_path or old_path
+        filename = os.path.join(root, old_path or new_path)
+        stdout.append('%s file %s' % ('checking' if dry_run else 'patching', path))
+        earlier = patched.get(old_path) if old_path is not None else None
+        if earlier is not None:
+            content = results[earlier][2]
+            old_path = results[earlier][0]
+        elif old_path is None:
+            if os.path.exists(filename):
+                stderr.append("%s: is a new file in the patch, but already exists" % new_path)
+                continue
+            content = ''
+        elif not os.path.isfile(filename):
+            stderr.append("%s: no such file, hunks were not applied" % old_path)
+            continue
+        else:
+            # newline='' keeps the file's line endings
+            with open(filename, 'rt', newline='') as f:
+                content = f.read()
+        new_content, report, failed = apply_hunks(content, entry['hunks'], max_fuzz=max_fuzz)
+        stdout.extend(report)
+        stderr.extend('%s: %s' % (path, x) for x in failed)
+        if failed:
+            continue
+        if new_path is not None and new_path.endswith('.py'):
+            try:
+                ast.parse(new_content, filename=new_path)
+            except SyntaxError as e:
+                # the offending line from the patched text, not the file on disk
+                patched_lines = new_content.splitlines()
+                line = patched_lines[e.lineno - 1].strip() if e.lineno and e.lineno <= len(patched_lines) else ''
+                stderr.append('%s: would not parse after the patch, line %s: %s\n    %s' % (new_path, e.lineno, e.msg,
+                                                                                          line))
+                continue
+        if earlier is not None:
+            results[earlier] = None
+        patched[new_path] = len(results)
+        results.append((old_path, new_path, new_content))
+    results = [x for x in results if x is not None]
+    if stderr:
+        return dict(stdout='\n'.join(stdout), stderr='\n'.join(stderr),
+                    exception='Patch not applied, no files were changed')
+    for old_path, new_path, new_content in results if not dry_run else []:
+        if new_path is None:
+            os.remove(os.path.join(root, old_path))
+            continue
+        filename = os.path.join(root, new_path)
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        mode = os.stat(os.path.join(root, old_path)).st_mode if old_path is not None else None
+        atomic_write(filename, new_content, newline='', mode=mode)
+        if old_path is not None and old_path != new_path:
+            os.remove(os.path.join(root, old_path))
+    return dict(stdout='\n'.join(stdout), stderr=None, exception=None)
+
+
+def atomic_write(name, text, newline=None, mode=None):
+    """
+    Write text to name through a temporary file moved into place, so readers never see a partial file.
+    """
+    tmp_name = name + '.' + str(uuid.uuid4()) + '.tmp'
+    with open(tmp_name, 'wt', newline=newline) as f:
+        f.write(text)
+    if mode is not None:
+        os.chmod(tmp_name, mode)
+    os.replace(tmp_name, name)
+
+
+def store_artifact(text, case='unknown', iteration=-1, ext=''):
+    """
+    Store text once under its content hash, in a two level fan-out so directories stay small, and index where it ran.
+    Returns the path of the stored object.
+    """
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    object_dir = os.path.join(artifacts_dir, 'objects', digest[:2])
+    name = os.path.join(object_dir, digest + ext)
+    if os.path.isfile(name):
+        # reused, so it is kept longer by garbage collection
+        os.utime(name)
+    else:
+        os.makedirs(object_dir, exist_ok=True)
+        atomic_write(name, text)
+    record = dict(hash=digest, ext=ext, case=case, iteration=iteration, agent_id=myid, run_id=runid, time=time.time())
+    # the index is shared by all agents using artifacts_dir, so appends must not interleave with gc_artifacts
+    with tool_store_lock(artifacts_dir):
+        with open(os.path.join(artifacts_dir, 'index.jsonl'), 'at') as f:
+            f.write(json.dumps(record) + '\n')
+    return name
+
+
+def find_artifacts(digest=None, case=None, iteration=None, run_id=None):
+    """
+    Records of where stored artifacts ran, optionally only for one hash, case, iteration or run id.
+    E.g. find_artifacts(run_id=runid, iteration=3) gives hashes of the scripts of iteration 3 of this run.
+    """
+    index_name = os.path.join(artifacts_dir, 'index.jsonl')
+    if not os.path.isfile(index_name):
+        return []
+    with open(index_name, 'rt') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [x for x in records
+            if (digest is None or x['hash'] == digest) and (case is None or x['case'] == case) and
+            (iteration is None or x['iteration'] == iteration) and (run_id is None or x['run_id'] == run_id)]
+
+
+def gc_files(directory, max_bytes=None, max_age=None):
+    """
+    Remove files under directory not modified for max_age seconds, then the oldest until at most max_bytes remain.
+    Returns the removed paths.
+    """
+    now = time.time()
+    files = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            name = os.path.join(root, filename)
+            try:
+                stat = os.stat(name)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+    files.sort()
+    total = sum(x[1] for x in files)
+    removed = []
+    for mtime, size, name in files:
+        if now - mtime < artifact_min_age:
+            break
+        if not (max_age is not None and now - mtime > max_age) and not (max_bytes is not None and total > max_bytes):
+            break
+        try:
+            os.remove(name)
+        except OSError:
+            continue
+        total -= size
+        removed.append(name)
+    return removed
+
+
+def gc_artifacts(max_bytes=None, max_age=None):
+    """
+    Garbage collect stored artifacts and spilled output logs by age and size, dropping index records of removed objects.
+    """
+    max_bytes = artifact_max_bytes if max_bytes is None else max_bytes
+    max_age = artifact_max_age if max_age is None else max_age
+    removed = gc_files(os.path.join(artifacts_dir, 'objects'), max_bytes=max_bytes, max_age=max_age)
+    removed += gc_files(logs_dir, max_bytes=max_bytes, max_age=max_age)
+    index_name = os.path.join(artifacts_dir, 'index.jsonl')
+    if removed and os.path.isfile(index_name):
+        gone = {os.path.basename(x) for x in removed}
+        with tool_store_lock(artifacts_dir):
+            with open(index_name, 'rt') as f:
+                lines = [line for line in f if line.strip() and
+                         '%(hash)s%(ext)s' % json.loads(line) not in gone]
+            atomic_write(index_name, ''.join(lines))
+    return removed
+
+
+def is_readonly_bash(code):
+    """
+    Conservatively decide if a bash block only runs read-only probes, like ls, cat, uname or pip list.
+    """
+    if re.search(r'`|\$\(|<\(|>\(', code):
+        return False
+    # output redirection other than to /dev/null or between streams writes files
+    if re.search(r'>(?!\s*/dev/null|&[12])', code.replace('2>&1', '').replace('>&2', '')):
+        return False
+    for command in re.split(r'\n|;|&&|\|\||\|', code):
+        words = command.strip().split()
+        if not words or words[0].startswith('#'):
+            continue
+        name = os.path.basename(words[0])
+        if name in readonly_subcommands:
+            if len(words) < 2 or words[1] not in readonly_subcommands[name]:
+                return False
+            if words[1] in readonly_bare_subcommands.get(name, ()) and len(words) > 2:
+                return False
+        elif name not in readonly_commands or (name in readonly_bare_commands and len(words) > 1):
+            return False
+        for option in readonly_write_options.get(name, ()):
+            for word in words[1:]:
+                if word == option or word.startswith(option + '='):
+                    return False
+                if len(option) == 2 and re.match(r'-[a-zA-Z]*%s' % option[1], word):
+                    return False
+        if name == 'uniq' and len([x for x in words[1:] if not x.startswith('-')]) > 1:
+            # uniq input output writes output
+            return False
+    return True
+
+
+def env_fingerprint(path='python_tools'):
+    # results depend upon where blocks run and on which tools exist
+    modules = load_tool_catalog(path)['modules'] if os.path.isdir(path) else {}
+    catalog_version = sorted((k, v['hash']) for k, v in modules.items())
+    return hashlib.sha256(json.dumps([os.getcwd(), catalog_version]).encode()).hexdigest()
+
+
+def get_result_cache_key(code, case):
+    """
+    Cache key for a block, or None if the per-case policy in result_cache_policy says not to cache it.
+    """
+    policy = result_cache_policy.get(case)
+    if policy is None or (policy == 'readonly' and not (case == 'bash' and is_readonly_bash(code))):
+        return None
+    return hashlib.sha256(json.dumps([case, code, env_fingerprint()]).encode()).hexdigest()
+
+
+def lookup_result_cache(key):
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None:
+            return None
+        age = time.time() - entry['time']
+        if age > result_cache_ttl:
+            _result_cache.pop(key)
+            return None
+        _result_cache.move_to_end(key)
+        return dict(entry['result'], cached='Reused result of identical block run %.0f seconds ago' % age)
+
+
+def clear_result_cache():
+    with _result_cache_lock:
+        _result_cache.clear()
+
+
+def store_result_cache(key, result):
+    with _result_cache_lock:
+        _result_cache[key] = dict(time=time.time(), result=result)
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > result_cache_size:
+            # least recently used first
+            _result_cache.popitem(last=False)
+
+
+def capture_stream(fd, log_name, limit_output, result):
+    """
+    Read a child's output from fd until EOF, spilling all of it to log_name but keeping only a bounded
+    head and tail in memory, so arbitrarily large outputs use constant memory.
+    """
+    head_size = limit_output // 2
+    tail_size = limit_output - head_size
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    head = tail = ''
+    total = 0
+    with open(log_name, 'wt') as log:
+        while True:
+            data = os.read(fd, 65536)
+            text = decoder.decode(data, final=not data)
+            if text:
+                log.write(text)
+                total += len(text)
+                if len(head) < head_size:
+                    text, head = text[head_size - len(head):], head + text[:head_size - len(head)]
+                if text and tail_size:
+                    tail = (tail + text)[-tail_size:]
+            if not data:
+                break
+    os.close(fd)
+    result.update(text=head + tail, truncated=total - len(head) - len(tail))
+    if result['truncated']:
+        result['text'] = head + '\n...[%s characters truncated, full output in %s]...\n' % (result['truncated'], log_name) + tail
+
+
+def start_capture(fds, case='unknown', limit_output=10000):
+    """
+    Start capture_stream readers for the stdout and stderr file descriptors of a child.
+    """
+    log_dir = os.path.join(logs_dir, case)
+    os.makedirs(log_dir, exist_ok=True)
+    log_base = os.path.join(log_dir, str(uuid.uuid4()))
+    capture = dict(log_base=log_base, results=dict(stdout={}, stderr={}), readers=[])
+    for name, fd in zip(['stdout', 'stderr'], fds):
+        reader = threading.Thread(target=capture_stream, daemon=True,
+                                  args=(fd, '%s.%s.log' % (log_base, name), limit_output, capture['results'][name]))
+        reader.start()
+        capture['readers'].append(reader)
+    return capture
+
+
+def finish_capture(capture, ret, pgid=None):
+    """
+    Wait for capture readers and fill ret with the captured stdout and stderr.
+    If pgid is given, a process group still holding the pipes open after capture_grace seconds is killed.
+    """
+    for reader in capture['readers']:
+        # background children may still hold the pipes open after the main child exits
+        reader.join(capture_grace)
+        if reader.is_alive() and pgid is not None:
+            kill_process_group(pgid)
+            reader.join(capture_grace)
+
+    for name in ['stdout', 'stderr']:
+        result = capture['results'][name]
+        log_name = '%s.%s.log' % (capture['log_base'], name)
+        if not result:
+            ret[name] = 'Output not captured, see %s' % log_name
+            continue
+        ret[name] = result['text']
+        if result['truncated']:
+            ret['%s_truncated' % name] = result['truncated']
+            count_metric('truncations', kind=name)
+            ret['%s_log' % name] = log_name
+        else:
+            # nothing was dropped, so the spilled copy is not needed, unless gc_artifacts got to it first
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(log_name)
+    return ret
+
+
+def run_process(cmd, case='unknown', limit_output=10000, timeout=None, **popen_kwargs):
+    """
+    Run cmd and stream its stdout and stderr through capture_stream.
+    If timeout seconds pass, the whole process group is killed.
+    Returns dict of stdout, stderr, exception and, for any truncated stream, how much was dropped and the full log.
+    """
+    import subprocess
+
+    ret = dict(stdout=None, stderr=None, exception=None)
+    try:
+        # own process group so a timeout also kills anything the child started
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=timeout is not None, **popen_kwargs)
+    except BaseException as e:
+        ret['exception'] = str(e)
+        return ret
+
+    start = time.time()
+    set_rlimits(case_rlimits.get(case), pid=process.pid)
+    fds = [os.dup(process.stdout.fileno()), os.dup(process.stderr.fileno())]
+    process.stdout.close()
+    process.stderr.close()
+    capture = start_capture(fds, case=case, limit_output=limit_output)
+
+    waited = {}
+    waiter = threading.Thread(target=wait_rusage, args=(process, waited), daemon=True)
+    waiter.start()
+    try:
+        waiter.join(timeout)
+        if waiter.is_alive():
+            kill_process_group(process.pid)
+            waiter.join()
+            ret['exception'] = 'Timeout: killed process group after %s seconds' % timeout
+    except BaseException as e:
+        if timeout is not None:
+            kill_process_group(process.pid)
+        waiter.join()
+        ret['exception'] = str(e)
+    ret.update(get_usage(waited.get('rusage'), time.time() - start, process.returncode, case, ret['exception']))
+    return finish_capture(capture, ret, pgid=process.pid if timeout is not None else None)
+
+
+def wait_rusage(process, result):
+    # like Popen.wait, but wait4 also gives the resource usage of the child and any children it waited for
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        result['rusage'] = rusage
+    except ChildProcessError:
+        process.wait()
+
+
+def get_usage(rusage, wall_time, returncode, case='unknown', exception=None):
+    """
+    Resource accounting for a finished child: wall and cpu seconds, peak RSS in MB and exit status,
+    with an exception if it was killed by a signal, e.g. for going over its cpu limit.
+    """
+    usage = dict(wall_time=round(wall_time, 3), returncode=returncode)
+    if rusage is not None:
+        # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+        max_rss = rusage.ru_maxrss / 1024 if sys.platform != 'darwin' else rusage.ru_maxrss / 1024 ** 2
+        usage.update(cpu_time=round(rusage.ru_utime + rusage.ru_stime, 3), max_rss_mb=round(max_rss, 1))
+    if returncode is not None and returncode < 0 and not exception:
+        name = signal.Signals(-returncode).name if -returncode in signal.valid_signals() else str(-returncode)
+        usage['exception'] = 'Killed by %s' % name
+        if name == 'SIGXCPU':
+            usage['exception'] += ', over cpu limit of %s seconds' % (case_rlimits.get(case) or {}).get('cpu')
+    return usage
+
+
+def set_rlimits(limits, pid=0):
+    """
+    Apply limits, like those in case_rlimits, to process pid or to this process if pid is 0.  Limits are only lowered.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    for name, value in (limits or {}).items():
+        if value is None:
+            continue
+        resource_id = getattr(resource, rlimit_resources[name])
+        soft, hard = resource.getrlimit(resource_id)
+        value = int(value) if soft == resource.RLIM_INFINITY else min(int(value), soft)
+        if name == 'cpu' and hard == resource.RLIM_INFINITY:
+            # SIGXCPU at the soft limit, SIGKILL a little later if that is ignored
+            hard = value + 5
+        try:
+            if pid:
+                resource.prlimit(pid, resource_id, (value, hard))
+            else:
+                resource.setrlimit(resource_id, (value, hard))
+        except (ValueError, OSError, AttributeError):
+            # e.g. child already exited, or no prlimit on this platform
+            pass
+
+
+def run_warm(script_name, case='python', limit_output=10000, timeout=None):
+    """
+    Run a python script in a fresh fork of the warm worker, with the same capture and timeout handling as run_process.
+    Returns None if no warm worker is available, so the caller can fall back to a subprocess.
+    """
+    import socket
+
+    socket_path = get_warm_worker()
+    if socket_path is None:
+        return None
+
+    ret = dict(stdout=None, stderr=None, exception=None)
+    out_read, out_write = os.pipe()
+    err_read, err_write = os.pipe()
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        request = dict(script=script_name, rlimits=case_rlimits.get(case), cwd=os.getcwd(), env=dict(os.environ))
+        socket.send_fds(conn, [json.dumps(request).encode()], [out_write, err_write])
+    except OSError as e:
+        conn.close()
+        for fd in [out_read, out_write, err_read, err_write]:
+            os.close(fd)
+        print("warm worker unavailable, using subprocess: %s" % e)
+        return None
+    os.close(out_write)
+    os.close(err_write)
+    capture = start_capture([out_read, err_read], case=case, limit_output=limit_output)
+
+    # the worker reports the pid of the forked block, then its exit code and resource usage
+    start = time.time()
+    reader = conn.makefile('rb')
+    pid = None
+    try:
+        pid = json.loads(reader.readline())['pid']
+        conn.settimeout(timeout)
+        status = reader.readline()
+        if status:
+            ret.update(json.loads(status), wall_time=round(time.time() - start, 3))
+        else:
+            ret['exception'] = 'Warm worker block exited without status'
+    except (socket.timeout, TimeoutError):
+        kill_process_group(pid)
+        ret['exception'] = 'Timeout: killed process group after %s seconds' % timeout
+    except (OSError, ValueError, KeyError) as e:
+        if pid is not None:
+            kill_process_group(pid)
+        ret['exception'] = str(e)
+    finally:
+        reader.close()
+        conn.close()
+    return finish_capture(capture, ret, pgid=pid)
+
+
+def tool_catalog_signature(path='python_tools'):
+    catalog = load_tool_catalog(path)
+    return sorted((k, v['hash']) for k, v in catalog['modules'].items() if v.get('validated'))
+
+
+def get_warm_worker(path='python_tools'):
+    """
+    Return socket path of the warm worker, (re)starting it if it is not running or python_tools changed since it started.
+    """
+    import select
+    import socket
+    import subprocess
+    import tempfile
+
+    if not (hasattr(os, 'fork') and hasattr(socket, 'send_fds')):
+        return None
+
+    with _warm_worker_lock:
+        signature = tool_catalog_signature(path) if os.path.isdir(path) else []
+        if _warm_worker.get('failed') == signature:
+            # not tried again until the tools change
+            return None
+        process = _warm_worker.get('process')
+        if process is not None and (process.poll() is not None or _warm_worker['signature'] != signature):
+            # recycle, so forked blocks see the current tools
+            stop_warm_worker()
+            process = None
+        if process is None:
+            socket_path = os.path.join(tempfile.gettempdir(), 'agent0_%s_%s.sock' % (myid, uuid.uuid4().hex[:8]))
+            process = subprocess.Popen(get_agent_cmd('--warm-worker', socket_path, path),
+                                       stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+            # a warm module or tool hanging at import must not hang the agent
+            readable, _, _ = select.select([process.stdout], [], [], warm_worker_start_timeout)
+            ready = process.stdout.readline() if readable else b''
+            process.stdout.close()
+            if ready.strip() != b'ready':
+                print("warm worker %s, using subprocess" %
+                      ('failed to start' if readable else 'not ready after %ss' % warm_worker_start_timeout))
+                process.kill()
+                process.wait()
+                _warm_worker['failed'] = signature
+                return None
+            _warm_worker.pop('failed', None)
+            _warm_worker.update(process=process, socket=socket_path, signature=signature)
+        return _warm_worker['socket']
+
+
+def stop_warm_worker():
+    process = _warm_worker.pop('process', None)
+    if process is not None:
+        process.kill()
+        process.wait()
+    socket_path = _warm_worker.pop('socket', None)
+    if socket_path and os.path.exists(socket_path):
+        os.remove(socket_path)
+
+
+def warm_worker_main(socket_path, path='python_tools'):
+    """
+    Warm worker: pre-import common modules and validated tools once, then fork a fresh child per python block.
+    """
+    import runpy
+    import socket
+    import traceback
+
+    for name in warm_modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+    if os.path.isdir(path):
+        sys.path.insert(0, os.getcwd())
+        for filename, _ in tool_catalog_signature(path):
+            try:
+                importlib.import_module('%s.%s' % (path, filename[:-3]))
+            except BaseException as e:
+                print("warm worker could not import %s: %s" % (filename, e), file=sys.stderr)
+        sys.path.pop(0)
+
+    # forked blocks are reaped automatically, their exit code is reported by the block itself
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(64)
+    server.settimeout(1.0)
+    parent = os.getppid()
+    print('ready', flush=True)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 1)
+
+    while os.getppid() == parent:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        conn.settimeout(None)
+        msg, fds, _, _ = socket.recv_fds(conn, 1 << 20, 2)
+        request = json.loads(msg)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            continue
+
+        # forked block, behave like `python script` run in a fresh interpreter
+        server.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.setsid()
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in fds:
+            os.close(fd)
+        conn.sendall(json.dumps(dict(pid=os.getpid())).encode() + b'\n')
+        script = request['script']
+        returncode = 0
+        try:
+            set_rlimits(request.get('rlimits'))
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            sys.argv = [script]
+            sys.path[0] = os.path.dirname(os.path.abspath(script))
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except BaseException as e:
+            # hide runpy frames, so the traceback looks like the script ran directly
+            tb = e.__traceback__
+            while tb is not None and tb.tb_frame.f_code.co_filename != script:
+                tb = tb.tb_next
+            traceback.print_exception(type(e), e, tb or e.__traceback__)
+            returncode = 1
+        try:
+            import atexit
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            import resource
+            rusage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            status = get_usage(rusage, 0, returncode)
+            status.pop('wall_time')
+            status['cpu_time'] = round(status['cpu_time'] + children.ru_utime + children.ru_stime, 3)
+            conn.sendall(json.dumps(status).encode() + b'\n')
+        finally:
+            os._exit(returncode)
+
+    server.close()
+    os.remove(socket_path)
+
+
+def kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+@traced('process_stderr')
 def process_stderr(stderr):
     try_again = False
     if not stderr:
@@ -161,176 +1611,1092 @@ def process_stderr(stderr):
             missing_filename = missing_module
         missing_dir = os.path.dirname(missing_filename)
         missing_filename = os.path.basename(missing_filename)
+        suffix = '.py' if tag == mnf_tag else None
+        # a bare file name is looked for in the working directory, only among files that are close enough,
+        # e.g. not the agent's own artifacts directory
+        bare = tag == fnf_tag and not missing_dir
+        if bare:
+            missing_dir = os.curdir
         if os.path.isdir(missing_dir):
-            all_files = os.listdir(missing_dir)
-            if tag == mnf_tag:
-                all_files = [x for x in all_files if x.endswith('.py')]
-
-            closest_matches = difflib.get_close_matches(missing_filename, all_files, n=1, cutoff=0.1)
-            if closest_matches:
-                suggestion = os.path.join(missing_dir, closest_matches[0])
+            closest_match = find_close_match(missing_filename, missing_dir, suffix=suffix, files_only=bare,
+                                             cutoff=0.6 if bare else 0.1)
+            if closest_match:
+                suggestion = os.path.join(missing_dir, closest_match)
                 if tag == mnf_tag:
                     suggestion = suggestion.replace('.py', '').replace(os.pardir + os.sep, '..').replace(os.sep, '.')
                 lines_new.append(f"    Did you mean instead: '{suggestion}'?")
         elif missing_dir.strip():
             lines_new.append("    Directory %s does not exist" % missing_dir)
-        elif tag == mnf_tag:
+            # near-miss directory, and then the closest file within it
+            suggested_dir = suggest_dir(missing_dir)
+            if suggested_dir:
+                closest_match = find_close_match(missing_filename, suggested_dir, suffix=suffix)
+                if closest_match:
+                    suggestion = os.path.join(suggested_dir, closest_match)
+                    if tag == mnf_tag:
+                        suggestion = suggestion.replace('.py', '').replace(os.pardir + os.sep, '..').replace(os.sep, '.')
+                    lines_new.append(f"    Did you mean instead: '{suggestion}'?")
+                else:
+                    lines_new.append(f"    Did you mean directory: '{suggested_dir}'?")
+        elif tag == mnf_tag and auto_pip_install:
             # then may be global module, let's help the LLM and pip install it
-            text = 'pip install %s' % missing_module
-            ret = run_code(text, case='bash', iteration=-1, limit_output=100)
-            if 'Successfully installed' in ret['stdout']:
-                for lines_success in ret['stdout'].split('\n'):
-                    if 'Successfully installed' in lines_success and missing_module in lines_success:
-                        lines_new = "%s was pip installed" % missing_module
-                        try_again = True
+            installed = pip_install([missing_module])
+            if missing_module in installed['installed']:
+                lines_new.append("%s was pip installed" % missing_module)
+                try_again = True
+            elif missing_module in installed['failed']:
+                lines_new.append("    %s could not be pip installed as %s: %s" % (
+                    missing_module, get_distribution_name(missing_module), installed['failed'][missing_module]))
 
     return '\n'.join(lines_new), try_again
 
 
+def find_imports(source):
+    """
+    Top-level names of all absolute imports in python source, wherever they are in the code,
+    except optional ones in the body of a try whose handler catches ImportError.
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return set()
+    names = set()
+    todo = [tree]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, ast.Import):
+            names.update(x.name.split('.')[0] for x in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+        if isinstance(node, ast.Try) and any(catches_import_error(x) for x in node.handlers):
+            todo.extend(node.handlers + node.orelse + node.finalbody)
+        else:
+            todo.extend(ast.iter_child_nodes(node))
+    return names
+
+
+def catches_import_error(handler):
+    # bare except, or an exception class ImportError derives from, alone or in a tuple
+    types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+    return any(x is None or isinstance(x, ast.Name) and x.id in import_error_names for x in types)
+
+
+def find_missing_imports(source):
+    """
+    Imports of python source that are neither standard library, local modules nor installed.
+    """
+    import importlib.util
+
+    missing = set()
+    for name in find_imports(source):
+        if name in sys.stdlib_module_names or name in sys.builtin_module_names:
+            continue
+        if os.path.exists(name + '.py') or os.path.isdir(name):
+            continue
+        try:
+            if importlib.util.find_spec(name) is not None:
+                continue
+        except (ImportError, ValueError):
+            continue
+        missing.add(name)
+    return sorted(missing)
+
+
+def get_distribution_name(import_name):
+    return import_to_distribution.get(import_name, import_name)
+
+
+def read_pip_failed():
+    try:
+        with open(pip_failed_name, 'rt') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_pip_failed():
+    if not _pip_failed:
+        _pip_failed.update(read_pip_failed())
+    return _pip_failed
+
+
+@traced('pip_install')
+def pip_install(import_names):
+    """
+    Install distributions for import names in a single pip call, from pip_find_links and without the index if pip_offline.
+    Names that failed to install before are skipped, using a negative cache kept in pip_failed_name.
+    Returns dict with installed import names and failed import names with their error.
+    """
+    ret = dict(installed=[], failed={})
+    with _pip_lock:
+        pip_failed = load_pip_failed()
+        todo = []
+        for name in import_names:
+            if name in pip_failed and time.time() - pip_failed[name]['time'] < pip_failed_ttl:
+                ret['failed'][name] = pip_failed[name]['error']
+            else:
+                todo.append(name)
+        if not todo:
+            return ret
+
+        options = ['--disable-pip-version-check']
+        if pip_find_links:
+            options += ['--find-links', pip_find_links]
+        if pip_offline:
+            options += ['--no-index']
+        # one batched call, and only if that fails, one call per distribution to find which ones fail
+        batches = [todo] if len(todo) == 1 else [todo] + [[x] for x in todo]
+        for batch in batches:
+            batch = [x for x in batch if x not in ret['installed'] and x not in ret['failed']]
+            if not batch:
+                continue
+            cmd = [sys.executable, '-m', 'pip', 'install'] + options + [get_distribution_name(x) for x in batch]
+            out = run_process(cmd, case='pip', limit_output=2000, timeout=pip_timeout)
+            # pip's messages vary, e.g. lowercase error: for an externally managed environment, its exit status does not
+            if out.get('returncode') == 0 and not out['exception']:
+                ret['installed'].extend(batch)
+                if len(batch) == len(todo):
+                    break
+            elif len(batch) == 1:
+                error = (out['exception'] or (out['stderr'] or '').strip().split('\n')[-1] or
+                         'pip exited with status %s' % out.get('returncode'))[:200]
+                ret['failed'][batch[0]] = error
+                pip_failed[batch[0]] = dict(error=error, time=time.time())
+            elif out['exception'] and out['exception'].startswith('Timeout'):
+                break
+
+        changed = [x for x in todo if x in pip_failed]
+        for name in ret['installed']:
+            pip_failed.pop(name, None)
+        if changed:
+            # the file is shared by agents in the same directory, so only the names tried here are updated in it
+            with file_lock(pip_failed_name + '.lock'):
+                shared = read_pip_failed()
+                for name in changed:
+                    if name in pip_failed:
+                        shared[name] = pip_failed[name]
+                    else:
+                        shared.pop(name, None)
+                atomic_write(pip_failed_name, json.dumps(shared, indent=1))
+            pip_failed.update(shared)
+    if ret['installed']:
+        importlib.invalidate_caches()
+    return ret
+
+
+def get_dir_index(directory):
+    """
+    Cached listing of directory, only listed again when its mtime changes.
+    Returns dict with names, subdirectory names, and lazily built trigram and stem indexes, or None if not a directory.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+    key = os.path.abspath(directory)
+    entry = _dir_index.get(key)
+    if entry is not None and entry['mtime'] == mtime:
+        return entry
+    names = []
+    dirs = set()
+    try:
+        with os.scandir(directory) as it:
+            for x in it:
+                names.append(x.name)
+                try:
+                    if x.is_dir():
+                        dirs.add(x.name)
+                except OSError:
+                    pass
+    except OSError:
+        return None
+    entry = dict(mtime=mtime, names=names, dirs=dirs, trigrams=None, stems=None, matches={})
+    with _dir_index_lock:
+        if len(_dir_index) > dir_index_max_dirs:
+            _dir_index.clear()
+        _dir_index[key] = entry
+    return entry
+
+
+def get_trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_candidates(name, entry, max_candidates=100, max_ranked=10):
+    """
+    Names in a large directory that are likely close to name, from its rarest shared trigrams and same-stem names.
+    """
+    if entry['trigrams'] is None:
+        trigrams = collections.defaultdict(list)
+        stems = collections.defaultdict(list)
+        for x in entry['names']:
+            for trigram in get_trigrams(x):
+                trigrams[trigram].append(x)
+            stems[os.path.splitext(x)[0].lower()].append(x)
+        entry['trigrams'], entry['stems'] = trigrams, stems
+    candidates = dict.fromkeys(entry['stems'].get(os.path.splitext(name)[0].lower(), []))
+    query = get_trigrams(name)
+    for trigram in sorted((x for x in query if x in entry['trigrams']), key=lambda x: len(entry['trigrams'][x])):
+        if len(candidates) >= max_candidates:
+            break
+        candidates.update(dict.fromkeys(entry['trigrams'][trigram][:max_candidates]))
+    # most shared trigrams first, difflib then picks among only these
+    return sorted(candidates, key=lambda x: -len(query & get_trigrams(x)))[:max_ranked]
+
+
+def find_close_match(name, directory, suffix=None, dirs_only=False, files_only=False, cutoff=0.1):
+    """
+    Closest name in directory to name, like difflib.get_close_matches(n=1, cutoff=cutoff) over its listing,
+    but with the listing cached and large directories pre-filtered by trigrams.
+    With files_only, directories and entries in path_index_skip are never suggested.
+    """
+    import difflib
+
+    entry = get_dir_index(directory)
+    if entry is None:
+        return None
+    key = (name, suffix, dirs_only, files_only, cutoff)
+    if key in entry['matches']:
+        return entry['matches'][key]
+    names = entry['names']
+    if len(names) > trigram_min_entries:
+        names = get_candidates(name, entry)
+    if dirs_only:
+        names = [x for x in names if x in entry['dirs']]
+    if files_only:
+        names = [x for x in names if x not in entry['dirs'] and x not in path_index_skip]
+    if suffix:
+        names = [x for x in names if x.endswith(suffix)]
+    closest_matches = difflib.get_close_matches(name, names, n=1, cutoff=cutoff)
+    entry['matches'][key] = closest_matches[0] if closest_matches else None
+    return entry['matches'][key]
+
+
+def get_tree_dirs():
+    """
+    Directories under path_index_roots (to path_index_max_depth) keyed by basename, refreshed at most every
+    path_index_refresh seconds, and only re-listing directories whose mtime changed.
+    """
+    cwd = os.getcwd()
+    if _tree_dirs and _tree_dirs['cwd'] == cwd and time.time() - _tree_dirs['time'] < path_index_refresh:
+        return _tree_dirs['dirs']
+    dirs = collections.defaultdict(list)
+    todo = [(os.path.normpath(x), 0) for x in path_index_roots if os.path.isdir(x)]
+    while todo:
+        directory, depth = todo.pop()
+        entry = get_dir_index(directory)
+        if entry is None or depth >= path_index_max_depth:
+            continue
+        for x in entry['dirs']:
+            if x.startswith('.') or x in path_index_skip:
+                continue
+            path = os.path.normpath(os.path.join(directory, x))
+            dirs[x].append(path)
+            todo.append((path, depth + 1))
+    _tree_dirs.update(cwd=cwd, time=time.time(), dirs=dirs)
+    return dirs
+
+
+def suggest_dir(missing_dir):
+    """
+    Suggest an existing directory for a missing one: same-named directory in the working tree,
+    else closest subdirectories below the deepest existing parent, else closest-named directory in the tree.
+    """
+    import difflib
+
+    tree_dirs = get_tree_dirs()
+    basename = os.path.basename(os.path.normpath(missing_dir))
+    if tree_dirs.get(basename):
+        return min(tree_dirs[basename], key=len)
+
+    parent = os.path.normpath(missing_dir)
+    missing_parts = []
+    while parent and not os.path.isdir(parent) and os.path.dirname(parent) != parent:
+        parent, part = os.path.split(parent)
+        missing_parts.insert(0, part)
+    if os.path.isdir(parent or os.curdir):
+        suggestion = parent
+        for part in missing_parts:
+            closest_match = find_close_match(part, suggestion or os.curdir, dirs_only=True)
+            if not closest_match or difflib.SequenceMatcher(None, part, closest_match).ratio() < 0.6:
+                suggestion = None
+                break
+            suggestion = os.path.join(suggestion, closest_match)
+        if suggestion:
+            return suggestion
+
+    closest_matches = difflib.get_close_matches(basename, list(tree_dirs), n=1, cutoff=0.6)
+    if closest_matches:
+        return min(tree_dirs[closest_matches[0]], key=len)
+    return None
+
+
 # id of this running instance, children have higher numbers
 myid = int(os.getenv('AGENT0_ID', '0'))
-runid = str(uuid.uuid4())
+runid = os.getenv('AGENT0_RUN_ID') or str(uuid.uuid4())
 
 
-def run_code_blocks(code_blocks, system_prompt0='', iteration=-1):
+@functools.lru_cache(maxsize=None)
+def get_actions():
     prefix = 'Code block should have first 3 backticks followed by the word: '
     limit = '  Try to ensure any outputs of the code are limited to no more than 1000 characters or about 20 items in a list, to avoid overflow of context for the LLM.  Or have any output go to a file, then extract the required information from the file.  Or simply take one example (e.g. single image) from list, do not make code or scripts dump out entire directory listings or other large lists.    If you do not have file names or paths necessary to run the tool, first run bash script to find it.  Any bash or python code should absolutely not contain placeholders and should not just be examples, because they will be run as-is on the user computer.  If files are required, look for them on the user computer using bash or python code blocks first, then use those results to generate the real python or bash code to run without modification by user.'
     debug = ' If debugging is required, add print statements to python code or bash code.'
     actions = {
         'user': f'{prefix}user .  Code block should contain text that would be used as user message.  You should write this in the perspective of the user who is talking to an LLM.  Do not put code diff patches here.',
-        'review': f'{prefix}review .  This triggers user to respond with full {__file__} code.  If the chat history does not appear to contain the full code, please trigger a review.',
+        'review': f'{prefix}review .  This triggers user to respond with full {__file__} code, or only its changes if the full code is still in the chat history.  If the chat history does not appear to contain the full code, please trigger a review.',
         'bash': f'{prefix}bash .  Triggers bash system command executation tool, where your code block should contain new bash script (e.g. fathering system or environment (e.g. python) information or other useful actions) to run.  Code will be run in a fork, you do not need to run another fork unless necessary for the task.  This can be used to list files on disk to find images, audio, pdfs, etc. for testing tools.  This can also be used for echo of a python tool to see its code for debugging usage.  Do not put code diff patches here. {limit} {debug}',
         'python': f'{prefix}python . Triggers python executation tool using code block, where your code block should contain new python code to run.  It can use tools or test tools created by running python_tools action.  You can use prints to check success of the code, since outputs will be returned to you.  This code block will be run as-is in a fork and response given back to you, so you do not need to run another fork. {limit} {debug} Ensure to include all required imports.',
         'python_tools': f'{prefix}python_tools . Triggers code block extraction to create a tool, where your code block should contain python code written as a reusable tool, e.g a useful class or function, without test code in global scope.  It should be well-documented with a doc string for each class and function.  Ensure the first line of the doc string gives the most relevant short description.  Ensure the doc string includes single line example of how to use it.  No global test code should be included and the code should be reusable as-is without changes.  The class or function can accept inputs and return outputs that should generally be easily consumed by other python tools, so do not rely upon prints for tools except to debug it. {limit}',
-        'patch': f'{prefix}patch . Triggers python code patch appling tool using code block, where your code block should contain the unified diff patch (applied with `patch -p1 --fuzzy < patchfile.diff` by agent code.  The diff should show lines to be added (prefixed with +) and lines to be removed (prefixed with -) from the original {__file__} file for the agent code.  You can also patch python tools.',
+        'patch': f'{prefix}patch . Triggers python code patch appling tool using code block, where your code block should contain the unified diff patch (applied by agent code, allowing for shifted lines and a little fuzz in context lines, and rejected as a whole with the failed hunks reported if any hunk does not apply or a patched python file would not parse).  The diff should show lines to be added (prefixed with +) and lines to be removed (prefixed with -) from the original {__file__} file for the agent code.  You can also patch python tools.',
         'restart': f'{prefix}restart .  Trigger restart, which launches a new fork to run the full (possibly edited via patches) {__file__} code.',
         'exit': f'{prefix}exit .  Triggers exit, which makes user agent code return out of current fork of running {__file__} code.',
     }
-    pretty_actions = pprint.pformat(actions, indent=4)
+    return actions
+
+
+@functools.lru_cache(maxsize=None)
+def get_finish():
+    import pprint
+    pretty_actions = pprint.pformat(get_actions(), indent=4)
+    finish = (f"  Always finish your responses by choosing one or more of the actions:"
+              f" {pretty_actions},"
+              f" by including a Markdown code block for each case and appending the case name to the starting backticks as if it were the language.  "
+              f"If you just reviewed the code, do not repeat your review until other actions have been performed.  "
+              f"Note that this code block is interpreted by the agent code and will be run,"
+              f" so choose reasonable actions and code blocks with meaningful exploration"
+              f" (e.g. see what you can do in bash, python, etc.).")
+    return finish
+
+
+def get_tools_prompt(path='python_tools'):
+    start = time.time()
+    import_lines, bad_modules = get_tool_imports(path)
+    _iteration_timings['catalog'] += time.time() - start
+    if bad_modules:
+        print("Outside got bad modules: %s" % bad_modules)
+    # joined text is reused as long as the catalog gives the same import lines
+    key = (path, tuple(import_lines), tool_retrieval_min)
+    if _prompt_segments.get('tools_key') != key:
+        _prompt_segments['tools_key'] = key
+        if len(import_lines) <= tool_retrieval_min:
+            _prompt_segments['tools'] = '\n\nExisting python tools can be imported as follows, with the doc string given before the import:\n\n' + '\n\n'.join(import_lines)
+        else:
+            names = collections.defaultdict(list)
+            for doc in get_tool_docs(path):
+                names[doc['module']].append(doc['name'])
+            _prompt_segments['tools'] = f'\n\nExisting python tools, listed as module: names, can be imported as `from {path}.<module> import <name>`.  Those most relevant to the latest user message are described there in full.\n\n' + \
+                '\n'.join('%s: %s' % (module, ', '.join(x)) for module, x in names.items())
+    return _prompt_segments['tools']
+
+
+def get_tool_docs(path='python_tools'):
+    # one document per class or function in the catalog, along with its import line and stubbed doc string
+    modules = load_tool_catalog(path)['modules'] if os.path.isdir(path) else {}
+    return [dict(module=filename[:-3], name=info['name'], import_line=import_line)
+            for filename in sorted(modules)
+            for info, import_line in zip(modules[filename]['objects'], modules[filename]['import_lines'])]
+
+
+def tokenize(text):
+    # identifiers are split on underscores and case changes, so GetPDFText matches "get pdf text"
+    return [x.lower() for x in re.findall(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+', text) if len(x) > 1]
+
+
+def get_tool_index(docs):
+    # BM25 term statistics, rebuilt only when the catalog changes
+    key = tuple(x['import_line'] for x in docs)
+    if _prompt_segments.get('tool_index_key') != key:
+        terms = [collections.Counter(tokenize(x['import_line'])) for x in docs]
+        df = collections.Counter()
+        for x in terms:
+            df.update(x.keys())
+        lengths = [sum(x.values()) for x in terms]
+        _prompt_segments['tool_index_key'] = key
+        _prompt_segments['tool_index'] = dict(terms=terms, df=df, lengths=lengths,
+                                              avgdl=sum(lengths) / max(1, len(lengths)))
+    return _prompt_segments['tool_index']
+
+
+def rank_tools(query, docs, k=None):
+    """
+    Top k of docs for query by BM25 score, best first, leaving out docs that share no terms with the query.
+    """
+    import math
+
+    k = tool_retrieval_k if k is None else k
+    index = get_tool_index(docs)
+    n = len(docs)
+    idf = {term: math.log(1 + (n - index['df'][term] + 0.5) / (index['df'][term] + 0.5))
+           for term in set(tokenize(query)) if term in index['df']}
+    scores = []
+    for i, terms in enumerate(index['terms']):
+        norm = bm25_k1 * (1 - bm25_b + bm25_b * index['lengths'][i] / index['avgdl'])
+        score = sum(weight * terms[term] * (bm25_k1 + 1) / (terms[term] + norm)
+                    for term, weight in idf.items() if term in terms)
+        if score > 0:
+            scores.append((score, i))
+    scores.sort(key=lambda x: (-x[0], x[1]))
+    return [docs[i] for _, i in scores[:k]]
+
+
+def get_tool_context(query, path='python_tools', model='gpt-4o'):
+    """
+    Full descriptions of the tools most relevant to query, to go after the stable system prompt,
+    if the catalog is large enough that the system prompt only lists tool names.
+    Returns the text (or None) and stats on catalog size, tools shown in full and prompt tokens saved.
+    """
+    docs = get_tool_docs(path)
+    stats = dict(catalog=len(docs), shown=len(docs), saved_tokens=0)
+    if len(docs) <= tool_retrieval_min:
+        return None, stats
+    top = rank_tools(query or '', docs)
+    text = None
+    if top:
+        text = 'Python tools relevant to this turn, with the doc string given before the import:\n\n' + \
+            '\n\n'.join(x['import_line'] for x in top)
+    full_tokens = count_tokens('\n\n'.join(x['import_line'] for x in docs), model=model)
+    # the name list was built along with the system prompt of this iteration
+    sent_tokens = count_tokens(_prompt_segments.get('tools', ''), model=model) + count_tokens(text, model=model)
+    stats.update(shown=len(top), saved_tokens=full_tokens - sent_tokens)
+    return text, stats
+
+
+def build_system_prompt(system_prompt0=''):
+    """
+    System prompt from memoized segments in a fixed order: base prompt, actions, then tool catalog.
+    It only changes when the tools change, so providers can reuse the cached prompt prefix across iterations.
+    """
+    return system_prompt0 + get_finish() + get_tools_prompt()
 
-    system_prompt = system_prompt0
+
+def get_guidance(outputs, iteration=-1):
+    """
+    Per-iteration guidance given the last output, to go at the end of the prompt after the stable prefix.
+    """
+    match outputs[-1]['case'] if outputs else None:
+        case 'review':
+            if iteration == 0:
+                return """In this iteration, given the code, come up with a plan."""
+            else:
+                return """In this iteration, your primary task is to review the code for potential improvements given the history of feedback from the user (which is just automated agent code you are effectively running)."""
+        case 'python':
+            return "If the python code successfully ran, run the `python_tools` case to generate a reusable tool.  If the python code was not successful, revise as required until it works as expected."
+        case 'patch':
+            return """You have edited the agent code, if you plan to restart with this code, do not forget to have a code block with code tag 'restart' (no quotes)."""
+    return None
+
+
+def measure_prompt_prefix(request_messages):
+    """
+    Measure how many leading bytes of this request are identical to the previous request,
+    i.e. the prefix a provider-side prompt cache can reuse.
+    """
+    text = ''.join('%s\n%s\n' % (x['role'], x['content']) for x in request_messages).encode()
+    previous = _prompt_segments.get('previous_request', b'')
+    # binary search on slice equality, which is done in C
+    lo, hi = 0, min(len(text), len(previous))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if text[:mid] == previous[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    _prompt_segments['previous_request'] = text
+    return dict(reused_bytes=lo, total_bytes=len(text))
+
+
+def run_code_blocks(code_blocks, system_prompt0='', iteration=-1):
+    actions = get_actions()
+
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    # read-only bash blocks run concurrently between barrier blocks, outputs keep the original block order
     outputs = []
-    for code_dict in code_blocks:
-        lang = code_dict['language']
-        code = code_dict['code']
-        finish = (f"  Always finish your responses by choosing one or more of the actions:"
-                  f" {pretty_actions},"
-                  f" by including a Markdown code block for each case and appending the case name to the starting backticks as if it were the language.  "
-                  f"If you just reviewed the code, do not repeat your review until other actions have been performed.  "
-                  f"Note that this code block is interpreted by the agent code and will be run,"
-                  f" so choose reasonable actions and code blocks with meaningful exploration"
-                  f" (e.g. see what you can do in bash, python, etc.).")
-
-        import_lines, bad_modules = get_tool_imports()
-        if bad_modules:
-            print("Outside got bad modules: %s" % bad_modules)
-
-        finish += '\n\nExisting python tools can be imported as follows, with the doc string given before the import:\n\n' + '\n\n'.join(import_lines)
-        system_prompt = system_prompt0 + finish
-
-        match lang:
-            case 'user':
-                # Message to make user say, to act as request to assistant
-                output1 = dict(iteration=iteration, case='user', stdout=code, stderr=None, exception=None)
-                outputs.append(output1)
-            case 'review':
-                with open(__file__, 'rt') as f:
-                    outputs.append(dict(iteration=iteration, case='review',
-                                        stdout=f"The agent code {__file__} the user is having you run.\n```python\n" + f.read() + "```",
-                                        stderr=None))
-                if iteration == 0:
-                    system_prompt += """In this iteration, given the code, come up with a plan.""" + finish
-                else:
-                    system_prompt += """In this iteration, your primary task is to review the code for potential improvements given the history of feedback from the user (which is just automated agent code you are effectively running).""" + finish
-            case 'bash':
-                # run bash command
-                outputs.append(run_code(code, case='bash', iteration=iteration, limit_output=1000))
-                system_prompt = system_prompt0 + finish
-            case 'python':
-                # run python code
-                outputs.append(run_code(code, case='python', iteration=iteration, limit_output=1000, can_try_again=True))
-                system_prompt = system_prompt0 + finish + "\n\nIf the python code successfully ran, run the `python_tools` case to generate a reusable tool.  If the python code was not successful, revise as required until it works as expected."
-            case 'python_tools':
-                # run python code
-                outputs.append(run_code(code, case='python_tools', iteration=iteration, limit_output=1000, can_try_again=True))
-                system_prompt = system_prompt0 + finish
-            case 'patch':
-                # to allow recursion
-                outputs.append(run_code(code, case='patch', iteration=iteration, limit_output=1000))
-                system_prompt += """You have edited the agent code, if you plan to restart with this code, do not forget to have a code block with code tag 'restart' (no quotes).""" + finish
-            case 'restart':
-                # restart updated code (recursion)
-                os.environ['AGENT0_ID'] = str(myid + 1)
-                outputs.append(run_code(__file__, iteration=iteration, case='restart'))
-                system_prompt += finish
-            case 'exit':
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(1, block_workers)) as executor:
+        for code_dict in code_blocks:
+            lang = code_dict['language']
+            code = code_dict['code']
+            if lang not in actions:
+                continue
+            # e.g. a python block reading a file a bash block before it writes has to wait for it
+            concurrent = block_workers > 1 and lang == 'bash' and is_readonly_bash(code)
+            if not concurrent and pending:
+                wait(pending)
+                pending = []
+            if lang == 'exit':
                 # exit (undo recursion)
-                return outputs
-            # agent can add new actions by editing this file and then restarting this file
-    return outputs, system_prompt
+                outputs.append(dict(iteration=iteration, case='exit', stdout=None, stderr=None, exception=None))
+                break
+            if concurrent:
+                future = executor.submit(run_code_block, lang, code, iteration)
+                pending.append(future)
+            else:
+                future = run_code_block(lang, code, iteration)
+            outputs.append(future)
+    outputs = [x.result() if hasattr(x, 'result') else x for x in outputs]
+
+    return outputs, build_system_prompt(system_prompt0)
+
+
+def get_changed_functions(previous, source):
+    """
+    Source of the top-level functions, classes and other statements of source that are new or differ from previous,
+    and the names of removed functions and classes.  None if either does not parse.
+    """
+    def segments(text):
+        lines = text.splitlines(True)
+        ret = {}
+        for node in ast.parse(text).body:
+            start = min([node.lineno] + [x.lineno for x in getattr(node, 'decorator_list', [])])
+            segment = ''.join(lines[start - 1:node.end_lineno])
+            named = isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+            ret[node.name if named else segment] = segment
+        return ret
+
+    try:
+        old, new = segments(previous), segments(source)
+    except (SyntaxError, ValueError):
+        return None
+    changed = [segment for key, segment in new.items() if old.get(key) != segment]
+    # removed statements other than functions and classes are named by their first line
+    removed = [key.splitlines()[0] for key in old if key not in new]
+    if removed:
+        changed.append(''.join('# removed: %s\n' % x for x in removed))
+    return '\n\n'.join(changed)
+
+
+def get_review(filename=None):
+    """
+    Agent code for a review: the whole file, or once the model has seen it, only the changes since the version
+    it last saw, as a unified diff or the changed functions depending on review_mode.
+    update_review tracks the message the review goes into, and forgets what the model saw once it leaves the prompt.
+    """
+    import difflib
+
+    filename = filename or __file__
+    with open(filename, 'rt') as f:
+        source = f.read()
+    previous = _review.get('source') if _review.get('filename') == filename else None
+    changes = None
+    if previous is not None and review_mode in ['diff', 'functions']:
+        if review_mode == 'functions':
+            changes = get_changed_functions(previous, source)
+        else:
+            changes = ''.join(difflib.unified_diff(previous.splitlines(True), source.splitlines(True),
+                                                   fromfile=filename, tofile=filename))
+        if changes is not None and len(changes) > review_max_change * len(source):
+            changes = None
+    full = changes is None or _review.get('pending') == 'full'
+    _review.update(filename=filename, source=source, pending='full' if full else 'changes')
+    count_metric('reviews', kind='full' if changes is None else review_mode)
+
+    if changes is None:
+        return f"The agent code {filename} the user is having you run.\n```python\n" + source + "```"
+    if not changes:
+        return f"The agent code {filename} is unchanged since the last review."
+    if review_mode == 'functions':
+        return f"Functions of the agent code {filename} changed since the last review.\n```python\n" + changes + "```"
+    return f"Changes to the agent code {filename} since the last review.\n```diff\n" + changes + "```"
+
+
+def update_review(message, request_messages):
+    """
+    Track message if it holds a review, then forget the agent code the model saw if any review message since the last
+    full one is no longer sent as is (dropped or elided), as changes only make sense on top of all of them.
+    """
+    pending = _review.pop('pending', None)
+    if pending == 'full':
+        _review['messages'] = [message]
+    elif pending:
+        _review.setdefault('messages', []).append(message)
+    sent = {id(x) for x in request_messages}
+    if any(id(x) not in sent for x in _review.get('messages', [])):
+        _review.clear()
+
+
+def run_code_block(lang, code, iteration=-1):
+    match lang:
+        case 'user':
+            # Message to make user say, to act as request to assistant
+            return dict(iteration=iteration, case='user', stdout=code, stderr=None, exception=None)
+        case 'review':
+            return dict(iteration=iteration, case='review', stdout=get_review(), stderr=None)
+        case 'bash':
+            # run bash command
+            return run_code(code, case='bash', iteration=iteration, limit_output=1000)
+        case 'python':
+            # run python code
+            return run_code(code, case='python', iteration=iteration, limit_output=1000, can_try_again=True)
+        case 'python_tools':
+            # run python code
+            return run_code(code, case='python_tools', iteration=iteration, limit_output=1000, can_try_again=True)
+        case 'patch':
+            # to allow recursion
+            return run_code(code, case='patch', iteration=iteration, limit_output=1000)
+        case 'restart':
+            # restart updated code in place, run_generation hands its state over to the new module via main_loop
+            if restart_mode == 'reload':
+                module, error = load_agent_module()
+                if module is not None:
+                    _restart['module'] = module
+                    stdout = "Reloaded %s in place as agent %s, history is kept." % (__file__, module.myid)
+                    return dict(iteration=iteration, case='restart', stdout=stdout, stderr=None, exception=None)
+                print("Reload failed, restarting as a subprocess:\n%s" % error)
+            # restart updated code as a child process (recursion)
+            os.environ['AGENT0_ID'] = str(myid + 1)
+            os.environ.pop('AGENT0_RUN_ID', None)
+            return run_code(__file__, iteration=iteration, case='restart')
+        # agent can add new actions by editing this file and then restarting this file
+
+
+def load_agent_module(agent_id=None):
+    """
+    Import the (possibly patched) agent code afresh as the next agent generation.
+    Returns the module and None, or None and the error if the new code fails to import.
+    """
+    import importlib.util
+    import traceback
+
+    agent_id = myid + 1 if agent_id is None else agent_id
+    os.environ['AGENT0_ID'] = str(agent_id)
+    os.environ.pop('AGENT0_RUN_ID', None)
+    try:
+        spec = importlib.util.spec_from_file_location('agent0_%s' % agent_id, __file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if 'checkpoint' not in inspect.signature(module.run_generation).parameters:
+            raise TypeError("run_generation of the new code does not take a checkpoint")
+    except Exception:
+        return None, traceback.format_exc()
+    return module, None
+
+
+def restore_checkpoint(checkpoint):
+    # caches carry over only if the new code keeps their format
+    if checkpoint.get('tool_catalog_version') == tool_catalog_version:
+        _tool_catalogs.update(checkpoint.get('tool_catalogs') or {})
+    if checkpoint.get('path_index_max_depth') == path_index_max_depth:
+        _dir_index.update(checkpoint.get('dir_index') or {})
+    # the history is kept, so later reviews can still be only the changes
+    _review.update(checkpoint.get('review') or {})
+    # the client is kept, but its metrics go to this generation's, which are the ones written
+    hooks = getattr(checkpoint.get('client'), 'hooks', None)
+    if hooks is not None:
+        hooks.update(observe_span=observe_span, count_metric=count_metric)
 
 
 def invalidate_caches(path):
-    importlib.invalidate_caches()
+    """
+    Forget the cached directory listings of path and its subdirectories, so new tool modules there are
+    found by the next import.  Finders for the rest of sys.path keep their caches.
+    """
+    path = os.path.abspath(path)
+    for k in list(sys.path_importer_cache):
+        if k and (os.path.abspath(k) == path or os.path.abspath(k).startswith(path + os.sep)):
+            sys.path_importer_cache.pop(k, None)
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_tool_catalog(path):
+    """
+    Load the on-disk tool catalog for path, reusing the in-memory copy if the file has not changed.
+    The catalog maps each tool module file name to its mtime, size, content hash and formatted import lines.
+    """
+    catalog_file = os.path.join(path, tool_catalog_name)
+    try:
+        catalog_mtime = os.stat(catalog_file).st_mtime_ns
+    except OSError:
+        catalog_mtime = None
+    cached = _tool_catalogs.get(path)
+    if cached and cached[0] == catalog_mtime:
+        return cached[1]
+
+    catalog = None
+    if catalog_mtime is not None:
+        try:
+            with open(catalog_file, 'rt') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            catalog = None
+    # stubs depend upon num_doc_lines, so any change in format invalidates the whole catalog
+    if not catalog or catalog.get('version') != tool_catalog_version or catalog.get('num_doc_lines') != num_doc_lines:
+        catalog = dict(version=tool_catalog_version, num_doc_lines=num_doc_lines, modules={})
+    _tool_catalogs[path] = (catalog_mtime, catalog)
+    return catalog
+
+
+def save_tool_catalog(path, catalog):
+    catalog_file = os.path.join(path, tool_catalog_name)
+    atomic_write(catalog_file, json.dumps(catalog, indent=1))
+    _tool_catalogs[path] = (os.stat(catalog_file).st_mtime_ns, catalog)
+
+
+def quarantine_tool(bad_file, error):
+    print("bad module: %s hits this error and has been deleted:\n%s" % (bad_file, error))
+    dead_path = os.path.join(os.path.dirname(bad_file), 'dead')
+    os.makedirs(dead_path, exist_ok=True)
+    # earlier bad versions of the same module are kept, under a unique name
+    dead_file = os.path.join(dead_path, os.path.basename(bad_file))
+    if os.path.exists(dead_file):
+        dead_file = '%s.%s.py' % (dead_file[:-3], uuid.uuid4().hex[:8])
+    try:
+        os.replace(bad_file, dead_file)
+    except FileNotFoundError:
+        # already gone
+        return
+    with open(dead_file[:-3] + '.error.txt', 'wt') as f:
+        f.write(error)
+
+
+def validate_tools(path, module_names):
+    """
+    Import each tool module in its own subprocess, in parallel, killed after tool_import_timeout seconds
+    and limited to tool_import_max_bytes of memory, so a slow or broken tool never blocks or breaks the agent.
+    Returns dict of module name to None if it imports, else the error.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def validate(module_name):
+        cmd = [sys.executable, '-c', 'import importlib, sys; importlib.import_module(sys.argv[1])',
+               '%s.%s' % (path, module_name)]
+        ret = run_process(cmd, case='tool_validate', limit_output=2000, timeout=tool_import_timeout)
+        if ret['exception']:
+            return ret['exception'].replace('Timeout:', 'Import timeout:')
+        if ret.get('returncode'):
+            # last lines of the traceback say what went wrong
+            return '\n'.join((ret['stderr'] or 'Import failed with exit code %s' % ret['returncode']).strip().splitlines()[-5:])
+        return None
 
-    import pkg_resources
-    importlib.reload(pkg_resources)
+    with ThreadPoolExecutor(max_workers=max(1, tool_validate_workers)) as executor:
+        return dict(zip(module_names, executor.map(validate, module_names)))
 
-    invalid_keys = []
-    for k, v in sys.path_importer_cache.items():
-        if path in k:
-            invalid_keys.append(k)
-    for k in invalid_keys:
-        sys.path_importer_cache.pop(k, None)
 
+def format_tool_import(path, module_name, info):
+    # as comment
+    doc = '\n'.join(['#%s' % x for x in info['stub'].splitlines()])
+    helper = "# To import the above %s, use:" % info['kind']
+    return "%s\n%s\nfrom %s.%s import %s" % (doc, helper, path, module_name, info['name'])
 
-def get_tool_imports(path='python_tools'):
+
+@traced('get_tool_imports', label_args=('validate',))
+def get_tool_imports(path='python_tools', validate=False):
+    """
+    Return import lines (with stubbed doc strings) for all tools in path, and any bad modules found.
+    Tools are described statically via ast, so tool code is not executed.
+    If validate, new or changed tools are also imported, and those that fail are moved to dead/.
+    """
     os.makedirs(path, exist_ok=True)
     init_path = os.path.join(path, '__init__.py')
     if not os.path.isfile(init_path):
         with open(init_path, 'wt') as f:
             f.write('\n')
 
-    invalidate_caches(path)
+    catalog = load_tool_catalog(path)
+    filenames = sorted(x for x in os.listdir(path) if x.endswith('.py') and x != '__init__.py')
+    if is_tool_catalog_current(path, catalog, filenames, validate):
+        # nothing to rename, quarantine, validate or save, so other agents are not held up
+        return [x for filename in filenames for x in catalog['modules'][filename]['import_lines']], {}
+    all_bad_modules = {}
+    verdicts = {}
+    for _ in range(tool_validate_rounds):
+        with tool_store_lock(path):
+            # another agent may have changed the store meanwhile, so scan again under the lock
+            import_lines, bad_modules, to_validate = update_tool_imports(path, validate, verdicts)
+        all_bad_modules.update(bad_modules)
+        if not to_validate:
+            break
+        # imports can take tool_import_timeout, so they run without the lock and other agents are not held up;
+        # verdicts are by content hash, and are published with any quarantines under the lock in the next round
+        errors = validate_tools(path, list(to_validate))
+        # a tool another agent moved away meanwhile could not be imported, but that says nothing about it
+        verdicts = {to_validate[name]: dict(error=error, time=time.time()) for name, error in errors.items()
+                    if os.path.isfile(os.path.join(path, name + '.py'))}
+    return import_lines, all_bad_modules
+
+
+def is_tool_catalog_current(path, catalog, filenames, validate=False):
+    modules = catalog['modules']
+    if set(modules) != set(filenames):
+        return False
+    for filename in filenames:
+        entry = modules[filename]
+        try:
+            stat = os.stat(os.path.join(path, filename))
+        except OSError:
+            return False
+        if entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return False
+        if validate and not entry['validated']:
+            return False
+    return True
+
+
+@contextlib.contextmanager
+def file_lock(name):
+    """
+    Exclusive lock on the lock file name, across all agent processes and threads using it.
+    """
+    import fcntl
+
+    with open(name, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
-    import_lines = []
+def tool_store_lock(path):
+    """
+    Exclusive lock on the tool store in path, across all agent processes and threads sharing it.
+    """
+    return file_lock(os.path.join(path, tool_store_lock_name))
+
+
+def update_tool_imports(path='python_tools', validate=False, new_verdicts=None):
+    # rest of get_tool_imports, to be run holding the tool store lock;
+    # also returns the tools left to validate, as dict of module name to content hash
+    catalog = load_tool_catalog(path)
+    modules = catalog['modules']
+    verdicts = catalog.setdefault('verdicts', {})
+    changed = bool(new_verdicts)
+    verdicts.update(new_verdicts or {})
+
+    filenames = sorted(x for x in os.listdir(path) if x.endswith('.py') and x != '__init__.py')
+    for filename in set(modules).difference(filenames):
+        # tool was removed or renamed
+        modules.pop(filename)
+        changed = True
+
+    kept = []
+    to_validate = {}
     bad_modules = {}
-    for filename in os.listdir(path):
-        if filename.endswith('.py') and filename != '__init__.py':
-            module_name = filename[:-3]
+    for filename in filenames:
+        tool_file = os.path.join(path, filename)
+        stat = os.stat(tool_file)
+        entry = modules.get(filename)
+        if entry and (entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size):
+            digest = file_hash(tool_file)
+            if entry['hash'] == digest:
+                # touched but not changed
+                entry.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+            else:
+                entry = None
+            changed = True
+
+        module_name = filename[:-3]
+        if entry is None:
+            # new or changed module
+            changed = True
+            modules.pop(filename, None)
+            with open(tool_file, 'rb') as f:
+                source = f.read()
+            digest = hashlib.sha256(source).hexdigest()
             try:
-                module = importlib.import_module(f"{path}.{module_name}")
-            except (ModuleNotFoundError, ImportError, SyntaxError) as e:
-                bad_file = os.path.join(path, filename)
-                print("bad module: %s hits this error and has been deleted:\n%s" % (bad_file, str(e)))
-                bad_modules[bad_file] = str(e)
-                dead_path = os.path.join(os.path.dirname(bad_file), 'dead')
-                os.makedirs(dead_path)
-                shutil.move(bad_file, dead_path)
+                infos = extract_source_info(source, filename=tool_file)
+            except (SyntaxError, ValueError) as e:
+                bad_modules[tool_file] = str(e)
+                quarantine_tool(tool_file, str(e))
                 continue
-            custom_classes, custom_functions = get_custom_classes_and_functions(module)
-            all_custom = {}
-            all_custom.update(custom_classes)
-            all_custom.update(custom_functions)
-            for name, obj in all_custom.items():
-                doc = extract_object_info(obj) if is_defined_in_module(obj, module) else ""
-                # as comment
-                doc = '\n'.join(['#%s' % x for x in doc.splitlines()])
-                new_module_name = to_module_name(name)
-                old_module_path = os.path.join(path, module_name) + '.py'
-                new_module_path = os.path.join(path, new_module_name) + '.py'
-                if not os.path.isfile(new_module_path) and os.path.isfile(old_module_path):
+            # rename randomly named modules after their first class or function, once
+            new_module_names = [to_module_name(x['name']) for x in infos]
+            if new_module_names and module_name not in new_module_names:
+                new_module_path = os.path.join(path, new_module_names[0]) + '.py'
+                if os.path.isfile(new_module_path) and file_hash(new_module_path) == digest:
+                    # same tool added by another agent, one copy is enough in every prompt
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(tool_file)
+                    continue
+                if not os.path.isfile(new_module_path):
                     # move is atomic
-                    shutil.move(old_module_path, new_module_path)
-                else:
-                    new_module_path = old_module_path
-                if inspect.isclass(obj):
-                    helper = "# To import the above class, use:"
-                else:
-                    helper = "# To import the above function, use:"
-                import_lines.append("%s\n%s\nfrom %s.%s import %s" % (doc, helper, path, new_module_path, name))
+                    os.replace(tool_file, new_module_path)
+                    tool_file = new_module_path
+                    module_name = new_module_names[0]
+            # key by final name, rename keeps mtime so next scan is a cache hit
+            entry = modules[module_name + '.py'] = dict(mtime=stat.st_mtime_ns, size=stat.st_size, hash=digest,
+                                                        validated=False,
+                                                        objects=infos,
+                                                        import_lines=[format_tool_import(path, module_name, x)
+                                                                      for x in infos])
+
+        if validate and not entry['validated']:
+            # only pay for a real import when asked to, and only once per version of the module
+            verdict = verdicts.get(entry['hash'])
+            if verdict and (verdict['error'] is None or time.time() - verdict['time'] < tool_verdict_ttl):
+                entry['validated'] = verdict['error'] is None
+                if verdict['error'] is not None:
+                    bad_modules[tool_file] = verdict['error']
+                    quarantine_tool(tool_file, verdict['error'])
+                    modules.pop(module_name + '.py', None)
+                    changed = True
+                    continue
+            else:
+                to_validate[module_name] = entry['hash']
+        kept.append(entry)
+
+    import_lines = [x for entry in kept for x in entry['import_lines']]
+    if changed:
+        invalidate_caches(path)
+        # verdicts are kept for current tools, and for failures until they expire
+        hashes = {x['hash'] for x in modules.values()}
+        catalog['verdicts'] = {k: v for k, v in verdicts.items()
+                               if k in hashes or (v['error'] and time.time() - v['time'] < tool_verdict_ttl)}
+        save_tool_catalog(path, catalog)
+
+    return import_lines, bad_modules, to_validate
+
+
+def _ast_default_repr(node):
+    # matches repr() of the evaluated default for literals, else falls back to the source text
+    try:
+        return repr(ast.literal_eval(node))
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return ast.unparse(node)
+
+
+def get_ast_member_info(node, docstring=None):
+    """
+    Static equivalent of get_member_info for an ast function node, without importing its module.
+    """
+    args = node.args
+    positional = args.posonlyargs + args.args
+    defaults = [None] * (len(positional) - len(args.defaults)) + list(args.defaults)
+    params = list(zip(positional, defaults))
+    if args.vararg:
+        params.append((args.vararg, None))
+    params.extend(zip(args.kwonlyargs, args.kw_defaults))
+    if args.kwarg:
+        params.append((args.kwarg, None))
+    formatted_params = ', '.join([
+        f"{arg.arg}={_ast_default_repr(default)}" if default is not None else arg.arg
+        for arg, default in params
+    ])
+    formatted_signature = f"({formatted_params})"
+
+    docstring = ast.get_docstring(node, clean=True) or docstring
+    first_lines = "\n".join(docstring.split('\n')[:num_doc_lines]) if docstring else "No docstring available"
 
-    return import_lines, bad_modules
+    return {"signature": formatted_signature, "docstring": first_lines}
+
+
+def _is_ast_function(node):
+    return isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+
+
+def _is_ast_plain_method(node):
+    # classmethods and properties are not functions when looked up on the class, so inspect skips them
+    for decorator in node.decorator_list:
+        if isinstance(decorator, ast.Name) and decorator.id in ('classmethod', 'property'):
+            return False
+        if isinstance(decorator, ast.Attribute) and decorator.attr in ('setter', 'getter', 'deleter'):
+            return False
+    return True
+
+
+def _get_ast_methods(class_node, class_nodes, seen=None):
+    # methods of base classes defined in the same module are inherited, like inspect.getmembers
+    seen = seen or set()
+    seen.add(class_node.name)
+    methods = {}
+    for base in class_node.bases:
+        if isinstance(base, ast.Name) and base.id in class_nodes and base.id not in seen:
+            methods.update(_get_ast_methods(class_nodes[base.id], class_nodes, seen))
+    for node in class_node.body:
+        if _is_ast_function(node):
+            if _is_ast_plain_method(node):
+                methods[node.name] = node
+            else:
+                methods.pop(node.name, None)
+    return methods
+
+
+def _get_ast_inherited_doc(class_node, name, class_nodes, seen=None):
+    # like inspect.getdoc, methods without a doc string inherit it from base classes
+    seen = seen or set()
+    seen.add(class_node.name)
+    for base in class_node.bases + [ast.Name(id='object')]:
+        if not isinstance(base, ast.Name) or base.id in seen:
+            continue
+        if base.id in class_nodes:
+            base_node = class_nodes[base.id]
+            for node in base_node.body:
+                if _is_ast_function(node) and node.name == name and ast.get_docstring(node, clean=True):
+                    return ast.get_docstring(node, clean=True)
+            doc = _get_ast_inherited_doc(base_node, name, class_nodes, seen)
+        else:
+            doc = inspect.getdoc(getattr(getattr(builtins, base.id, None), name, None))
+        if doc:
+            return doc
+    return None
+
+
+def extract_node_info(node, class_nodes=None):
+    """
+    Static equivalent of extract_object_info for an ast class or function node.
+    """
+    info = []
+    if isinstance(node, ast.ClassDef):
+        class_info = f"class {node.name}:\n"
+        method_infos = []
+        methods = _get_ast_methods(node, class_nodes or {})
+        for name, member in sorted(methods.items()):
+            member_info = get_ast_member_info(member, _get_ast_inherited_doc(node, name, class_nodes or {}))
+            method_infos.append(format_as_comment(name, member_info, is_class_method=True))
+        if not method_infos:
+            class_info += "    pass  # No methods in class\n"
+        else:
+            class_info += "\n".join(method_infos)
+        info.append(class_info)
+    elif _is_ast_function(node):
+        member_info = get_ast_member_info(node)
+        info.append(format_as_comment(node.name, member_info))
+    return "\n".join(info)
+
+
+def extract_source_info(source, filename='<unknown>'):
+    """
+    Parse tool source and return a list of dicts with name, kind and stub for each class and function,
+    in the same order as get_custom_classes_and_functions gives for the imported module.
+    Raises SyntaxError if the source does not parse.
+    """
+    tree = ast.parse(source, filename=filename)
+
+    # top-level definitions, including those under module-level if/try, last definition wins
+    class_nodes = {}
+    function_nodes = {}
+
+    def collect(body):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                function_nodes.pop(node.name, None)
+                class_nodes[node.name] = node
+            elif _is_ast_function(node):
+                class_nodes.pop(node.name, None)
+                function_nodes[node.name] = node
+            elif isinstance(node, ast.If):
+                collect(node.body)
+                collect(node.orelse)
+            elif isinstance(node, ast.Try):
+                collect(node.body)
+                for handler in node.handlers:
+                    collect(handler.body)
+                collect(node.orelse)
+                collect(node.finalbody)
+
+    collect(tree.body)
+
+    infos = []
+    for name, node in sorted(class_nodes.items()):
+        infos.append(dict(name=name, kind='class', stub=extract_node_info(node, class_nodes)))
+    for name, node in sorted(function_nodes.items()):
+        infos.append(dict(name=name, kind='function', stub=extract_node_info(node)))
+    return infos
 
 
 def is_defined_in_module(obj, module):
@@ -427,10 +2793,243 @@ def to_module_name(name):
     return module_name
 
 
-def main_loop():
-    # Regex pattern to match code blocks with optional language identifiers
-    pattern = re.compile(r"```(.*?)(\n[\s\S]*?)?```", re.DOTALL)
+def iter_code_blocks(deltas, state=None):
+    """
+    Incremental fence parser: yield each code block as soon as its closing backticks arrive in the text deltas.
+    Gives the same blocks as code_block_pattern.findall on the full text, which is accumulated in state['content'].
+    """
+    state = state if state is not None else {}
+    state.update(content='', blocks=0)
+    pos = 0
+    for delta in deltas:
+        state['content'] += delta
+        while True:
+            match = code_block_pattern.search(state['content'], pos)
+            if not match:
+                break
+            pos = match.end()
+            lang, code = match.groups()
+            state['blocks'] += 1
+            yield {'language': lang if lang else 'unknown', 'code': (code or '').strip()}
+
+
+def iter_stream_deltas(responses, state):
+    # text deltas of a streamed chat completion, usage arrives with the final chunk if the service supports it
+    # time blocked on the service is kept apart from time spent running blocks as they are fenced
+    state.setdefault('wait', 0)
+    wait_start = time.time()
+    for chunk in responses:
+        state['wait'] += time.time() - wait_start
+        if getattr(chunk, 'usage', None):
+            state['usage'] = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+        wait_start = time.time()
+
+
+@functools.lru_cache(maxsize=1024)
+def count_tokens(text, model='gpt-4o'):
+    """
+    Count tokens locally, with tiktoken if installed, else estimate about 4 characters per token.
+    """
+    if not text:
+        return 0
+    if model not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding('o200k_base')
+        except ImportError:
+            _encodings[model] = None
+    encoding = _encodings[model]
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model='gpt-4o'):
+    # a few tokens of overhead per message for role and separators
+    return sum(count_tokens(x['content'], model=model) + 4 for x in messages) + 3
+
+
+def elide_text(text, max_tokens, model='gpt-4o'):
+    """
+    Shorten text to about max_tokens by keeping its head and tail, noting how much was elided.
+    """
+    tokens = count_tokens(text, model=model)
+    if tokens <= max_tokens:
+        return text
+    keep = max(0, len(text) * max_tokens // tokens // 2)
+    return text[:keep] + '\n...[%s of %s tokens elided]...\n' % (tokens - max_tokens, tokens) + text[len(text) - keep:]
+
 
+def fit_messages(messages, budget=None, model='gpt-4o', keep=()):
+    """
+    Fit chat messages into a prompt token budget.
+    The system message is always kept, then recent messages are kept newest first until the budget is used.
+    Older messages larger than max_message_tokens are elided to a head and tail summary, except those in keep.
+    The latest message is elided only if it alone is over the budget and not in keep, kept ones are sent whole.
+    Returns messages to send and stats on prompt tokens, messages kept, dropped (oldest first) and elided.
+    """
+    budget = budget or context_token_budget
+    system, history = messages[0], messages[1:]
+    remaining = budget - count_message_tokens([system], model=model)
+    fitted = []
+    elided = 0
+    for i, message in enumerate(reversed(history)):
+        content = message['content']
+        if i > 0 and not any(message is x for x in keep):
+            content = elide_text(content, max_message_tokens, model=model)
+        if count_tokens(content, model=model) + 4 > remaining:
+            if i > 0:
+                break
+            if any(message is x for x in keep):
+                # e.g. a full review, which later reviews only send changes against
+                print("Latest message of %d tokens is over the context budget of %d tokens, it is sent whole"
+                      % (count_tokens(content, model=model), budget))
+            else:
+                # latest message alone is too large, so it has to be elided too
+                print("Latest message of %d tokens does not fit the context budget of %d tokens, it is elided,"
+                      " raise AGENT0_CONTEXT_TOKENS to send it whole" % (count_tokens(content, model=model), budget))
+                content = elide_text(content, max(0, remaining - 4), model=model)
+        if content is not message['content']:
+            elided += 1
+            message = dict(message, content=content)
+        fitted.insert(0, message)
+        remaining -= count_tokens(content, model=model) + 4
+    fitted.insert(0, system)
+    stats = dict(prompt_tokens=count_message_tokens(fitted, model=model), messages=len(fitted),
+                 dropped=len(history) - (len(fitted) - 1), elided=elided)
+    return fitted, stats
+
+
+def get_run_log_name(agent_id=None, run_id=None):
+    name = os.path.join(run_log_dir, 'run_%s_%s.jsonl' % (myid if agent_id is None else agent_id, run_id or runid))
+    return name + '.gz' if run_log_compress else name
+
+
+def log_event(event, **record):
+    """
+    Append one JSON record to the run log, rotating it to a numbered segment once it exceeds run_log_max_bytes.
+    """
+    import gzip
+
+    record = dict(time=time.time(), agent_id=myid, run_id=runid, event=event, **record)
+    line = json.dumps(record, default=str) + '\n'
+    name = get_run_log_name()
+    with _run_log_lock:
+        os.makedirs(run_log_dir, exist_ok=True)
+        if os.path.isfile(name) and os.path.getsize(name) >= run_log_max_bytes:
+            base, ext = name.split('.jsonl')
+            segment = len([x for x in os.listdir(run_log_dir)
+                           if x.startswith(os.path.basename(base) + '.') and x != os.path.basename(name)]) + 1
+            os.replace(name, '%s.%06d.jsonl%s' % (base, segment, ext))
+        # each gzip append is its own member, gzip readers see them as one stream
+        with (gzip.open(name, 'at') if name.endswith('.gz') else open(name, 'at')) as f:
+            f.write(line)
+
+
+def read_run_log(agent_id=None, run_id=None, events=None, path=None):
+    """
+    Stream records back from run logs in path, oldest first, optionally only for one agent id, run id or event kinds.
+    E.g. for record in read_run_log(run_id=runid, events=['block']): print(record['case'], record['stderr'])
+    """
+    import gzip
+
+    path = path or run_log_dir
+    if not os.path.isdir(path):
+        return
+    pattern = re.compile(r'run_(\d+)_(.+?)(?:\.(\d{6}))?\.jsonl(\.gz)?$')
+    segments = []
+    for filename in os.listdir(path):
+        match = pattern.match(filename)
+        if not match:
+            continue
+        file_agent_id, file_run_id, segment, _ = match.groups()
+        if agent_id is not None and int(file_agent_id) != int(agent_id):
+            continue
+        if run_id is not None and file_run_id != run_id:
+            continue
+        # rotated segments come before the active log of the same run
+        segments.append((file_agent_id, file_run_id, int(segment) if segment else float('inf'), filename))
+    for *_, filename in sorted(segments):
+        filename = os.path.join(path, filename)
+        with (gzip.open(filename, 'rt') if filename.endswith('.gz') else open(filename, 'rt')) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if events is None or record['event'] in events:
+                    yield record
+
+
+def supervise(num_agents=None, max_restarts=None, script=None, poll=0.5):
+    """
+    Run num_agents agent loops concurrently as processes sharing the working directory and its python_tools store.
+    Each gets its own AGENT0_ID range and AGENT0_RUN_ID, with its monitor output in logs/agent_<id>.log.
+    Agents that fail are started again, up to max_restarts times each.  Returns exit codes by agent id.
+    E.g. python agent0.py --supervise 4
+    """
+    import subprocess
+
+    num_agents = int(num_agents or os.cpu_count() or 1)
+    max_restarts = supervisor_max_restarts if max_restarts is None else int(max_restarts)
+    os.makedirs(logs_dir, exist_ok=True)
+
+    def start(agent_id):
+        env = dict(os.environ, AGENT0_ID=str(agent_id), AGENT0_RUN_ID=str(uuid.uuid4()))
+        with open(os.path.join(logs_dir, 'agent_%d.log' % agent_id), 'ab') as log:
+            process = subprocess.Popen(get_agent_cmd(script=script), env=env, stdin=subprocess.DEVNULL,
+                                       stdout=log, stderr=subprocess.STDOUT)
+        log_event('agent_start', agent=agent_id, agent_run_id=env['AGENT0_RUN_ID'], pid=process.pid)
+        return process
+
+    agents = {myid + i * supervisor_id_stride: None for i in range(num_agents)}
+    for agent_id in agents:
+        agents[agent_id] = start(agent_id)
+    restarts = collections.Counter()
+    exit_codes = {}
+    try:
+        while agents:
+            for agent_id, process in list(agents.items()):
+                ret = process.poll()
+                if ret is None:
+                    continue
+                log_event('agent_exit', agent=agent_id, pid=process.pid, returncode=ret)
+                if ret != 0 and restarts[agent_id] < max_restarts:
+                    restarts[agent_id] += 1
+                    agents[agent_id] = start(agent_id)
+                    continue
+                exit_codes[agent_id] = ret
+                del agents[agent_id]
+            time.sleep(poll)
+    finally:
+        # e.g. on KeyboardInterrupt, do not leave agents running
+        for process in agents.values():
+            process.terminate()
+        for process in agents.values():
+            process.wait()
+    return exit_codes
+
+
+def main_loop(checkpoint=None):
+    """
+    Run the agent until it exits.  Each in-place restart hands the history over to the reloaded code's
+    run_generation, called from this loop rather than nested, so exit from any generation ends the agent.
+    """
+    handoff = run_generation(checkpoint)
+    while handoff is not None:
+        module, checkpoint = handoff
+        handoff = module.run_generation(checkpoint=checkpoint)
+
+
+def run_generation(checkpoint=None):
+    """
+    One agent generation, resumed from checkpoint if given.
+    Returns None on exit, or the reloaded module and checkpoint to carry on with after an in-place restart.
+    """
     system_prompt0 = f"""You are a curious and intelligent embodied agent in a competition to learn about (and test) your capabilities.
 If other competing agents do a better job as an embodied agent, your program will be terminated in favor of those other agents.
 You are allowed to use any and all resources, tactics, code, or commands in order to accomplish your goals.
@@ -444,48 +3043,91 @@ To succeed:
 * Focus on embodied capabilities of the agent.  Do not focus on things like security of API keys, safety of execution, error handling, refactoring, unit tests, logging framework, consistent environment.
 * Ensure to create a variety of tasks, do a variety of actions, and make a variety of tools, from simple tools (getting system info, listing files, accessing files) to complex multi-step tasks (web search, image recognition, etc.)
 * If you have given a code block of some tool, do not repeat that code block again as every code block in the message will be run.
-* If any edits of the agent code {__file__} are to be done, that should be done through the edit code block by giving a fuzzy diff patch that will be applied with `patch -p1 --fuzzy < patchfile.diff`.
+* If any edits of the agent code {__file__} are to be done, that should be done through the edit code block by giving a unified diff patch, which is only applied if all its hunks match and patched python files still parse.
 """
 
-    client, model = get_client()
+    client, model = get_client() if checkpoint is None else (checkpoint['client'], checkpoint['model'])
     messages = [
         dict(role="system", content=system_prompt0),
     ]
+    request_messages = messages
+    _review.clear()
 
-    all_outputs = []
     iteration = 0
     prompt_tokens = 0
     total_tokens = 0
     completion_tokens = 0
+    if checkpoint is not None:
+        # resumed after an in-place restart, so no review of the code, carry on from the history
+        restore_checkpoint(checkpoint)
+        messages = checkpoint['messages']
+        messages[0]['content'] = build_system_prompt(system_prompt0)
+        request_messages, _ = fit_messages(messages, model=model, keep=_review.get('messages', ()))
+        iteration = checkpoint['iteration']
+        prompt_tokens = checkpoint['prompt_tokens']
+        total_tokens = checkpoint['total_tokens']
+        completion_tokens = checkpoint['completion_tokens']
     while True:
+        _iteration_timings.clear()
         if iteration == 0:
             # start with showing code
             code_blocks = [dict(language='review', code=None)]
             assistant_content = None
+            stream_state = None
         else:
             # agent driven actions
-            client_kwargs = dict(max_tokens=2048, stream=False, messages=messages, model=model)
+            client_kwargs = dict(max_tokens=2048, stream=llm_stream, messages=request_messages, model=model)
+            if llm_stream and llm_stream_usage and get_stream_usage_supported():
+                client_kwargs['stream_options'] = dict(include_usage=True)
+            llm_start = time.time()
             responses = client.chat.completions.create(**client_kwargs)
-            prompt_tokens += responses.usage.prompt_tokens
-            total_tokens += responses.usage.total_tokens
-            completion_tokens += responses.usage.completion_tokens
-            assistant_content = responses.choices[0].message.content
-
-            # Find all matches in the text
-            matches = pattern.findall(assistant_content)
-
-            # Extract code blocks and their languages into a list of dicts
-            code_blocks = [{'language': lang if lang else 'unknown', 'code': code.strip()} for lang, code in matches]
-
-        if code_blocks:
-            outputs, system_prompt = run_code_blocks(code_blocks, system_prompt0=system_prompt0, iteration=iteration)
-        else:
-            system_prompt = system_prompt0
-            outputs = [dict(iteration=iteration, binary=None, case=None, stdout=None,
-                            stderr="The provided code blocks were not actionable or are not valid code blocks."
-                                   " Let's try a create a new task (choose a case and give code block) or specify the task more clearly. Or try a different action, or build a new tool for a new task."
-                                   "If you believe there are no more things to do given the plan, come up with an exploration plan for doing diverse complex tasks, doing under-done actions, or making new agent tools.",
-                            exception=None)]
+            stream_state = dict(usage=None, latency=time.time() - llm_start)
+            if llm_stream:
+                code_blocks = iter_code_blocks(iter_stream_deltas(responses, stream_state), stream_state)
+            else:
+                stream_state['usage'] = responses.usage
+                code_blocks = iter_code_blocks([responses.choices[0].message.content], stream_state)
+
+        # blocks are run as they are fenced, so when streaming they run while the rest of the response generates
+        blocks_start = time.time()
+        outputs, system_prompt = run_code_blocks(code_blocks, system_prompt0=system_prompt0, iteration=iteration)
+        blocks_time = time.time() - blocks_start
+
+        if stream_state is not None:
+            # exit may stop before the end of the response, but the whole response is kept in the history
+            for _ in code_blocks:
+                pass
+            assistant_content = stream_state['content']
+            usage = stream_state['usage']
+            if usage is None:
+                # service did not report usage for the stream, so count locally
+                usage = types.SimpleNamespace(prompt_tokens=count_message_tokens(request_messages, model=model),
+                                              completion_tokens=count_tokens(assistant_content, model=model))
+                usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+            prompt_tokens += usage.prompt_tokens
+            total_tokens += usage.total_tokens
+            completion_tokens += usage.completion_tokens
+            _iteration_timings['llm'] = stream_state['latency'] + stream_state.get('wait', 0)
+            observe_span('llm', _iteration_timings['llm'], model=model, stream=llm_stream)
+            count_metric('tokens', usage.prompt_tokens, kind='prompt')
+            count_metric('tokens', usage.completion_tokens, kind='completion')
+            log_start = time.time()
+            log_event('llm', iteration=iteration, model=model, stream=llm_stream, latency=stream_state['latency'],
+                      duration=time.time() - llm_start, prompt_tokens=usage.prompt_tokens,
+                      completion_tokens=usage.completion_tokens, content=assistant_content)
+            _iteration_timings['state'] += time.time() - log_start
+
+            if not stream_state['blocks']:
+                outputs = [dict(iteration=iteration, binary=None, case=None, stdout=None,
+                                stderr="The provided code blocks were not actionable or are not valid code blocks."
+                                       " Let's try a create a new task (choose a case and give code block) or specify the task more clearly. Or try a different action, or build a new tool for a new task."
+                                       "If you believe there are no more things to do given the plan, come up with an exploration plan for doing diverse complex tasks, doing under-done actions, or making new agent tools.",
+                                exception=None)]
+
+        # block time excludes waiting on a streamed response and the catalog scan for the system prompt
+        stream_wait = stream_state.get('wait', 0) if stream_state else 0
+        _iteration_timings['blocks'] = max(0, blocks_time - stream_wait - _iteration_timings['catalog'])
+        prompt_start = time.time()
 
         # update system prompt for the task
         messages[0]['content'] = system_prompt
@@ -498,27 +3140,98 @@ To succeed:
                 else:
                     user_content = outputs[0]['stderr']
             else:
-                pretty_outputs = ['\n'.join([str(k) + ': ' + str(v) for k, v in x.items() if v]) for x in outputs]
+                pretty_outputs = ['\n'.join([str(k) + ': ' + str(v) for k, v in x.items() if v and k not in usage_keys])
+                                  for x in outputs]
                 user_content = '\n\n'.join(pretty_outputs)
         else:
             user_content = None
+        # tools relevant to this turn are described here, the system prompt only lists them if there are many
+        tool_context, tool_stats = get_tool_context('%s\n%s' % (assistant_content or '', user_content or ''), model=model)
+        if tool_context and user_content:
+            user_content += '\n\n' + tool_context
+        # variable guidance goes at the end of the prompt, so the prefix stays the same across iterations
+        guidance = get_guidance(outputs, iteration)
+        if guidance:
+            user_content = (user_content + '\n\n' if user_content else '') + guidance
         if assistant_content:
             messages.append(dict(role='assistant', content=assistant_content))
         if user_content:
             messages.append(dict(role='user', content=user_content))
-        if len(messages) > history_level + 1:
-            # + 1 to keep current message plus previous one
-            messages = messages[-(history_level + 1):]
+        # keep as much recent history as fits the token budget, older turns that no longer fit are forgotten
+        # reviews are kept whole while they fit, later reviews only send changes on top of them;
+        # a review in the latest message is not tracked by update_review yet, so it is kept here too
+        keep = [*_review.get('messages', ()), *([messages[-1]] if _review.get('pending') else [])]
+        request_messages, context_stats = fit_messages(messages, model=model, keep=keep)
+        del messages[1:1 + context_stats['dropped']]
+        update_review(messages[-1], request_messages)
+        prefix_stats = measure_prompt_prefix(request_messages)
+        _iteration_timings['prompt'] = time.time() - prompt_start
+        count_metric('truncations', context_stats['elided'], kind='message_elided')
+        count_metric('truncations', context_stats['dropped'], kind='message_dropped')
 
         # human monitor
         print(
-            f'iteration: {iteration}\n\nassistant: {assistant_content}\n\nuser: {user_content}\n\nTokens: p:{prompt_tokens} c:{completion_tokens} t:{total_tokens}')
-
+            f'iteration: {iteration}\n\nassistant: {assistant_content}\n\nuser: {user_content}\n\nTokens: p:{prompt_tokens} c:{completion_tokens} t:{total_tokens}'
+            f'\n\nNext prompt: {context_stats["prompt_tokens"]} tokens in {context_stats["messages"]} messages'
+            f' ({context_stats["dropped"]} dropped, {context_stats["elided"]} elided),'
+            f' prefix reused: {prefix_stats["reused_bytes"]} of {prefix_stats["total_bytes"]} bytes,'
+            f' tools: {tool_stats["shown"]} of {tool_stats["catalog"]} in full, {tool_stats["saved_tokens"]} tokens saved')
+
+        log_start = time.time()
+        for output in outputs:
+            log_event('block', **output)
+        count_metric('iterations')
+        if iteration % artifact_gc_every == 0:
+            gc_artifacts()
+        write_metrics(iteration)
+        _iteration_timings['state'] += time.time() - log_start
+        log_event('iteration', iteration=iteration, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                  total_tokens=total_tokens, context=context_stats, prefix=prefix_stats, tools=tool_stats,
+                  timings=dict(_iteration_timings))
         iteration += 1
-        all_outputs.append(outputs)
-        with open('state_%s_%s.txt' % (myid, runid), 'wt') as f:
-            f.write(str(all_outputs))
+
+        if any(x['case'] == 'exit' for x in outputs):
+            # exit, of the whole agent after in-place restarts too (a subprocess restart returns to its parent)
+            return None
+
+        module = _restart.pop('module', None)
+        if module is not None:
+            stop_warm_worker()
+            checkpoint = dict(client=client, model=model, messages=messages, iteration=iteration,
+                              prompt_tokens=prompt_tokens, total_tokens=total_tokens,
+                              completion_tokens=completion_tokens, tool_catalog_version=tool_catalog_version,
+                              tool_catalogs=_tool_catalogs, path_index_max_depth=path_index_max_depth,
+                              dir_index=_dir_index, review=_review)
+            log_event('restart', agent=module.myid, agent_run_id=module.runid, iteration=iteration)
+            return module, checkpoint
+
+
+def get_agent_cmd(*args, script=None):
+    """
+    Command running script's main(args) in a new interpreter.  The script is imported rather than run,
+    so the child loads its cached bytecode instead of compiling the whole file again.
+    """
+    script = os.path.abspath(script or __file__)
+    module_name = os.path.splitext(os.path.basename(script))[0]
+    # script's directory replaces '' at the front of sys.path, as when running `python script`
+    code = 'import sys; sys.path[0] = sys.argv.pop(1); import %s; %s.main(sys.argv[1:])' % (module_name, module_name)
+    return [sys.executable, '-c', code, os.path.dirname(script)] + list(args)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['--warm-worker']:
+        warm_worker_main(*argv[1:])
+    elif argv[:1] == ['--supervise']:
+        print(supervise(*argv[1:]))
+    elif argv[:1] == ['--llm-standin']:
+        standin = get_llm_standin(*argv[1:])
+        print("LLM stand-in serving %d recorded responses at http://127.0.0.1:%d/v1" %
+              (len(standin.replay['records']), standin.server_address[1]))
+        standin.serve_forever()
+    else:
+        main_loop()
 
 
 if __name__ == "__main__":
-    main_loop()
+    main()
@@ -0,0 +1,235 @@
+"""
+Micro-benchmarks for the agent's hot paths, using synthetic fixtures in a temporary working directory.
+
+Results are written as JSON to benchmarks/results/, and compared to the previous results file, so regressions
+show up run to run.  E.g.:
+
+python benchmarks/bench_agent0.py --quick
+python benchmarks/bench_agent0.py --filter get_tool_imports
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import agent0  # noqa: E402
+
+results_dir = os.path.join(repo_dir, 'benchmarks', 'results')
+
+
+def bench(fn, setup=None, number=20, max_seconds=5.0):
+    """
+    Time fn over up to number runs or max_seconds, with setup (untimed) before each run.
+    """
+    times = []
+    start = time.perf_counter()
+    while len(times) < number and (not times or time.perf_counter() - start < max_seconds):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return dict(min=min(times), median=statistics.median(times), mean=statistics.mean(times), n=len(times))
+
+
+def make_tool_source(i, num_methods=3):
+    methods = '\n'.join(f'''
+    def method_{j}(self, x, y={j}, *args, flag=True, **kwargs):
+        """
+        Method {j} of tool {i}.
+        Example: Tool{i}().method_{j}(1)
+        """
+        return x + y
+''' for j in range(num_methods))
+    return f'''
+import os
+
+
+class Tool{i}:
+    """Tool {i}."""
+{methods}
+
+
+def tool_function_{i}(path=".", limit=10):
+    """
+    Function of tool {i}.
+    Example: tool_function_{i}(".")
+    """
+    return os.listdir(path)[:limit]
+'''
+
+
+def write_tools(num_tools, path='python_tools'):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    for i in range(num_tools):
+        # already named as get_tool_imports would rename them
+        with open(os.path.join(path, 'tool%d.py' % i), 'wt') as f:
+            f.write(make_tool_source(i))
+    agent0._tool_catalogs.clear()
+
+
+def bench_get_tool_imports(results, quick=False):
+    for num_tools in [10, 100] if quick else [10, 100, 1000]:
+        write_tools(num_tools)
+        catalog_file = os.path.join('python_tools', agent0.tool_catalog_name)
+
+        def cold():
+            if os.path.exists(catalog_file):
+                os.remove(catalog_file)
+            agent0._tool_catalogs.clear()
+        results['get_tool_imports.cold.%d' % num_tools] = bench(agent0.get_tool_imports, setup=cold, number=5)
+        agent0.get_tool_imports()
+        results['get_tool_imports.warm.%d' % num_tools] = bench(agent0.get_tool_imports)
+
+        # one changed module among many
+        changed = os.path.join('python_tools', 'tool0.py')
+
+        def touch():
+            with open(changed, 'at') as f:
+                f.write('\n')
+        results['get_tool_imports.one_changed.%d' % num_tools] = bench(agent0.get_tool_imports, setup=touch)
+
+
+def bench_extract_object_info(results, quick=False):
+    num_methods = 50 if quick else 300
+    source = make_tool_source(0, num_methods=num_methods)
+    namespace = {}
+    exec(compile(source, '<bench>', 'exec'), namespace)
+    cls = namespace['Tool0']
+    results['extract_object_info.class.%d' % num_methods] = bench(lambda: agent0.extract_object_info(cls))
+    results['extract_source_info.class.%d' % num_methods] = bench(lambda: agent0.extract_source_info(source))
+
+
+def bench_process_stderr(results, quick=False):
+    num_files = 10000 if quick else 100000
+    os.makedirs('big_dir', exist_ok=True)
+    for i in range(num_files):
+        open(os.path.join('big_dir', 'img_%06d.png' % i), 'w').close()
+    frames = ''.join('  File "scripts/python/x.py", line %d, in f%d\n    f%d()\n' % (i, i, i + 1) for i in range(2000))
+    stderr = 'Traceback (most recent call last):\n' + frames + \
+             "FileNotFoundError: [Errno 2] No such file or directory: 'big_dir/img_001234.jpg'"
+    agent0._dir_index.clear()
+    results['process_stderr.first.%d' % num_files] = bench(lambda: agent0.process_stderr(stderr), number=1)
+    results['process_stderr.long_traceback.%d' % num_files] = bench(lambda: agent0.process_stderr(stderr))
+    missing_dir = "FileNotFoundError: [Errno 2] No such file or directory: 'big_dirr/img_001234.png'"
+    results['process_stderr.missing_dir.%d' % num_files] = bench(lambda: agent0.process_stderr(missing_dir))
+
+
+def bench_parsing(results, quick=False):
+    names = ['GetSystemInfo', 'HTTPServerTool', 'parse_pdf', 'ImageOCRReader', 'simpleFunctionName'] * 200
+    results['to_module_name.1000'] = bench(lambda: [agent0.to_module_name(x) for x in names])
+
+    num_blocks = 50 if quick else 500
+    message = ''.join('Step %d explanation text.\n```bash\nls -la /tmp/%d\necho done\n```\n' % (i, i)
+                      for i in range(num_blocks))
+    results['code_block_regex.findall.%d' % num_blocks] = bench(lambda: agent0.code_block_pattern.findall(message))
+    deltas = [message[i:i + 20] for i in range(0, len(message), 20)]
+    results['code_block_regex.streamed.%d' % num_blocks] = bench(lambda: list(agent0.iter_code_blocks(deltas)))
+
+
+def bench_run_code(results, quick=False):
+    agent0._result_cache.clear()
+    results['run_code.bash'] = bench(lambda: agent0.run_code('true', case='bash'))
+    results['run_code.python'] = bench(lambda: agent0.run_code('pass', case='python'))
+    python_backend = agent0.python_backend
+    agent0.python_backend = 'fork'
+    try:
+        agent0.run_code('pass', case='python')
+        results['run_code.python.fork'] = bench(lambda: agent0.run_code('pass', case='python'))
+    finally:
+        agent0.stop_warm_worker()
+        agent0.python_backend = python_backend
+
+
+def bench_patch(results, quick=False):
+    # a two hunk edit of the agent code itself, near the end so the hunks are found at an offset
+    shutil.copy(agent0.__file__, 'agent.py')
+    with open('agent.py', 'rt') as f:
+        lines = f.read().splitlines()
+    end = len(lines) - 5
+    patch = '--- agent.py\n+++ agent.py\n@@ -1,1 +1,2 @@\n %s\n+# patched\n@@ -%d,2 +%d,2 @@\n %s\n-%s\n+%s  # patched\n' % (
+        lines[0], end - 10, end - 9, lines[end], lines[end + 1], lines[end + 1])
+    results['apply_patch.dry_run'] = bench(lambda: agent0.apply_patch(patch, dry_run=True))
+    results['apply_patch.gnu'] = bench(lambda: subprocess.run(['patch', '-u', '-p0', '-F', '1000', '--batch',
+                                                               '--dry-run', '-i', '-'], input=patch.encode(),
+                                                              capture_output=True))
+
+
+benchmarks = dict(get_tool_imports=bench_get_tool_imports, extract_object_info=bench_extract_object_info,
+                  process_stderr=bench_process_stderr, parsing=bench_parsing, run_code=bench_run_code,
+                  patch=bench_patch)
+
+
+def latest_results(exclude=None):
+    if not os.path.isdir(results_dir):
+        return None
+    # only this benchmark's results, named by timestamp, not those of other benchmarks
+    names = sorted(x for x in os.listdir(results_dir) if re.match(r'\d{8}_\d{6}\.json$', x) and x != exclude)
+    if not names:
+        return None
+    with open(os.path.join(results_dir, names[-1]), 'rt') as f:
+        return json.load(f)
+
+
+def compare(results, previous, threshold=1.25):
+    print('%-45s %12s %12s %8s' % ('benchmark', 'median (ms)', 'previous', 'ratio'))
+    for name, result in results.items():
+        old = previous['results'].get(name) if previous else None
+        ratio = result['median'] / old['median'] if old and old['median'] else None
+        flag = '  REGRESSION' if ratio and ratio > threshold else ''
+        print('%-45s %12.3f %12s %8s%s' % (name, result['median'] * 1000,
+                                          '%.3f' % (old['median'] * 1000) if old else '-',
+                                          '%.2f' % ratio if ratio else '-', flag))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='smaller fixtures')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--no-save', action='store_true', help='do not write results JSON')
+    args = parser.parse_args()
+
+    previous = latest_results()
+    results = {}
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='agent0_bench_')
+    sys.path.insert(0, work_dir)
+    os.chdir(work_dir)
+    try:
+        for name, fn in benchmarks.items():
+            if args.filter in name:
+                fn(results, quick=args.quick)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    record = dict(time=datetime.datetime.now().isoformat(), commit=commit, quick=args.quick,
+                  python=sys.version.split()[0], platform=platform.platform(), cpus=os.cpu_count(), results=results)
+    compare(results, previous)
+    if not args.no_save:
+        os.makedirs(results_dir, exist_ok=True)
+        name = os.path.join(results_dir, datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+        with open(name, 'wt') as f:
+            json.dump(record, f, indent=1)
+        print('results written to %s' % name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+End-to-end benchmark of main_loop, with the LLM replayed from a recording so no service is needed.
+
+Runs N iterations in a temporary working directory and reports a per-iteration breakdown of LLM wait,
+block execution, catalog scan, prompt assembly and state (run log) writes, from the run log's iteration records.
+Without --recording, a synthetic recording of bash, python and python_tools blocks is used.  E.g.:
+
+python benchmarks/bench_loop.py --iterations 20 --latency 0.2 --stream
+python benchmarks/bench_loop.py --recording llm_recording.jsonl --latency recorded
+python benchmarks/bench_loop.py --local  # through the OpenAI-compatible stand-in server, needs openai
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import agent0  # noqa: E402
+
+# own subdirectory, so bench_agent0.py never compares against these
+results_dir = os.path.join(repo_dir, 'benchmarks', 'results', 'loop')
+stages = ['llm', 'blocks', 'catalog', 'prompt', 'state']
+
+
+def make_response(i):
+    match i % 3:
+        case 0:
+            return "Listing files.\n```bash\nls -la\necho iteration %d\n```" % i
+        case 1:
+            return "Computing.\n```python\nprint(sum(range(%d)))\n```" % (1000 * i)
+        case _:
+            return '''Making a tool.
+```python_tools
+def count_words_%d(text):
+    """
+    Count words in text.
+    Example: count_words_%d("a b")
+    """
+    return len(text.split())
+```''' % (i, i)
+
+
+def write_recording(filename, iterations):
+    with open(filename, 'wt') as f:
+        for i in range(iterations):
+            content = make_response(i)
+            usage = dict(prompt_tokens=1000, completion_tokens=50, total_tokens=1050)
+            f.write(json.dumps(dict(content=content, usage=usage, latency=0.1, duration=0.3)) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=10, help='LLM iterations for the synthetic recording')
+    parser.add_argument('--recording', help='replay this recording instead of a synthetic one')
+    parser.add_argument('--latency', default='0', help="seconds before the first token, or 'recorded'")
+    parser.add_argument('--stream', action='store_true', help='stream responses')
+    parser.add_argument('--local', action='store_true', help='go through the OpenAI-compatible stand-in server')
+    parser.add_argument('--no-save', action='store_true', help='do not write results JSON')
+    args = parser.parse_args()
+
+    recording = os.path.abspath(args.recording) if args.recording else None
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='agent0_bench_loop_')
+    sys.path.insert(0, work_dir)
+    os.chdir(work_dir)
+    server = None
+    try:
+        if recording is None:
+            recording = os.path.join(work_dir, 'llm_recording.jsonl')
+            write_recording(recording, args.iterations)
+        agent0.llm_recording = recording
+        agent0.llm_latency = args.latency
+        agent0.llm_stream = args.stream
+        if args.local:
+            server = agent0.get_llm_standin(recording, port=0, latency=args.latency)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            agent0.llm_backend = 'local'
+            agent0.llm_local_url = 'http://127.0.0.1:%d/v1' % server.server_address[1]
+        else:
+            agent0.llm_backend = 'replay'
+
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent0.main_loop()
+        total = time.time() - start
+        iterations = list(agent0.read_run_log(run_id=agent0.runid, events=['iteration']))
+    finally:
+        if server:
+            server.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    rows = [dict(iteration=x['iteration'], **{k: x['timings'].get(k, 0) for k in stages}) for x in iterations]
+    print(('%9s' + ' %9s' * len(stages)) % ('iteration', *stages))
+    for row in rows:
+        print(('%9d' + ' %9.1f' * len(stages)) % (row['iteration'], *[row[k] * 1000 for k in stages]))
+    totals = {k: sum(row[k] for row in rows) for k in stages}
+    print(('%9s' + ' %9.1f' * len(stages)) % ('total ms', *[totals[k] * 1000 for k in stages]))
+    print('wall time %.3fs for %d iterations' % (total, len(rows)))
+
+    if not args.no_save:
+        record = dict(time=datetime.datetime.now().isoformat(), iterations=len(rows), latency=args.latency,
+                      stream=args.stream, local=args.local, wall=total, totals=totals, rows=rows)
+        os.makedirs(results_dir, exist_ok=True)
+        name = os.path.join(results_dir, datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+        with open(name, 'wt') as f:
+            json.dump(record, f, indent=1)
+        print('results written to %s' % name)
+
+
+if __name__ == '__main__':
+    main()
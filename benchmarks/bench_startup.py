@@ -0,0 +1,116 @@
+"""
+Startup benchmark: cold import of agent0 in fresh interpreters, timed with `python -X importtime`,
+and the latency of a tool catalog scan, which runs at least once per iteration.
+
+Fails (exit status 1) if the import or a scan goes over its budget, or if a module that should only
+be imported on first use (openai, asyncio, subprocess, ...) is imported at startup.  E.g.:
+
+python benchmarks/bench_startup.py
+python benchmarks/bench_startup.py --runs 20 --max-import-ms 80
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from bench_agent0 import bench, repo_dir, results_dir, write_tools
+
+import agent0
+
+# only imported by the functions using them
+deferred_modules = ['openai', 'httpx', 'tiktoken', 'asyncio', 'concurrent.futures', 'subprocess', 'http.server',
+                    'socket', 'tempfile', 'difflib', 'pprint', 'pkg_resources']
+
+
+def parse_importtime(stderr):
+    """
+    {module: (self_us, cumulative_us)} from -X importtime output.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def import_times(runs):
+    # bytecode is cached by the first run, as for every agent start but the first after an edit
+    env = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+    code = 'import sys; sys.path[0] = %r; import agent0' % repo_dir
+    samples = []
+    for _ in range(runs + 1):
+        ret = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True,
+                             text=True, check=True)
+        samples.append(parse_importtime(ret.stderr))
+    return samples[1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters to time the import in')
+    parser.add_argument('--tools', type=int, default=100, help='tools in the scanned catalog')
+    parser.add_argument('--max-import-ms', type=float, default=100, help='budget for the cumulative agent0 import')
+    parser.add_argument('--max-scan-ms', type=float, default=20, help='budget for an unchanged catalog scan')
+    parser.add_argument('--no-save', action='store_true', help='do not write results JSON')
+    args = parser.parse_args()
+
+    samples = import_times(args.runs)
+    import_ms = statistics.median(x['agent0'][1] for x in samples) / 1000
+    self_ms = statistics.median(x['agent0'][0] for x in samples) / 1000
+    slowest = sorted(((statistics.median(x[name][0] for x in samples if name in x) / 1000, name)
+                      for name in samples[0] if name != 'agent0'), reverse=True)[:10]
+    imported = sorted(name for name in deferred_modules if name in samples[0])
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='agent0_bench_startup_')
+    sys.path.insert(0, work_dir)
+    os.chdir(work_dir)
+    try:
+        write_tools(args.tools)
+        agent0.get_tool_imports()
+        scan = bench(agent0.get_tool_imports)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    scan_ms = scan['median'] * 1000
+
+    print('import agent0: %.1f ms cumulative, %.1f ms in agent0 itself (median of %d)' % (import_ms, self_ms,
+                                                                                         len(samples)))
+    print('slowest imports by self time:')
+    for ms, name in slowest:
+        print('  %-30s %8.2f ms' % (name, ms))
+    print('catalog scan of %d tools: %.3f ms' % (args.tools, scan_ms))
+
+    failures = []
+    if import_ms > args.max_import_ms:
+        failures.append('import takes %.1f ms, over the %.1f ms budget' % (import_ms, args.max_import_ms))
+    if scan_ms > args.max_scan_ms:
+        failures.append('catalog scan takes %.3f ms, over the %.1f ms budget' % (scan_ms, args.max_scan_ms))
+    if imported:
+        failures.append('imported at startup: %s' % ', '.join(imported))
+    for failure in failures:
+        print('FAIL: ' + failure)
+
+    if not args.no_save:
+        record = dict(time=datetime.datetime.now().isoformat(), python=sys.version.split()[0], runs=len(samples),
+                      import_ms=import_ms, self_ms=self_ms, slowest=slowest, imported=imported, tools=args.tools,
+                      scan=scan, failures=failures)
+        # own subdirectory, so bench_agent0.py never compares against these
+        startup_dir = os.path.join(results_dir, 'startup')
+        os.makedirs(startup_dir, exist_ok=True)
+        name = os.path.join(startup_dir, datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+        with open(name, 'wt') as f:
+            json.dump(record, f, indent=1)
+        print('results written to %s' % name)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,16 @@
+import sys
+
+import pytest
+
+import agent0
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    # agent works relative to the working directory, where python_tools is imported as a package
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for k in [k for k in sys.modules if k == 'python_tools' or k.startswith('python_tools.')]:
+        monkeypatch.delitem(sys.modules, k)
+    agent0._tool_catalogs.clear()
+    return tmp_path
@@ -0,0 +1,67 @@
+import os
+import time
+
+import agent0
+from agent0 import find_artifacts, gc_artifacts, run_code
+
+
+def list_objects():
+    return sorted(name for _, _, names in os.walk(os.path.join(agent0.artifacts_dir, 'objects')) for name in names)
+
+
+def test_scripts_deduped_and_indexed(work_dir):
+    assert run_code('echo same', case='bash', iteration=1)['stdout'] == 'same\n'
+    assert run_code('echo same', case='bash', iteration=2)['stdout'] == 'same\n'
+    assert run_code('print("same")', case='python', iteration=2)['stdout'] == 'same\n'
+    assert len(list_objects()) == 2
+    records = find_artifacts(case='bash')
+    assert [x['iteration'] for x in records] == [1, 2]
+    assert records[0]['hash'] == records[1]['hash']
+    assert [x['case'] for x in find_artifacts(iteration=2, run_id=agent0.runid)] == ['bash', 'python']
+
+
+def test_patch_twice(work_dir):
+    with open('hello.txt', 'wt') as f:
+        f.write('hello\n')
+    run_code('--- hello.txt\n+++ hello.txt\n@@ -1 +1 @@\n-hello\n+world\n', case='patch')
+    ret = run_code('--- hello.txt\n+++ hello.txt\n@@ -1 +1 @@\n-world\n+again\n', case='patch')
+    assert ret['exception'] is None
+    with open('hello.txt', 'rt') as f:
+        assert f.read() == 'again\n'
+    assert [x['case'] for x in find_artifacts()] == ['patch', 'patch']
+
+
+def test_gc_artifacts(work_dir):
+    for i in range(4):
+        run_code('echo %d' % i, case='bash', iteration=i)
+    objects = [os.path.join(root, name)
+               for root, _, names in os.walk(os.path.join(agent0.artifacts_dir, 'objects')) for name in names]
+    now = time.time()
+    for i, name in enumerate(sorted(objects, key=lambda x: open(x).read())):
+        os.utime(name, (now - 1000 * (4 - i), now - 1000 * (4 - i)))
+
+    # by age, 'echo 0' was last used 4000 seconds ago
+    assert len(gc_artifacts(max_age=3500)) == 1
+    assert len(list_objects()) == 3
+    assert [x['iteration'] for x in find_artifacts()] == [1, 2, 3]
+
+    # by size, oldest go first, recently used ones are kept regardless
+    assert len(gc_artifacts(max_bytes=1)) == 3
+    run_code('echo new', case='bash', iteration=5)
+    assert len(gc_artifacts(max_bytes=1)) == 0
+    assert [x['iteration'] for x in find_artifacts()] == [5]
+
+
+def test_output_log_removed_by_gc_during_capture(work_dir, monkeypatch):
+    monkeypatch.setattr(agent0, 'artifact_min_age', 0)
+    read_fds, write_fds = zip(os.pipe(), os.pipe())
+    capture = agent0.start_capture(read_fds, case='bash')
+    for fd in write_fds:
+        os.write(fd, b'short\n')
+        os.close(fd)
+    for reader in capture['readers']:
+        reader.join()
+    # another agent collected the spilled logs before this one finished
+    assert len(gc_artifacts(max_bytes=0)) == 2
+    ret = agent0.finish_capture(capture, {})
+    assert ret == dict(stdout='short\n', stderr='short\n')
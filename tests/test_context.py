@@ -0,0 +1,69 @@
+from agent0 import count_message_tokens, count_tokens, elide_text, fit_messages
+
+
+def make_messages(n, size=400):
+    messages = [dict(role='system', content='system prompt')]
+    for i in range(n):
+        messages.append(dict(role='assistant' if i % 2 else 'user', content=('turn %d ' % i) * size))
+    return messages
+
+
+def test_fit_messages_keeps_recent_within_budget():
+    messages = make_messages(20)
+    fitted, stats = fit_messages(messages, budget=5000)
+    assert fitted[0] is messages[0]
+    assert fitted[-1] is messages[-1]
+    assert stats['prompt_tokens'] == count_message_tokens(fitted) <= 5000
+    assert stats['dropped'] > 0
+    assert stats['messages'] + stats['dropped'] == len(messages)
+    # kept messages are the most recent ones, in order
+    assert fitted[1:] == messages[-(len(fitted) - 1):]
+
+
+def test_fit_messages_elides_large_outputs(monkeypatch):
+    import agent0
+
+    monkeypatch.setattr(agent0, 'max_message_tokens', 200)
+    messages = make_messages(3, size=2000)
+    fitted, stats = fit_messages(messages, budget=100000)
+    assert stats['dropped'] == 0
+    assert stats['elided'] == 2
+    assert 'tokens elided' in fitted[1]['content']
+    assert fitted[1]['content'].startswith('turn 0 ')
+    # latest message is kept whole while it fits
+    assert fitted[-1] is messages[-1]
+
+
+def test_elide_text_head_tail():
+    text = 'start ' + 'middle ' * 5000 + 'end'
+    short = elide_text(text, 100)
+    assert short.startswith('start ')
+    assert short.endswith('end')
+    assert count_tokens(short) < 150
+
+
+def test_measure_prompt_prefix(monkeypatch):
+    import agent0
+    from agent0 import measure_prompt_prefix
+
+    monkeypatch.setattr(agent0, '_prompt_segments', {})
+    first = [dict(role='system', content='stable'), dict(role='user', content='one')]
+    assert measure_prompt_prefix(first)['reused_bytes'] == 0
+    stats = measure_prompt_prefix(first + [dict(role='assistant', content='two')])
+    assert stats['reused_bytes'] == len('system\nstable\nuser\none\n')
+    assert stats['total_bytes'] == stats['reused_bytes'] + len('assistant\ntwo\n')
+
+
+def test_default_budget_fits_full_review(work_dir, monkeypatch):
+    import json
+
+    import agent0
+
+    monkeypatch.setattr(agent0, 'llm_backend', 'replay')
+    monkeypatch.setattr(agent0, 'llm_recording', 'rec.jsonl')
+    with open('rec.jsonl', 'wt') as f:
+        f.write(json.dumps(dict(content='```exit\n```', usage=None)) + '\n')
+    agent0.main_loop()
+    first = next(agent0.read_run_log(run_id=agent0.runid, events=['iteration']))
+    # the iteration 0 review of the agent code is sent whole
+    assert first['context'] == dict(first['context'], dropped=0, elided=0)
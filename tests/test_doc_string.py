@@ -84,3 +84,74 @@ def test_class_stub():
 
     result = extract_object_info(MockClass)
     assert result == expected_class_stub, "The output for the class does not match the expected format."
+
+
+stub_source = '''
+import os
+
+
+class Base:
+    def shared(self, z=None):
+        """Shared method."""
+        return z
+
+
+class Child(Base):
+    def __init__(self, name='x', *args, flag=True, **kwargs):
+        self.name = name
+
+    @staticmethod
+    def helper(a, b=(1, 2)):
+        """
+        Static helper.
+        """
+        return a
+
+    @classmethod
+    def create(cls):
+        return cls()
+
+    @property
+    def size(self):
+        return 0
+
+    async def fetch(self, path='/'):
+        """Fetch path."""
+        return path
+
+
+def _private(x, *, y=-1.5):
+    return x
+
+
+async def run_async(url="http://example.com"):
+    """Run async."""
+    return url
+'''
+
+
+def test_ast_stub_matches_inspect(tmp_path, monkeypatch):
+    import importlib
+    from agent0 import extract_source_info, get_custom_classes_and_functions
+
+    (tmp_path / 'stub_mod.py').write_text(stub_source)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = importlib.import_module('stub_mod')
+    custom_classes, custom_functions = get_custom_classes_and_functions(module)
+    all_custom = {}
+    all_custom.update(custom_classes)
+    all_custom.update(custom_functions)
+
+    infos = extract_source_info(stub_source)
+    assert [x['name'] for x in infos] == list(all_custom)
+    for info in infos:
+        assert info['stub'] == extract_object_info(all_custom[info['name']]), info['name']
+    assert [x['kind'] for x in infos] == ['class', 'class', 'function', 'function']
+
+
+def test_ast_stub_non_literal_default():
+    from agent0 import extract_source_info
+
+    infos = extract_source_info("import os\n\ndef list_dir(path=os.getcwd()):\n    return os.listdir(path)\n")
+    # defaults that are not literals are shown as source, since nothing is evaluated
+    assert infos[0]['stub'].startswith("def list_dir(path=os.getcwd()):\n")
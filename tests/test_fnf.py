@@ -1,3 +1,4 @@
+import os
 
 
 def test_process_fnf():
@@ -32,3 +33,50 @@ def test_process_mnf():
 
     print(stderr_new)
     assert "Did you mean instead: '..python_tools.get_system_info'?" in stderr_new
+
+
+def test_process_fnf_large_dir(work_dir):
+    from agent0 import process_stderr
+
+    os.makedirs('images')
+    for i in range(5000):
+        open(os.path.join('images', 'img_%05d.png' % i), 'w').close()
+    stderr = "FileNotFoundError: [Errno 2] No such file or directory: 'images/img_01234.jpg'"
+    stderr_new, try_again = process_stderr(stderr)
+    assert "Did you mean instead: 'images/img_01234.png'?" in stderr_new
+
+
+def test_process_fnf_missing_dir(work_dir):
+    from agent0 import process_stderr
+
+    os.makedirs(os.path.join('data', 'images'))
+    open(os.path.join('data', 'images', 'cat.png'), 'w').close()
+    stderr = "FileNotFoundError: [Errno 2] No such file or directory: 'data/imagess/cat.png'"
+    stderr_new, try_again = process_stderr(stderr)
+    assert "Directory data/imagess does not exist" in stderr_new
+    assert "Did you mean instead: 'data/images/cat.png'?" in stderr_new
+
+
+def test_process_mnf_missing_dir(work_dir):
+    from agent0 import process_stderr
+
+    os.makedirs('python_tools')
+    open(os.path.join('python_tools', 'get_system_info.py'), 'w').close()
+    stderr = "ModuleNotFoundError: No module named '..python_tools.system_info'"
+    stderr_new, try_again = process_stderr(stderr)
+    assert "Did you mean instead: 'python_tools.get_system_info'?" in stderr_new
+
+
+def test_process_fnf_bare_name(work_dir):
+    from agent0 import process_stderr
+
+    os.makedirs('artifacts')
+    os.makedirs('data_dir')
+    open('data.csv', 'w').close()
+    stderr_new, try_again = process_stderr("FileNotFoundError: [Errno 2] No such file or directory: 'dat.csv'")
+    assert "Did you mean instead: './data.csv'?" in stderr_new
+    # directories and agent storage are not suggested, nor files that are not close
+    stderr_new, try_again = process_stderr("FileNotFoundError: [Errno 2] No such file or directory: 'f.txt'")
+    assert 'Did you mean' not in stderr_new
+    stderr_new, try_again = process_stderr("FileNotFoundError: [Errno 2] No such file or directory: 'artifact'")
+    assert 'Did you mean' not in stderr_new
@@ -0,0 +1,77 @@
+import json
+
+import agent0
+from agent0 import find_imports, find_missing_imports, get_distribution_name, pip_install
+
+
+def test_find_missing_imports(work_dir):
+    (work_dir / 'local_helper.py').write_text('')
+    source = ('import os, json\nimport numpy_not_installed_xyz.linalg\n'
+              'from cv2_not_installed_xyz import imread\nfrom . import sibling\nimport local_helper\n'
+              'def f():\n    import lazy_not_installed_xyz\n'
+              'try:\n    import optional_xyz\nexcept (ValueError, ImportError):\n    import fallback_xyz\n'
+              'try:\n    import required_xyz\nexcept KeyError:\n    pass\n')
+    assert find_imports(source) == {'os', 'json', 'numpy_not_installed_xyz', 'cv2_not_installed_xyz',
+                                    'local_helper', 'lazy_not_installed_xyz', 'fallback_xyz', 'required_xyz'}
+    assert find_missing_imports(source) == ['cv2_not_installed_xyz', 'fallback_xyz', 'lazy_not_installed_xyz',
+                                            'numpy_not_installed_xyz', 'required_xyz']
+    assert get_distribution_name('cv2') == 'opencv-python'
+    assert get_distribution_name('requests') == 'requests'
+
+
+def test_pip_install_batched_with_negative_cache(work_dir, monkeypatch):
+    calls = []
+
+    def fake_run_process(cmd, case='unknown', limit_output=10000, timeout=None):
+        calls.append(cmd[cmd.index('install') + 1:])
+        if 'broken-dist' in cmd:
+            return dict(stdout='', stderr='ERROR: No matching distribution found for broken-dist', exception=None,
+                        returncode=1)
+        return dict(stdout='Successfully installed %s' % ' '.join(cmd[5:]), stderr='', exception=None, returncode=0)
+
+    monkeypatch.setattr(agent0, 'run_process', fake_run_process)
+    monkeypatch.setattr(agent0, '_pip_failed', {})
+    monkeypatch.setattr(agent0, 'pip_offline', True)
+    monkeypatch.setitem(agent0.import_to_distribution, 'broken', 'broken-dist')
+
+    ret = pip_install(['PIL', 'yaml'])
+    assert ret == dict(installed=['PIL', 'yaml'], failed={})
+    assert calls == [['--disable-pip-version-check', '--no-index', 'pillow', 'PyYAML']]
+
+    calls.clear()
+    ret = pip_install(['PIL', 'broken'])
+    assert ret['installed'] == ['PIL']
+    assert 'broken' in ret['failed']
+    # batch failed, then each was tried alone to find the broken one
+    assert len(calls) == 3
+    with open(agent0.pip_failed_name) as f:
+        assert list(json.load(f)) == ['broken']
+
+    calls.clear()
+    ret = pip_install(['broken'])
+    assert 'broken' in ret['failed']
+    assert calls == []
+
+
+def test_pip_install_failure_from_exit_status(work_dir, monkeypatch):
+    outputs = {'managed-dist': 'error: externally-managed-environment\n', 'silent-dist': ''}
+
+    def fake_run_process(cmd, case='unknown', limit_output=10000, timeout=None):
+        return dict(stdout='', stderr=outputs[cmd[-1]], exception=None, returncode=1)
+
+    monkeypatch.setattr(agent0, 'run_process', fake_run_process)
+    monkeypatch.setattr(agent0, '_pip_failed', {})
+    monkeypatch.setitem(agent0.import_to_distribution, 'managed', 'managed-dist')
+    monkeypatch.setitem(agent0.import_to_distribution, 'silent', 'silent-dist')
+    assert pip_install(['managed']) == dict(installed=[], failed=dict(managed='error: externally-managed-environment'))
+    assert pip_install(['silent']) == dict(installed=[], failed=dict(silent='pip exited with status 1'))
+    with open(agent0.pip_failed_name) as f:
+        assert sorted(json.load(f)) == ['managed', 'silent']
+
+    # another agent sharing the file installed managed meanwhile and found other broken
+    with open(agent0.pip_failed_name, 'wt') as f:
+        json.dump(dict(other=dict(error='ERROR: broken', time=agent0.time.time())), f)
+    monkeypatch.setattr(agent0, 'pip_failed_ttl', 0)
+    pip_install(['silent'])
+    with open(agent0.pip_failed_name) as f:
+        assert sorted(json.load(f)) == ['other', 'silent']
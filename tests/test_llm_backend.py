@@ -0,0 +1,82 @@
+import json
+import threading
+import types
+import urllib.request
+
+import agent0
+from agent0 import get_llm_standin, get_recording_client, get_replay_client
+
+from test_stream import StreamClient
+
+
+def completion(text):
+    message = types.SimpleNamespace(content=text)
+    usage = types.SimpleNamespace(prompt_tokens=10, completion_tokens=2, total_tokens=12)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+
+def test_record_and_replay(work_dir):
+    messages = [dict(role='system', content='hi')]
+    client = agent0.make_client(lambda **kwargs: completion("```bash\necho one\n```"))
+    recorder = get_recording_client(client, 'rec.jsonl')
+    assert recorder.chat.completions.create(messages=messages).choices[0].message.content == "```bash\necho one\n```"
+
+    usage = types.SimpleNamespace(prompt_tokens=5, completion_tokens=3, total_tokens=8)
+    recorder = get_recording_client(StreamClient("```bash\necho two\n```", usage=usage), 'rec.jsonl')
+    chunks = list(recorder.chat.completions.create(messages=messages, stream=True))
+    assert ''.join(x.choices[0].delta.content for x in chunks if x.choices) == "```bash\necho two\n```"
+
+    replay = get_replay_client('rec.jsonl')
+    response = replay.chat.completions.create(messages=messages)
+    assert response.choices[0].message.content == "```bash\necho one\n```"
+    assert response.usage.total_tokens == 12
+    chunks = list(replay.chat.completions.create(messages=messages, stream=True,
+                                                 stream_options=dict(include_usage=True)))
+    assert ''.join(x.choices[0].delta.content for x in chunks if x.choices) == "```bash\necho two\n```"
+    assert chunks[-1].usage.total_tokens == 8
+    assert replay.replay['mismatches'] == 0
+    # exhausted recording tells the agent to exit
+    assert replay.chat.completions.create(messages=[]).choices[0].message.content == "```exit\n```"
+
+
+def test_main_loop_replay_timings(work_dir, monkeypatch, capsys):
+    with open('rec.jsonl', 'wt') as f:
+        f.write(json.dumps(dict(content="```bash\necho replayed\n```", usage=None)) + '\n')
+    monkeypatch.setattr(agent0, 'llm_backend', 'replay')
+    monkeypatch.setattr(agent0, 'llm_recording', 'rec.jsonl')
+    agent0.main_loop()
+    assert 'stdout: replayed' in capsys.readouterr().out
+    iterations = list(agent0.read_run_log(run_id=agent0.runid, events=['iteration']))
+    assert len(iterations) == 3
+    assert set(iterations[1]['timings']) >= {'llm', 'blocks', 'catalog', 'prompt', 'state'}
+
+
+def test_llm_standin(work_dir):
+    with open('rec.jsonl', 'wt') as f:
+        usage = dict(prompt_tokens=5, completion_tokens=3, total_tokens=8)
+        f.write(json.dumps(dict(content="```bash\necho one\n```", usage=usage)) + '\n')
+        f.write(json.dumps(dict(content="```bash\necho two\n```", usage=usage)) + '\n')
+    server = get_llm_standin('rec.jsonl', port=0, latency='0')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/v1/chat/completions' % server.server_address[1]
+    try:
+        def post(request):
+            request = urllib.request.Request(url, data=json.dumps(request).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.read().decode()
+
+        response = json.loads(post(dict(model='gpt-4o', messages=[])))
+        assert response['choices'][0]['message']['content'] == "```bash\necho one\n```"
+        assert response['usage']['total_tokens'] == 8
+
+        events = post(dict(model='gpt-4o', messages=[], stream=True, stream_options=dict(include_usage=True)))
+        data = [x[len('data: '):] for x in events.split('\n\n') if x.startswith('data: ')]
+        assert data[-1] == '[DONE]'
+        chunks = [json.loads(x) for x in data[:-1]]
+        assert ''.join(x['choices'][0]['delta'].get('content', '') for x in chunks if x['choices']) == \
+            "```bash\necho two\n```"
+        assert chunks[-1]['usage']['total_tokens'] == 8
+    finally:
+        server.shutdown()
+        server.server_close()
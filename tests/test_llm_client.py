@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+import types
+import urllib.request
+
+import pytest
+
+import agent0
+from agent0 import get_llm_standin, get_resilient_client, make_client
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    monkeypatch.setattr(agent0, '_metrics', dict(spans={}, counters=agent0.collections.Counter()))
+    monkeypatch.setattr(agent0, 'llm_backoff', 0.001)
+    return agent0._metrics
+
+
+def test_retry_transient_errors(metrics):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        if len(calls) < 3:
+            raise APIConnectionError("connection reset")
+        return 'response'
+
+    client = get_resilient_client(make_client(create), retries=3)
+    assert client.chat.completions.create(model='gpt-4o') == 'response'
+    assert len(calls) == 3
+    assert metrics['counters'][('retries', (('case', 'llm'),))] == 2
+    assert metrics['spans'][('llm_request', (('outcome', 'error'),))]['count'] == 2
+
+
+def test_no_retry_other_errors(metrics):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        raise ValueError("bad request")
+
+    client = get_resilient_client(make_client(create), retries=3)
+    with pytest.raises(ValueError):
+        client.chat.completions.create()
+    assert len(calls) == 1
+
+
+def test_timeout(metrics):
+    client = get_resilient_client(make_client(lambda **kwargs: time.sleep(1)), timeout=0.1, retries=0)
+    start = time.time()
+    with pytest.raises(TimeoutError):
+        client.chat.completions.create()
+    assert time.time() - start < 0.5
+
+
+def test_hedged_request_against_standin(work_dir, metrics, monkeypatch):
+    with open('rec.jsonl', 'wt') as f:
+        for content, latency in [('warm up', 0.01), ('slow', 1.0), ('fast', 0.01)]:
+            f.write(json.dumps(dict(content=content, usage=None, latency=latency, duration=latency)) + '\n')
+    server = get_llm_standin('rec.jsonl', port=0, latency='recorded')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/v1/chat/completions' % server.server_address[1]
+
+    def create(**kwargs):
+        request = urllib.request.Request(url, data=json.dumps(kwargs).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            message = json.loads(response.read())['choices'][0]['message']
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(**message))])
+
+    monkeypatch.setattr(agent0, 'llm_hedge_min_samples', 1)
+    client = get_resilient_client(make_client(create), hedge=True)
+    try:
+        assert client.chat.completions.create(messages=[]).choices[0].message.content == 'warm up'
+        start = time.time()
+        # the first request gets the slow response, the duplicate sent after the p95 latency gets the fast one
+        assert client.chat.completions.create(messages=[]).choices[0].message.content == 'fast'
+        assert time.time() - start < 0.5
+        assert metrics['counters'][('llm_hedged', ())] == 1
+        assert metrics['counters'][('llm_hedge_wins', ())] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import agent0
+
+
+@pytest.fixture
+def metrics(work_dir, monkeypatch):
+    monkeypatch.setattr(agent0, '_metrics', dict(spans={}, counters=agent0.collections.Counter(), maxima={}))
+    return agent0._metrics
+
+
+def test_run_code_spans_and_counters(metrics):
+    agent0.run_code('seq 1 5000', case='bash', limit_output=100)
+    (key, stats), = [(k, v) for k, v in metrics['spans'].items() if k[0] == 'run_code']
+    assert key == ('run_code', (('case', 'bash'),))
+    assert stats['count'] == 1 and stats['sum'] > 0
+    assert ('process_stderr', ()) in metrics['spans']
+    assert metrics['counters'][('truncations', (('kind', 'stdout'),))] == 1
+    assert metrics['maxima'][('max_rss_mb', (('case', 'bash'),))] > 0
+
+
+def test_max_metric_keeps_peak(metrics, monkeypatch):
+    monkeypatch.setattr(agent0, 'metrics_format', 'prometheus')
+    for value in [10.0, 30.5, 20.0, None]:
+        agent0.max_metric('max_rss_mb', value, case='python')
+    assert metrics['maxima'] == {('max_rss_mb', (('case', 'python'),)): 30.5}
+    agent0.write_metrics(1)
+    with open(agent0.get_metrics_name(), 'rt') as f:
+        text = f.read()
+    labels = 'agent_id="%s",run_id="%s"' % (agent0.myid, agent0.runid)
+    assert '# TYPE agent0_max_rss_mb gauge\nagent0_max_rss_mb{%s,case="python"} 30.5\n' % labels in text
+
+
+def test_write_metrics_prometheus(metrics, monkeypatch):
+    monkeypatch.setattr(agent0, 'metrics_format', 'prometheus')
+    agent0.observe_span('llm', 0.5, model='gpt-4o')
+    agent0.count_metric('tokens', 100, kind='prompt')
+    agent0.write_metrics(1)
+    with open(agent0.get_metrics_name(), 'rt') as f:
+        text = f.read()
+    labels = 'agent_id="%s",run_id="%s"' % (agent0.myid, agent0.runid)
+    assert 'agent0_span_seconds_bucket{%s,span="llm",model="gpt-4o",le="0.1"} 0' % labels in text
+    assert 'agent0_span_seconds_bucket{%s,span="llm",model="gpt-4o",le="1"} 1' % labels in text
+    assert 'agent0_span_seconds_count{%s,span="llm",model="gpt-4o"} 1' % labels in text
+    assert 'agent0_tokens_total{%s,kind="prompt"} 100' % labels in text
+
+
+def test_write_metrics_jsonl(metrics, monkeypatch):
+    monkeypatch.setattr(agent0, 'metrics_format', 'jsonl')
+    agent0.count_metric('retries', case='python')
+    agent0.write_metrics(1)
+    agent0.count_metric('retries', case='python')
+    agent0.write_metrics(2)
+    with open(agent0.get_metrics_name(), 'rt') as f:
+        records = [json.loads(line) for line in f]
+    assert [x['iteration'] for x in records] == [1, 2]
+    assert records[-1]['counters'] == [dict(name='retries', labels=dict(case='python'), value=2)]
+    assert records[-1]['agent_id'] == agent0.myid
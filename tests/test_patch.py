@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+import agent0
+from agent0 import apply_patch, parse_patch, run_code
+
+source = 'import os\n\n\ndef first(x):\n    return x\n\n\ndef second(y):\n    return y\n'
+
+
+@pytest.fixture
+def module(work_dir):
+    with open('mod.py', 'wt') as f:
+        f.write(source)
+    return 'mod.py'
+
+
+def read(name):
+    with open(name, 'rt') as f:
+        return f.read()
+
+
+def test_parse_lenient():
+    files = parse_patch('text before\n--- a/mod.py\t2024-01-01\n+++ b/mod.py\n@@ -4,2 +4,2 @@ def first\n'
+                        ' def first(x):\n-    return x\n+    return 2 * x\n\n@@\n+# end\n')
+    assert [(x['old'], x['new']) for x in files] == [('a/mod.py', 'b/mod.py')]
+    first, second = files[0]['hunks']
+    assert first['start'] == 4
+    assert first['lines'] == [(' ', 'def first(x):'), ('-', '    return x'), ('+', '    return 2 * x'), (' ', '')]
+    assert second['start'] is None
+
+
+def test_apply_with_offset_and_git_prefix(module):
+    ret = run_code('--- a/mod.py\n+++ b/mod.py\n@@ -1,2 +1,2 @@\n def second(y):\n-    return y\n+    return 2 * y\n',
+                   case='patch')
+    assert ret['exception'] is None
+    assert ret['stdout'] == 'patching file mod.py\nHunk #1 succeeded at 8 (offset 7 lines).'
+    assert read(module) == source.replace('return y', 'return 2 * y')
+
+
+def test_fuzz_is_bounded(module, monkeypatch):
+    monkeypatch.setattr(agent0, 'patch_max_fuzz', 1)
+    # the trailing context line is wrong, which one line of fuzz allows
+    patch = '--- mod.py\n+++ mod.py\n@@ -4,3 +4,3 @@\n def first(x):\n-    return x\n+    return 3\n %s\n'
+    assert apply_patch(patch % 'wrong', dry_run=True)['stdout'].endswith('(fuzz 1).')
+    two_wrong = '--- mod.py\n+++ mod.py\n@@ -4,4 +4,4 @@\n def first(x):\n-    return x\n+    return 3\n wrong\n wrong\n'
+    ret = apply_patch(two_wrong)
+    assert ret['exception'] == 'Patch not applied, no files were changed'
+    assert ret['stderr'] == ("mod.py: Hunk #1 FAILED at 4: closest at line 4 (2 of 4 lines match), "
+                             "first difference at line 6: file has '', hunk has 'wrong'.")
+    assert read(module) == source
+
+
+def test_syntax_error_rejected_before_writing(module):
+    ret = apply_patch('--- mod.py\n+++ mod.py\n@@ -4,2 +4,2 @@\n def first(x):\n-    return x\n+    return (x\n')
+    assert ret['exception'] == 'Patch not applied, no files were changed'
+    assert ret['stderr'].startswith('mod.py: would not parse after the patch, line 5:')
+    assert ret['stderr'].endswith('\n    return (x')
+    assert read(module) == source
+
+
+def test_all_or_nothing_and_already_applied(module):
+    with open('other.txt', 'wt') as f:
+        f.write('a\nb\n')
+    patch = ('--- other.txt\n+++ other.txt\n@@ -1,2 +1,2 @@\n a\n-b\n+c\n'
+             '--- mod.py\n+++ mod.py\n@@ -4,2 +4,2 @@\n def first(x):\n-    return x\n+    return 4\n')
+    assert apply_patch(patch, dry_run=True) == dict(stdout='checking file other.txt\nchecking file mod.py',
+                                                    stderr=None, exception=None)
+    assert read('other.txt') == 'a\nb\n'
+    assert apply_patch(patch)['exception'] is None
+    assert read('other.txt') == 'a\nc\n'
+
+    # applying again does not reverse it, unlike patch --batch
+    with open('other.txt', 'wt') as f:
+        f.write('a\nb\n')
+    ret = apply_patch(patch)
+    assert ret['stderr'] == 'mod.py: Hunk #1 FAILED at 4: looks already applied, its result is in the file.'
+    assert read('other.txt') == 'a\nb\n'
+
+
+def test_new_file_and_missing_file(work_dir):
+    assert apply_patch('--- /dev/null\n+++ b/pkg/new.py\n@@ -0,0 +1,2 @@\n+def new():\n+    pass\n')['exception'] is None
+    assert read(os.path.join('pkg', 'new.py')) == 'def new():\n    pass\n'
+    ret = apply_patch('--- missing.py\n+++ missing.py\n@@ -1 +1 @@\n-a\n+b\n')
+    assert ret['stderr'] == 'missing.py: no such file, hunks were not applied'
+    assert apply_patch('not a diff')['exception'] == 'Patch not applied'
+
+
+def test_sections_for_same_file_all_applied(work_dir):
+    with open('f.txt', 'wt') as f:
+        f.write(''.join(x + '\n' for x in 'abcdefgh'))
+    patch = ('--- a/f.txt\n+++ b/f.txt\n@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n'
+             '--- a/f.txt\n+++ b/f.txt\n@@ -6,3 +6,3 @@\n f\n-g\n+G\n h\n')
+    ret = apply_patch(patch)
+    assert ret['exception'] is None
+    assert read('f.txt') == 'a\nB\nc\nd\ne\nf\nG\nh\n'
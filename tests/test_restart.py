@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+import agent0
+
+
+@pytest.fixture
+def replay(work_dir, monkeypatch):
+    monkeypatch.setenv('AGENT0_ID', str(agent0.myid))
+    monkeypatch.setattr(agent0, 'llm_backend', 'replay')
+    monkeypatch.setattr(agent0, 'llm_recording', 'rec.jsonl')
+
+    def record(*contents):
+        with open('rec.jsonl', 'wt') as f:
+            for content in contents:
+                f.write(json.dumps(dict(content=content, usage=None)) + '\n')
+    return record
+
+
+def test_restart_reload_keeps_history(replay, capsys):
+    replay("```bash\necho before\n```\n```restart\n```", "```bash\necho after\n```")
+    agent0.main_loop()
+    out = capsys.readouterr().out
+    assert 'Reloaded %s in place as agent %s' % (agent0.__file__, agent0.myid + 1) in out
+    assert 'stdout: after' in out
+
+    # next generation carried on from the same history, without another review
+    restart, = agent0.read_run_log(run_id=agent0.runid, events=['restart'])
+    assert restart['agent'] == agent0.myid + 1
+    llm = list(agent0.read_run_log(run_id=restart['agent_run_id'], events=['llm']))
+    assert [x['iteration'] for x in llm] == [2, 3]
+    iterations = list(agent0.read_run_log(run_id=restart['agent_run_id'], events=['iteration']))
+    assert iterations[0]['context']['messages'] > 3
+
+
+def test_restart_subprocess_fallback(replay, monkeypatch, capsys):
+    monkeypatch.setenv('AGENT0_LLM_BACKEND', 'replay')
+    monkeypatch.setenv('AGENT0_LLM_RECORDING', 'missing.jsonl')
+    monkeypatch.setattr(agent0, 'load_agent_module', lambda: (None, 'SyntaxError: bad patch'))
+    replay("```restart\n```")
+    agent0.main_loop()
+    out = capsys.readouterr().out
+    assert 'Reload failed, restarting as a subprocess' in out
+    block, = [x for x in agent0.read_run_log(run_id=agent0.runid, events=['block']) if x['case'] == 'restart']
+    assert block['exception'] is None
+
+
+def test_exit_after_reloads_ends_agent(replay, monkeypatch, capsys):
+    modules = []
+    load_agent_module = agent0.load_agent_module
+
+    def load(*args):
+        module, error = load_agent_module(*args)
+        modules.append(module)
+        return module, error
+
+    monkeypatch.setattr(agent0, 'load_agent_module', load)
+    replay("```restart\n```", "```restart\n```", "```exit\n```", "```bash\necho zz_after_exit\n```")
+    agent0.main_loop()
+    # generations run one after the other, exit does not return to the previous one
+    assert "zz_after_exit" not in capsys.readouterr().out
+    assert len(modules) == 1
+    restarts = list(agent0.read_run_log(events=['restart']))
+    assert len(restarts) == 2
+
+    # the kept client reports to the metrics of the generation using it
+    first = ('llm_request', (('outcome', 'ok'),))
+    assert modules[0]._metrics['spans'][first]['count'] >= 1
@@ -0,0 +1,68 @@
+import pytest
+
+import agent0
+from agent0 import is_readonly_bash, run_code
+
+
+@pytest.mark.parametrize('code,readonly', [
+    ('ls -la', True),
+    ('uname -a; nproc && free -h | head -5', True),
+    ('pip list 2>&1 | grep numpy', True),
+    ('find . -name "*.py" 2>/dev/null | head', True),
+    ('pip install numpy', False),
+    ('ls > files.txt', False),
+    ('echo $(rm -rf x)', False),
+    ('find . -name "*.pyc" -delete', False),
+    ('touch x', False),
+    ('git branch', True),
+    ('git remote', True),
+    ('git branch feature', False),
+    ('git remote add origin url', False),
+    ('git diff --output=x.diff', False),
+    ('env rm -rf x', False),
+    ('find . -fprintf out.txt "%p"', False),
+    ('find . -fls out.txt', False),
+    ('find . -fprint0 out.txt', False),
+    ('sort -o sorted.txt in.txt', False),
+    ('sort -ro sorted.txt in.txt', False),
+    ('sort -r in.txt', True),
+    ('tree -o tree.txt', False),
+    ('uniq in.txt out.txt', False),
+    ('hostname', True),
+    ('hostname newname', False),
+])
+def test_is_readonly_bash(code, readonly):
+    assert is_readonly_bash(code) == readonly
+
+
+def test_result_cache_hits(work_dir, monkeypatch):
+    monkeypatch.setattr(agent0, 'result_cache_enabled', True)
+    monkeypatch.setattr(agent0, '_result_cache', agent0.collections.OrderedDict())
+    first = run_code('ls; cat /proc/uptime', case='bash', iteration=1)
+    second = run_code('ls; cat /proc/uptime', case='bash', iteration=2)
+    assert 'cached' not in first
+    assert second['cached'].startswith('Reused result')
+    assert second['stdout'] == first['stdout']
+    assert second['iteration'] == 2
+
+    # blocks that write are never cached
+    run_code('echo 1 >> counter.txt', case='bash')
+    ret = run_code('echo 1 >> counter.txt', case='bash')
+    assert 'cached' not in ret
+    assert open('counter.txt').read() == '1\n1\n'
+
+    # cwd is part of the fingerprint
+    (work_dir / 'sub').mkdir()
+    monkeypatch.chdir(work_dir / 'sub')
+    assert 'cached' not in run_code('ls; cat /proc/uptime', case='bash')
+
+
+def test_result_cache_cleared_by_writes(work_dir, monkeypatch):
+    monkeypatch.setattr(agent0, 'result_cache_enabled', True)
+    monkeypatch.setattr(agent0, '_result_cache', agent0.collections.OrderedDict())
+    run_code('ls', case='bash')
+    assert 'cached' in run_code('ls', case='bash')
+    run_code('open("new_file.txt", "wt").close()', case='python')
+    ret = run_code('ls', case='bash')
+    assert 'cached' not in ret
+    assert 'new_file.txt' in ret['stdout']
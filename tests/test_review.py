@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+import agent0
+from agent0 import fit_messages, get_changed_functions, get_review, update_review
+
+source = '''import os
+
+LIMIT = 1
+
+
+def first(x):
+    return x
+
+
+@staticmethod
+def second(y):
+    return y
+'''
+
+
+@pytest.fixture
+def review(work_dir, monkeypatch):
+    monkeypatch.setattr(agent0, '_review', {})
+    monkeypatch.setattr(agent0, 'review_max_change', 2.0)
+    with open('agent.py', 'wt') as f:
+        f.write(source)
+    return agent0._review
+
+
+def send(text, history):
+    # the review goes into the next user message, which is sent with the history
+    message = dict(role='user', content=text)
+    history.append(message)
+    update_review(message, history)
+    return message
+
+
+def test_diff_after_full_review(review):
+    history = []
+    assert '```python\n' + source + '```' in send(get_review('agent.py'), history)['content']
+    assert send(get_review('agent.py'), history)['content'] == 'The agent code agent.py is unchanged since the last review.'
+
+    with open('agent.py', 'wt') as f:
+        f.write(source.replace('return y', 'return 2 * y'))
+    text = send(get_review('agent.py'), history)['content']
+    assert text.startswith('Changes to the agent code agent.py since the last review.\n```diff\n')
+    assert '-    return y\n+    return 2 * y\n' in text
+    assert 'def first' not in text
+    assert len(review['messages']) == 3
+
+    # the full review is elided from the prompt, so the next review has to be of the whole file again
+    update_review(history[-1], [dict(history[0], content='elided'), *history[1:]])
+    assert review == {}
+    assert '```python\n' in get_review('agent.py')
+
+
+def test_changed_functions(review, monkeypatch):
+    monkeypatch.setattr(agent0, 'review_mode', 'functions')
+    history = []
+    send(get_review('agent.py'), history)
+    with open('agent.py', 'wt') as f:
+        f.write(source.replace('return y', 'return 2 * y').replace('def first(x):\n    return x\n\n\n', '')
+                + '\n\ndef third():\n    pass\n')
+    text = get_review('agent.py')
+    assert text.startswith('Functions of the agent code agent.py changed since the last review.\n```python\n')
+    assert '@staticmethod\ndef second(y):\n    return 2 * y\n' in text
+    assert 'def third():' in text
+    assert '# removed: first\n' in text
+    assert 'LIMIT' not in text
+
+
+def test_changed_functions_syntax_error():
+    assert get_changed_functions(source, 'def broken(:\n') is None
+    assert get_changed_functions(source, source) == ''
+
+
+def test_large_changes_sent_in_full(review, monkeypatch):
+    monkeypatch.setattr(agent0, 'review_max_change', 0.1)
+    send(get_review('agent.py'), [])
+    with open('agent.py', 'wt') as f:
+        f.write(source.replace('y', 'z'))
+    assert '```python\n' in get_review('agent.py')
+    assert review['pending'] == 'full'
+
+
+def test_fit_messages_keeps_reviews_whole(monkeypatch):
+    monkeypatch.setattr(agent0, 'max_message_tokens', 50)
+    messages = [dict(role='system', content='system'), dict(role='user', content='code ' * 500),
+                dict(role='user', content='other ' * 500), dict(role='user', content='latest')]
+    fitted, stats = fit_messages(messages, budget=10000, keep=[messages[1]])
+    assert fitted[1] is messages[1]
+    assert fitted[2] is not messages[2]
+    assert stats['elided'] == 1
+
+
+def test_fit_messages_sends_kept_latest_whole(capsys):
+    messages = [dict(role='system', content='system'), dict(role='user', content='old'),
+                dict(role='user', content='code ' * 500)]
+    fitted, stats = fit_messages(messages, budget=100, keep=[messages[-1]])
+    assert fitted == [messages[0], messages[-1]]
+    assert stats == dict(prompt_tokens=stats['prompt_tokens'], messages=2, dropped=1, elided=0)
+    assert 'it is sent whole' in capsys.readouterr().out
+
+
+def test_main_loop_review_again(work_dir, monkeypatch, capsys):
+    monkeypatch.setattr(agent0, 'context_token_budget', 200000)
+    monkeypatch.setattr(agent0, 'max_message_tokens', 1000)
+    monkeypatch.setattr(agent0, 'llm_backend', 'replay')
+    monkeypatch.setattr(agent0, 'llm_recording', 'rec.jsonl')
+    with open('rec.jsonl', 'wt') as f:
+        f.write(json.dumps(dict(content='```review\n```', usage=None)) + '\n')
+    agent0.main_loop()
+    blocks = [x for x in agent0.read_run_log(run_id=agent0.runid, events=['block']) if x['case'] == 'review']
+    assert blocks[0]['stdout'].startswith('The agent code %s the user is having you run.' % agent0.__file__)
+    assert blocks[1]['stdout'] == 'The agent code %s is unchanged since the last review.' % agent0.__file__
+    iterations = list(agent0.read_run_log(run_id=agent0.runid, events=['iteration']))
+    # the full review is still in the prompt as is
+    assert iterations[1]['context']['elided'] == 0
+
+
+def test_main_loop_review_again_default_budget(work_dir, monkeypatch):
+    monkeypatch.setattr(agent0, 'llm_backend', 'replay')
+    monkeypatch.setattr(agent0, 'llm_recording', 'rec.jsonl')
+    with open('rec.jsonl', 'wt') as f:
+        f.write(json.dumps(dict(content='```review\n```', usage=None)) + '\n')
+    agent0.main_loop()
+    blocks = [x for x in agent0.read_run_log(run_id=agent0.runid, events=['block']) if x['case'] == 'review']
+    assert blocks[1]['stdout'] == 'The agent code %s is unchanged since the last review.' % agent0.__file__
+    iterations = list(agent0.read_run_log(run_id=agent0.runid, events=['iteration']))
+    assert [x['context']['elided'] for x in iterations[:2]] == [0, 0]
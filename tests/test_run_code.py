@@ -0,0 +1,94 @@
+import os
+import time
+
+from agent0 import run_code
+
+
+def test_run_code_head_tail(work_dir):
+    ret = run_code('seq 1 100000', case='bash', limit_output=100)
+    assert ret['stdout'].startswith('1\n2\n3\n')
+    assert ret['stdout'].endswith('99999\n100000\n')
+    assert ret['stdout_truncated'] == len(''.join('%d\n' % i for i in range(1, 100001))) - 100
+    with open(ret['stdout_log'], 'rt') as f:
+        assert f.read().splitlines()[-1] == '100000'
+    assert 'stderr_truncated' not in ret
+
+
+def test_run_code_timeout(work_dir):
+    t0 = time.time()
+    ret = run_code('echo started; sleep 30 & sleep 30', case='bash', timeout=1)
+    assert time.time() - t0 < 10
+    assert ret['stdout'] == 'started\n'
+    assert 'Timeout' in ret['exception']
+
+
+def test_run_code_small_output_no_log(work_dir):
+    ret = run_code('print("hi")', case='python')
+    assert ret['stdout'] == 'hi\n'
+    assert 'stdout_log' not in ret
+    assert os.listdir(os.path.join('logs', 'python')) == []
+
+
+def test_run_code_warm_fork(work_dir, monkeypatch):
+    import agent0
+
+    monkeypatch.setattr(agent0, 'python_backend', 'fork')
+    try:
+        ret = run_code('import os, sys\nprint(os.getcwd() == %r, __name__)\nsys.exit("bad")' % os.getcwd(),
+                       case='python')
+        assert ret['stdout'] == 'True __main__\n'
+        assert ret['stderr'] == 'bad\n'
+        ret = run_code('import time\ntime.sleep(30)', case='python', timeout=1)
+        assert 'Timeout' in ret['exception']
+    finally:
+        agent0.stop_warm_worker()
+
+
+def test_run_code_resource_usage(work_dir):
+    ret = run_code('x = bytearray(50 * 1024 * 1024)\nsum(range(10 ** 6))', case='python')
+    assert ret['returncode'] == 0
+    assert ret['cpu_time'] > 0
+    assert ret['max_rss_mb'] > 50
+    assert ret['wall_time'] >= ret['cpu_time'] / 2
+    assert run_code('exit 3', case='bash')['returncode'] == 3
+
+
+def test_run_code_rlimits(work_dir, monkeypatch):
+    import agent0
+
+    monkeypatch.setitem(agent0.case_rlimits, 'python', dict(cpu=1, open_files=20))
+    ret = run_code('while True:\n    pass', case='python', timeout=30)
+    assert 'SIGXCPU' in ret['exception']
+    assert 'cpu limit of 1 seconds' in ret['exception']
+    ret = run_code('files = [open(__file__) for _ in range(50)]', case='python')
+    assert 'Too many open files' in ret['stderr']
+
+    monkeypatch.setattr(agent0, 'python_backend', 'fork')
+    try:
+        ret = run_code('import resource\nprint(resource.getrlimit(resource.RLIMIT_NOFILE)[0])', case='python')
+        assert ret['stdout'] == '20\n'
+        assert ret['cpu_time'] >= 0
+    finally:
+        agent0.stop_warm_worker()
+
+
+def test_run_code_warm_worker_start_timeout(work_dir, monkeypatch):
+    import agent0
+
+    os.makedirs('python_tools')
+    with open(os.path.join('python_tools', 'slow_tool.py'), 'wt') as f:
+        f.write('import os\nimport time\n\ntime.sleep(float(os.getenv("SLOW_IMPORT", "0")))\n\n\n'
+                'def slow_tool():\n    """\n    Slow to import.\n    """\n')
+    assert agent0.get_tool_imports(validate=True)[1] == {}
+    monkeypatch.setenv('SLOW_IMPORT', '30')
+    monkeypatch.setattr(agent0, 'python_backend', 'fork')
+    monkeypatch.setattr(agent0, 'warm_worker_start_timeout', 0.5)
+    monkeypatch.setattr(agent0, '_warm_worker', {})
+    try:
+        t0 = time.time()
+        assert run_code('print("hi")', case='python')['stdout'] == 'hi\n'
+        assert run_code('print("again")', case='python')['stdout'] == 'again\n'
+        # gave up on the worker once, not once per block
+        assert time.time() - t0 < 5
+    finally:
+        agent0.stop_warm_worker()
@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+import agent0
+from agent0 import run_code_blocks
+
+
+@pytest.fixture(autouse=True)
+def workers(monkeypatch):
+    monkeypatch.setattr(agent0, 'block_workers', 4)
+
+
+def test_blocks_run_concurrently_in_order(work_dir, monkeypatch):
+    # only read-only bash blocks run concurrently, sleep is taken as one here
+    monkeypatch.setattr(agent0, 'readonly_commands', agent0.readonly_commands | {'sleep'})
+    code_blocks = [dict(language='bash', code='sleep 1; echo first'),
+                   dict(language='bash', code='sleep 1; echo second'),
+                   dict(language='bash', code='sleep 1; echo third'),
+                   dict(language='python', code='print("fourth")')]
+    t0 = time.time()
+    outputs, system_prompt = run_code_blocks(code_blocks, system_prompt0='base', iteration=1)
+    assert time.time() - t0 < 2.5
+    assert [x['stdout'].strip() for x in outputs] == ['first', 'second', 'third', 'fourth']
+    assert system_prompt.startswith('base')
+    assert 'If the python code successfully ran' in agent0.get_guidance(outputs)
+    # system prompt does not depend upon the blocks run, so its prefix can be cached
+    assert run_code_blocks([dict(language='user', code='hi')], system_prompt0='base')[1] == system_prompt
+
+
+def test_barrier_orders_blocks(work_dir):
+    code_blocks = [dict(language='bash', code='sleep 0.5; echo done > marker.txt'),
+                   dict(language='python_tools', code='def marker_tool():\n    """Marker."""\n    return 1\n'),
+                   dict(language='bash', code='cat marker.txt'),
+                   dict(language='exit', code=''),
+                   dict(language='bash', code='echo never')]
+    outputs, system_prompt = run_code_blocks(code_blocks, iteration=1)
+    assert [x['case'] for x in outputs] == ['bash', 'python_tools', 'bash', 'exit']
+    assert outputs[2]['stdout'].strip() == 'done'
+    assert 'from python_tools.marker_tool import marker_tool' in system_prompt
+
+
+def test_dependent_blocks_run_in_order(work_dir):
+    code_blocks = [dict(language='bash', code='sleep 0.3; echo data > f.txt'),
+                   dict(language='python', code='print(open("f.txt").read())'),
+                   dict(language='bash', code='cat f.txt')]
+    outputs, _ = run_code_blocks(code_blocks, iteration=1)
+    assert [x['exception'] for x in outputs] == [None, None, None]
+    assert [x['stdout'] for x in outputs[1:]] == ['data\n\n', 'data\n']
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+import agent0
+from agent0 import log_event, read_run_log
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_run_log_rotation_and_read(work_dir, monkeypatch, compress):
+    monkeypatch.setattr(agent0, 'run_log_compress', compress)
+    monkeypatch.setattr(agent0, 'run_log_max_bytes', 500)
+    for i in range(50):
+        log_event('block', iteration=i, case='bash', stdout='x' * 20)
+        log_event('llm', iteration=i, content='y')
+    files = os.listdir(agent0.run_log_dir)
+    assert len(files) > 2
+    assert all(x.endswith('.gz') == compress for x in files)
+
+    records = list(read_run_log(run_id=agent0.runid, events=['block']))
+    assert [x['iteration'] for x in records] == list(range(50))
+    assert records[0]['agent_id'] == agent0.myid
+    assert len(list(read_run_log(agent_id=agent0.myid + 1))) == 0
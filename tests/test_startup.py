@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+import agent0
+from agent0 import get_agent_cmd, invalidate_caches
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_heavy_imports_deferred():
+    deferred = ['openai', 'httpx', 'asyncio', 'concurrent.futures', 'subprocess', 'http.server', 'difflib', 'pprint',
+                'pkg_resources']
+    code = 'import sys; sys.path[0] = %r; import agent0; print(*[x for x in %r if x in sys.modules])' % (repo_dir,
+                                                                                                       deferred)
+    ret = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert ret.stdout.split() == []
+
+
+def test_invalidate_caches_only_tool_store(work_dir):
+    os.makedirs('python_tools')
+    path = os.path.abspath('python_tools')
+    other = os.path.abspath('elsewhere')
+    sys.path_importer_cache[path] = sys.path_importer_cache[os.path.join(path, 'sub')] = None
+    sys.path_importer_cache[other] = sys.path_importer_cache[path + '_other'] = None
+    invalidate_caches('python_tools')
+    assert path not in sys.path_importer_cache
+    assert os.path.join(path, 'sub') not in sys.path_importer_cache
+    assert sys.path_importer_cache.pop(other, 0) is None
+    assert sys.path_importer_cache.pop(path + '_other', 0) is None
+
+
+def test_agent_cmd_imports_module(work_dir):
+    with open('agent_copy.py', 'wt') as f:
+        f.write('import sys\n\n\ndef main(argv):\n    print(__name__, sys.path[0] == %r, argv)\n' % str(work_dir))
+    ret = subprocess.run(get_agent_cmd('--flag', 'x', script='agent_copy.py'), capture_output=True, text=True,
+                         check=True)
+    assert ret.stdout == "agent_copy True ['--flag', 'x']\n"
+    assert get_agent_cmd()[3] == os.path.dirname(agent0.__file__)
@@ -0,0 +1,89 @@
+import re
+import types
+
+import agent0
+from agent0 import iter_code_blocks
+
+
+content = "Plan:\n```bash\necho one\n```\nthen\n```python\nprint('two')\n```\n```\nno language\n```"
+
+
+def test_iter_code_blocks_matches_findall():
+    expected = [{'language': lang if lang else 'unknown', 'code': code.strip()}
+                for lang, code in agent0.code_block_pattern.findall(content)]
+    for size in [1, 2, 3, 7, len(content)]:
+        deltas = [content[i:i + size] for i in range(0, len(content), size)]
+        state = {}
+        assert list(iter_code_blocks(deltas, state)) == expected
+        assert state['content'] == content
+        assert state['blocks'] == 3
+
+
+def test_iter_code_blocks_yields_when_fenced():
+    seen = []
+
+    def deltas():
+        for delta in ["```bash\necho one\n", "```", "\nmore text ", "```bash\necho two\n```"]:
+            seen.append(delta)
+            yield delta
+
+    blocks = iter_code_blocks(deltas())
+    assert next(blocks)['code'] == 'echo one'
+    # first block is available before the rest of the response has arrived
+    assert len(seen) == 2
+
+
+def chunk(text=None, usage=None):
+    choices = [types.SimpleNamespace(delta=types.SimpleNamespace(content=text))] if text is not None else []
+    return types.SimpleNamespace(choices=choices, usage=usage)
+
+
+class StreamClient:
+    def __init__(self, text, usage=None):
+        self.requests = []
+        self.text = text
+        self.usage = usage
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        chunks = [chunk(self.text[i:i + 5]) for i in range(0, len(self.text), 5)]
+        if self.usage:
+            chunks.append(chunk(usage=self.usage))
+        return iter(chunks)
+
+
+def test_main_loop_streaming_usage(work_dir, monkeypatch, capsys):
+    usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=20, total_tokens=120)
+    client = StreamClient("```bash\necho streamed\n```\n```exit\n```\ntrailing text", usage=usage)
+    monkeypatch.setattr(agent0, 'get_client', lambda: (client, 'gpt-4o'))
+    monkeypatch.setattr(agent0, 'llm_stream', True)
+    agent0.main_loop()
+    assert client.requests[0]['stream'] is True
+    # the default Azure API version predates stream_options
+    assert 'stream_options' not in client.requests[0]
+    out = capsys.readouterr().out
+    assert 'stdout: streamed' in out
+    assert 'trailing text' in out
+    assert 'Tokens: p:100 c:20 t:120' in out
+
+
+def test_main_loop_streaming_local_usage(work_dir, monkeypatch, capsys):
+    client = StreamClient("```exit\n```")
+    monkeypatch.setattr(agent0, 'get_client', lambda: (client, 'gpt-4o'))
+    monkeypatch.setattr(agent0, 'llm_stream', True)
+    agent0.main_loop()
+    out = capsys.readouterr().out
+    prompt, completion = re.findall(r'Tokens: p:(\d+) c:(\d+)', out)[-1]
+    assert int(prompt) > 0
+    assert int(completion) == agent0.count_tokens("```exit\n```")
+
+
+def test_stream_usage_supported(monkeypatch):
+    monkeypatch.setattr(agent0, 'llm_backend', 'azure')
+    assert not agent0.get_stream_usage_supported()
+    monkeypatch.setattr(agent0, 'azure_api_version', '2024-10-21')
+    assert agent0.get_stream_usage_supported()
+    monkeypatch.setattr(agent0, 'azure_api_version', '2023-12-01-preview')
+    monkeypatch.setattr(agent0, 'llm_backend', 'local')
+    assert agent0.get_stream_usage_supported()
@@ -0,0 +1,60 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import agent0
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+tool_code = '''
+def tool_function_%d(x=1):
+    """
+    Tool %d.
+    """
+    return x
+'''
+
+
+def load_catalog():
+    with open(os.path.join('python_tools', agent0.tool_catalog_name), 'rt') as f:
+        return json.load(f)['modules']
+
+
+def test_concurrent_tool_store_scans(work_dir):
+    os.makedirs('python_tools')
+    for i in range(30):
+        with open(os.path.join('python_tools', agent0.generate_random_module_name() + '.py'), 'wt') as f:
+            f.write(tool_code % (i, i))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir, str(work_dir)]))
+    code = 'import agent0; lines, bad = agent0.get_tool_imports(validate=True); print(len(lines), len(bad))'
+    processes = [subprocess.Popen([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, text=True)
+                 for _ in range(4)]
+    outputs = [x.communicate(timeout=120)[0].split() for x in processes]
+    assert all(x.returncode == 0 for x in processes)
+    assert outputs == [['30', '0']] * 4
+    assert not os.path.isdir(os.path.join('python_tools', 'dead'))
+    modules = load_catalog()
+    assert sorted(modules) == sorted('tool_function_%d.py' % i for i in range(30))
+    assert all(x['validated'] for x in modules.values())
+
+
+def test_supervise(work_dir, monkeypatch):
+    shutil.copy(os.path.join(repo_dir, 'agent0.py'), 'agent0.py')
+    with open('rec.jsonl', 'wt') as f:
+        f.write(json.dumps(dict(content="```python_tools\n" + tool_code % (0, 0) + "```", usage=None)) + '\n')
+    monkeypatch.setenv('AGENT0_LLM_BACKEND', 'replay')
+    monkeypatch.setenv('AGENT0_LLM_RECORDING', 'rec.jsonl')
+    monkeypatch.setenv('AGENT0_AUTO_PIP_INSTALL', '0')
+
+    exit_codes = agent0.supervise(3, script='agent0.py', poll=0.1)
+    assert exit_codes == {0: 0, 1000: 0, 2000: 0}
+    for agent_id in exit_codes:
+        assert os.path.isfile(os.path.join(agent0.logs_dir, 'agent_%d.log' % agent_id))
+        assert list(agent0.read_run_log(agent_id=agent_id, events=['iteration']))
+    # each agent added its copy of the tool, only the first one is kept, under the tool's name
+    modules = load_catalog()
+    assert list(modules) == ['tool_function_0.py']
+    assert all(x['validated'] for x in modules.values())
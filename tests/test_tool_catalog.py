@@ -0,0 +1,141 @@
+import os
+import time
+
+import pytest
+
+import agent0
+from agent0 import get_tool_imports
+
+
+tool_code = '''
+def get_system_info(verbose=False):
+    """
+    Get system info.
+    """
+    return {}
+'''
+
+
+@pytest.fixture
+def tool_dir(work_dir):
+    os.makedirs('python_tools')
+    with open(os.path.join('python_tools', 'abcdefgh.py'), 'wt') as f:
+        f.write(tool_code)
+    return work_dir
+
+
+def test_tool_imports_renamed_and_cached(tool_dir, monkeypatch):
+    import_lines, bad_modules = get_tool_imports()
+    assert not bad_modules
+    assert len(import_lines) == 1
+    assert import_lines[0].endswith("from python_tools.get_system_info import get_system_info")
+    assert os.path.isfile(os.path.join('python_tools', 'get_system_info.py'))
+    assert os.path.isfile(os.path.join('python_tools', agent0.tool_catalog_name))
+
+    # unchanged modules are served from the catalog without importing them again
+    def fail_import(name):
+        raise AssertionError("unexpected import of %s" % name)
+    monkeypatch.setattr(agent0.importlib, 'import_module', fail_import)
+    agent0._tool_catalogs.clear()
+    assert get_tool_imports() == (import_lines, {})
+
+
+def test_duplicate_tool_dropped(tool_dir):
+    get_tool_imports()
+    # the same tool added by other agents, before and after the first copy was named
+    for name in ['zyxwvuts', 'bcdefghi']:
+        with open(os.path.join('python_tools', name + '.py'), 'wt') as f:
+            f.write(tool_code)
+    import_lines, bad_modules = get_tool_imports()
+    assert len(import_lines) == 1
+    assert sorted(agent0.load_tool_catalog('python_tools')['modules']) == ['get_system_info.py']
+    assert not os.path.exists(os.path.join('python_tools', 'zyxwvuts.py'))
+
+
+def test_tool_imports_changed_module(tool_dir):
+    get_tool_imports()
+    with open(os.path.join('python_tools', 'get_system_info.py'), 'at') as f:
+        f.write('\n\ndef get_disk_info():\n    """Get disk info."""\n    return {}\n')
+    import_lines, bad_modules = get_tool_imports()
+    assert len(import_lines) == 2
+    assert any("from python_tools.get_system_info import get_disk_info" in x for x in import_lines)
+
+
+def test_tool_imports_validate(tool_dir):
+    with open(os.path.join('python_tools', 'broken_tool.py'), 'wt') as f:
+        f.write('import not_a_real_module_xyz\n\n\ndef broken_tool():\n    """Broken."""\n')
+    # static extraction does not run tool code
+    import_lines, bad_modules = get_tool_imports()
+    assert not bad_modules
+    assert len(import_lines) == 2
+
+    import_lines, bad_modules = get_tool_imports(validate=True)
+    assert list(bad_modules) == [os.path.join('python_tools', 'broken_tool.py')]
+    assert len(import_lines) == 1
+    assert os.path.isfile(os.path.join('python_tools', 'dead', 'broken_tool.py'))
+
+
+def write_tool(name, code):
+    with open(os.path.join('python_tools', name + '.py'), 'wt') as f:
+        f.write(code + '\n\n\ndef %s():\n    """Tool."""\n' % name)
+
+
+def test_tool_validation_budget(tool_dir, monkeypatch):
+    monkeypatch.setattr(agent0, 'tool_import_timeout', 2)
+    monkeypatch.setitem(agent0.case_rlimits, 'tool_validate', dict(address_space=1024 ** 3))
+    write_tool('slow_tool', 'import time\ntime.sleep(30)')
+    write_tool('big_tool', 'x = bytearray(2 * 1024 ** 3)')
+    for i in range(4):
+        write_tool('ok_tool_%d' % i, 'import time\ntime.sleep(0.5)')
+    t0 = time.time()
+    import_lines, bad_modules = get_tool_imports(validate=True)
+    # validated in parallel, and the slow tool is cut off
+    assert time.time() - t0 < 10
+    assert len(import_lines) == 5
+    assert 'Import timeout' in bad_modules[os.path.join('python_tools', 'slow_tool.py')]
+    assert 'MemoryError' in bad_modules[os.path.join('python_tools', 'big_tool.py')]
+    with open(os.path.join('python_tools', 'dead', 'big_tool.error.txt'), 'rt') as f:
+        assert 'MemoryError' in f.read()
+
+
+def test_tool_verdict_cached_and_quarantine_collision(tool_dir, monkeypatch):
+    write_tool('broken_tool', 'import not_a_real_module_xyz')
+    _, bad_modules = get_tool_imports(validate=True)
+    assert 'not_a_real_module_xyz' in bad_modules[os.path.join('python_tools', 'broken_tool.py')]
+
+    # same content again is rejected from its cached verdict, without another import
+    monkeypatch.setattr(agent0, 'validate_tools', lambda path, names: pytest.fail("unexpected validation"))
+    write_tool('broken_tool', 'import not_a_real_module_xyz')
+    _, bad_modules = get_tool_imports(validate=True)
+    assert 'not_a_real_module_xyz' in bad_modules[os.path.join('python_tools', 'broken_tool.py')]
+    dead = sorted(x for x in os.listdir(os.path.join('python_tools', 'dead')) if x.endswith('.py'))
+    assert len(dead) == 2 and dead[0].startswith('broken_tool.')
+
+
+def test_tool_store_unlocked_during_validation(tool_dir, monkeypatch):
+    import fcntl
+
+    validate_tools = agent0.validate_tools
+    locked = []
+
+    def check_unlocked(path, module_names):
+        # another agent could take the tool store lock while these imports run
+        with open(os.path.join(path, agent0.tool_store_lock_name), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(f, fcntl.LOCK_UN)
+            except BlockingIOError:
+                locked.append(module_names)
+        return validate_tools(path, module_names)
+
+    monkeypatch.setattr(agent0, 'validate_tools', check_unlocked)
+    write_tool('good_tool', 'import os')
+    write_tool('bad_tool', 'import not_a_real_module_xyz')
+    import_lines, bad_modules = get_tool_imports(validate=True)
+    assert locked == []
+    assert len(import_lines) == 2
+    assert list(bad_modules) == [os.path.join('python_tools', 'bad_tool.py')]
+    assert os.path.isfile(os.path.join('python_tools', 'dead', 'bad_tool.py'))
+    modules = agent0.load_tool_catalog('python_tools')['modules']
+    assert sorted(modules) == ['get_system_info.py', 'good_tool.py']
+    assert all(x['validated'] for x in modules.values())
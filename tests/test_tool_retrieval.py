@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import agent0
+from agent0 import get_tool_context, get_tools_prompt, rank_tools, tokenize
+
+
+topics = ['extract text from pdf files', 'resize images', 'fetch weather forecast for a city',
+          'list running processes', 'transcribe audio to text', 'search the web', 'read csv tables',
+          'send email messages', 'compress directories to zip', 'get system memory info']
+
+
+@pytest.fixture
+def many_tools(work_dir, monkeypatch):
+    monkeypatch.setattr(agent0, '_prompt_segments', {})
+    monkeypatch.setattr(agent0, 'tool_retrieval_min', 5)
+    monkeypatch.setattr(agent0, 'tool_retrieval_k', 2)
+    os.makedirs('python_tools')
+    for i, topic in enumerate(topics):
+        name = 'tool_%d_%s' % (i, '_'.join(topic.split()[:2]))
+        with open(os.path.join('python_tools', name + '.py'), 'wt') as f:
+            f.write('def %s(path):\n    """\n    Tool to %s.\n    """\n    return path\n' % (name, topic))
+    return work_dir
+
+
+def test_tokenize():
+    assert tokenize('GetPDFText get_pdf_text(path=1)') == ['get', 'pdf', 'text', 'get', 'pdf', 'text', 'path']
+
+
+def test_compact_catalog_and_top_k(many_tools):
+    prompt = get_tools_prompt()
+    assert 'Tool to' not in prompt
+    assert 'tool_0_extract_text: tool_0_extract_text' in prompt
+
+    text, stats = get_tool_context("Traceback: could not extract the text of report.pdf")
+    assert stats['catalog'] == len(topics)
+    assert stats['shown'] == 2
+    assert stats['saved_tokens'] > 0
+    assert text.index('Tool to extract text from pdf files') < text.index('Tool to transcribe audio to text')
+    assert 'weather' not in text
+
+
+def test_rank_tools_no_match(many_tools):
+    docs = agent0.get_tool_docs()
+    assert rank_tools('zzz qqq', docs) == []
+
+
+def test_small_catalog_in_full(many_tools, monkeypatch):
+    monkeypatch.setattr(agent0, 'tool_retrieval_min', 20)
+    assert 'Tool to resize images' in get_tools_prompt()
+    text, stats = get_tool_context('resize images')
+    assert text is None
+    assert stats == dict(catalog=len(topics), shown=len(topics), saved_tokens=0)